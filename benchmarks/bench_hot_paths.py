@@ -0,0 +1,188 @@
+# Timing of the per cycle hot paths with mocked connections.
+# python benchmarks/bench_hot_paths.py --output bench.json [--compare bench_old.json]
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wallbox_system_state import WBSystemState
+from pv_modbus_wallbox import WBDef
+from pv_modbus_solarlog import SolarLogData
+from wallbox_proxy import WallboxProxy
+from toolbox import Toolbox
+from config_file import ConfigFile
+import pv_database
+from pv_sqlite_database import PVSQLiteDatabase
+from unittest import mock
+import argparse
+import datetime
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+WALLBOX_COUNTS = [2, 16, 64, 256]
+
+
+class FakeWallboxConnection:
+    def set_max_current(self, slave_id: int, val: int):
+        return True
+
+    def set_standby_control(self, slave_id: int, val):
+        return True
+
+
+def setup_config() -> ConfigFile:
+    cfg = ConfigFile()
+    cfg.WB_SYSTEM_MAX_CURRENT = 16.0
+    cfg.WB_MIN_CURRENT = 6.0
+    cfg.PV_CHARGE_AMP_TOLERANCE = 2.0
+    cfg.REDUCE_AVAILABLE_CURRENT_BY = 1.0
+    cfg.MIN_TIME_PV_CHARGE = 60
+    cfg.MIN_WAIT_BEFORE_PV_ON = 60
+    cfg.KEEP_CHARGE_CURRENT_STABLE_FOR = 20
+    cfg.INFLUX_HOST = '127.0.0.1'
+    cfg.INFLUX_PORT = 8086
+    cfg.INFLUX_USER = 'pv_modbus'
+    cfg.INFLUX_PWD = '#'
+    cfg.INFLUX_DB_NAME = 'pv_modbus'
+    cfg.INFLUX_QUEUE_SIZE = 1000000
+    return cfg
+
+
+# half of the WBs already charge, all of them have a car plugged in and are out of their hold times
+def setup_wallboxes(count: int, pv_charge_active: bool = True, grid_charge_active: bool = False):
+    long_ago = datetime.datetime.now() - datetime.timedelta(hours=1)
+    wallbox = [WBSystemState(slave_id) for slave_id in range(1, count + 1)]
+    for wb in wallbox:
+        wb.charge_state = WBDef.CHARGE_REQUEST1
+        wb.last_charge_activation = long_ago
+        wb.last_charge_deactivation = long_ago
+        wb.pv_charge_active = pv_charge_active and wb.slave_id % 2 == 0
+        wb.grid_charge_active = grid_charge_active
+    return wallbox
+
+
+# fn(state) gets timed, setup() builds a fresh state for every run and is not timed
+def measure(name: str, count: int, setup, fn, runs: int) -> dict:
+    timings = []
+    for _ in range(runs):
+        state = setup()
+        start = time.perf_counter()
+        fn(state)
+        timings.append(time.perf_counter() - start)
+    return {'name': name, 'wallboxes': count, 'runs': runs,
+            'min_us': min(timings) * 1e6, 'median_us': statistics.median(timings) * 1e6,
+            'mean_us': statistics.mean(timings) * 1e6}
+
+
+def bench_allocation(cfg: ConfigFile, runs: int) -> list:
+    connection = FakeWallboxConnection()
+    wb_prox = WallboxProxy(cfg)
+    results = []
+    for count in WALLBOX_COUNTS:
+        results.append(measure('activate_pv_charge', count, lambda: setup_wallboxes(count)
+                               , lambda wallbox: wb_prox.activate_pv_charge(connection, wallbox, count * 8.0), runs))
+        results.append(measure('activate_pv_charge_waterfill', count, lambda: setup_wallboxes(count)
+                               , lambda wallbox: wb_prox.activate_pv_charge_waterfill(connection, wallbox, count * 8.0)
+                               , runs))
+        results.append(measure('activate_grid_charge', count, lambda: setup_wallboxes(count, False)
+                               , lambda wallbox: wb_prox.activate_grid_charge(connection, wallbox), runs))
+        results.append(measure('deactivate_grid_charge', count, lambda: setup_wallboxes(count, False, True)
+                               , lambda wallbox: wb_prox.deactivate_grid_charge(connection, wallbox), runs))
+    return results
+
+
+def bench_toolbox(runs: int) -> list:
+    solar_log_data = SolarLogData()
+    solar_log_data.actual_output = 6370
+    solar_log_data.actual_consumption = 5160
+    return [measure('calc_available_power', 0, lambda: solar_log_data
+                    , lambda data: Toolbox.calc_available_power(data, 4440), runs)]
+
+
+def bench_database(cfg: ConfigFile, runs: int) -> list:
+    results = []
+    with mock.patch.object(pv_database, 'InfluxDBClient'):
+        database = pv_database.PVDatabase(cfg)
+        solar_log_data = SolarLogData()
+        database.write_solarlog_data(solar_log_data)
+        results.append(measure('solarlog_only_if_changed_unchanged', 0, lambda: solar_log_data
+                               , database.write_solarlog_data_only_if_changed, runs))
+        for count in WALLBOX_COUNTS:
+            wallbox = setup_wallboxes(count)
+            database.write_wallbox_data(wallbox)
+            results.append(measure('wallbox_only_if_changed_unchanged', count, lambda: wallbox
+                                   , database.write_wallbox_data_only_if_changed, runs))
+            results.append(measure('wallbox_data_write', count, lambda: wallbox
+                                   , database.write_wallbox_data, runs))
+            results.append(measure('format_wallbox_lines', count, lambda: wallbox
+                                   , lambda wbs: [database.format_wallbox_line(wb, 1700000000) for wb in wbs], runs))
+        database.close(timeout=5)
+    return results
+
+
+# the cycle only queues the rows. _commit is what the writer thread does with one cycle of rows
+def bench_sqlite(cfg: ConfigFile, runs: int) -> list:
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        cfg.SQLITE_PATH = os.path.join(directory, 'bench.sqlite')
+        database = PVSQLiteDatabase(cfg)
+        timestamps = iter(range(1700000000, 1800000000))
+        for count in WALLBOX_COUNTS:
+            wallbox = setup_wallboxes(count)
+            results.append(measure('sqlite_wallbox_data_write', count, lambda: wallbox
+                                   , database.write_wallbox_data, runs))
+            results.append(measure('sqlite_commit_one_cycle', count
+                                   , lambda: {'solarlog': [], 'wallbox': [database.wallbox_row(wb, next(timestamps))
+                                                                          for wb in wallbox]}
+                                   , database._commit, runs))
+        database.close(timeout=30)
+    return results
+
+
+def git_version() -> str:
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL
+                                       , cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return 'unknown'
+
+
+def compare(results: list, old_path: str):
+    with open(old_path) as f:
+        old = {(r['name'], r['wallboxes']): r for r in json.load(f)['results']}
+    for r in results:
+        before = old.get((r['name'], r['wallboxes']))
+        if before is not None and before['median_us'] > 0:
+            print('%-36s %4s WBs  %10.1f us -> %10.1f us  (%+.0f %%)' % (
+                r['name'], r['wallboxes'], before['median_us'], r['median_us']
+                , (r['median_us'] / before['median_us'] - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of allocation and persistence hot paths')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--compare', help='results of an earlier run')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)  # same as main.py
+    cfg = setup_config()
+    results = bench_allocation(cfg, args.runs) + bench_toolbox(args.runs) + bench_database(cfg, args.runs) \
+        + bench_sqlite(cfg, args.runs)
+
+    with open(args.output, 'w') as f:
+        json.dump({'version': git_version(), 'python': platform.python_version(), 'machine': platform.machine()
+                   , 'date': datetime.datetime.now().isoformat(), 'results': results}, f, indent=2)
+
+    for r in results:
+        print('%-36s %4s WBs  median %10.1f us' % (r['name'], r['wallboxes'], r['median_us']))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
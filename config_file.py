@@ -1,26 +1,126 @@
 
+from typing import List
+import configparser
+
+
+# wallboxes that share one RS485 bus
+class WallboxGroupConfig:
+    def __init__(self, name: str, rtu_device: str, slave_ids: List[int]):
+        self.name = name
+        self.rtu_device = rtu_device
+        self.slave_ids = slave_ids
+
+    def __eq__(self, other):
+        return isinstance(other, WallboxGroupConfig) and vars(self) == vars(other)
+
+
+# One loaded config. Not changed once it is in use: a reload builds a new one (see PVController.reload_config)
 class ConfigFile:
+    # settings that are read again in every cycle. Changing them takes effect without a restart
+    RELOADABLE = ('WB_SYSTEM_MAX_CURRENT', 'WB_MIN_CURRENT', 'WB_SITE_MAX_CURRENT', 'WB_ALLOCATOR'
+                  , 'PV_CHARGE_AMP_TOLERANCE', 'REDUCE_AVAILABLE_CURRENT_BY', 'KEEP_CHARGE_CURRENT_STABLE_FOR'
+                  , 'MIN_TIME_PV_CHARGE', 'MIN_WAIT_BEFORE_PV_ON', 'SOLARLOG_WRITE_EVERY', 'WB_REGISTER_VERIFY_EVERY'
+                  , 'CYCLE_TIME', 'POLL_FAST', 'POLL_SLOW', 'POLL_PV_DELTA_FAST')
 
     def __init__(self, config=None):
+        # optional settings. These defaults are used if the config file does not set them
+        self.INFLUX_QUEUE_SIZE = 100  # max. number of queued writes, while the DB is slow or gone
+        self.INFLUX_BATCH_DELAY = 0.5  # seconds. Collect all writes of a cycle into one request
+        self.INFLUX_TIMEOUT = 10  # seconds
+        self.SOLARLOG_TIMEOUT = 3  # seconds per request
+        self.SOLARLOG_BACKOFF_MIN = 1  # seconds before the first reconnect. Doubles with every failed one
+        self.SOLARLOG_BACKOFF_MAX = 60  # seconds
+        self.SPOOL_DIR = ''  # keep data on disk while the DB is gone. Empty -> no spool
+        self.SPOOL_SEGMENT_SIZE = 1024 * 1024  # bytes
+        self.SPOOL_MAX_SIZE = 64 * 1024 * 1024  # bytes. Oldest data gets dropped above this
+        self.SPOOL_REPLAY_BATCH = 5000  # lines per request when writing the spool to the DB
+        self.SPOOL_REPLAY_EVERY = 30  # seconds. Check if the DB is back
+        self.ROLLUP_RESOLUTIONS: List[int] = []  # seconds, e.g. [10, 300]. Write min/max/mean/last per interval. Empty -> raw points
+        self.SQLITE_PATH = 'pv_modbus.sqlite'  # file of DATA_SINK = sqlite
+        self.SQLITE_COMMIT_EVERY = 10  # seconds. Everything of that time is written in one transaction
+        self.SQLITE_RETENTION_DAYS = 30  # older data gets deleted. 0 -> keep everything
+        self.SQLITE_PRUNE_BUCKET = 3600  # seconds. Old data is deleted in slices of this size
+        self.ASYNC_LOOP = False  # poll SolarLog and wallboxes at the same time
+        self.CYCLE_TIME = 5  # seconds between two control cycles
+        self.POLL_FAST = 2  # seconds between two cycles while charging or while the PV output changes fast
+        self.POLL_SLOW = 30  # seconds between two cycles at night or without any plug connected
+        self.POLL_PV_DELTA_FAST = 500  # Watt. PV output change from one cycle to the next to switch to fast polling
+        self.HISTORY_WINDOW = 60  # cycles of PV output, consumption and charge currents kept for statistics
+        self.METRICS_PORT = 0  # port of the Prometheus endpoint (/metrics). 0 -> disabled
+        self.METRICS_ADDRESS = '127.0.0.1'  # only reachable from this host by default
+        self.CONFIG_RELOAD = True  # apply changes of the config file between two cycles (RELOADABLE settings only)
+        self.WB_TIMEOUT = 3  # seconds. Max. time to wait for a WB to answer. Adapts to the WB below that
+        self.WB_TIMEOUT_MIN = 0.2  # seconds
+        self.WB_BREAKER_FAILURES = 3  # WB does not answer x times in a row -> skip it
+        self.WB_BREAKER_PROBE_EVERY = 60  # seconds. Try a skipped WB again
+        self.WB_REGISTER_VERIFY_EVERY = 300  # seconds. Read back the holding registers of the WBs
+        self.WB_GROUPS: List[WallboxGroupConfig] = []  # empty -> WB1_SLAVEID and WB2_SLAVEID on WB_RTU_DEVICE
+        self.WB_SITE_MAX_CURRENT = 0.0  # Ampere. Max. PV charge current of all WBs together. 0 -> no limit
+        self.WB_ALLOCATOR = 'greedy'  # PV current split: 'greedy' (by priority) or 'waterfill' (evenly)
+        self.PV_FORECAST = False  # charge with the PV output predicted for the next minutes instead of the measured one
+        self.PV_FORECAST_HORIZON = 120  # seconds ahead
+        self.PV_FORECAST_SMOOTHING = 0.3  # 0..1. Higher -> follows the measured output faster
+        self.PV_FORECAST_WINDOW = 12  # samples the trend is calculated from
+        self.DATA_SINK = 'influx'  # where the data goes: 'influx', 'sqlite', 'none' or 'uplink' (pv_supervisor)
+        self.WB_TRANSPORT = 'modbus_rtu'  # how the WBs are reached
+        self.SOLARLOG_TRANSPORT = 'modbus_tcp'  # how the SolarLog is reached
+        self.SWITCH_INPUT = 'gpio'  # where the PV/grid switch is read from, if HAVE_SWITCH: 'gpio' or 'file'
+        self.SWITCH_FILE = ''  # SWITCH_INPUT = file: '0' in there -> grid charge, else PV only
+        self.SWITCH_DEBOUNCE = 0.05  # seconds the switch has to be stable
+
         if config is not None:
             self.HAVE_SWITCH = config['SWITCH'].getboolean('HAVE_SWITCH')
+            self.SWITCH_INPUT = config['SWITCH'].get('SWITCH_INPUT', fallback=self.SWITCH_INPUT)
+            self.SWITCH_FILE = config['SWITCH'].get('SWITCH_FILE', fallback=self.SWITCH_FILE)
+            self.SWITCH_DEBOUNCE = config['SWITCH'].getfloat('SWITCH_DEBOUNCE', fallback=self.SWITCH_DEBOUNCE)
 
             self.SOLARLOG_IP = config['SOLARLOG']['SOLARLOG_IP']
             self.SOLARLOG_PORT = int(config['SOLARLOG']['SOLARLOG_PORT'])
             self.SOLARLOG_SLAVEID = int(config['SOLARLOG']['SOLARLOG_SLAVEID'])
+            self.SOLARLOG_TRANSPORT = config['SOLARLOG'].get('SOLARLOG_TRANSPORT', fallback=self.SOLARLOG_TRANSPORT)
+            self.SOLARLOG_TIMEOUT = config['SOLARLOG'].getfloat('SOLARLOG_TIMEOUT', fallback=self.SOLARLOG_TIMEOUT)
+            self.SOLARLOG_BACKOFF_MIN = config['SOLARLOG'].getfloat('SOLARLOG_BACKOFF_MIN'
+                                                                    , fallback=self.SOLARLOG_BACKOFF_MIN)
+            self.SOLARLOG_BACKOFF_MAX = config['SOLARLOG'].getfloat('SOLARLOG_BACKOFF_MAX'
+                                                                    , fallback=self.SOLARLOG_BACKOFF_MAX)
 
-            self.WB1_SLAVEID = int(
-                config['WALLBOX']['WB1_SLAVEID'])  # Slave ID is also Priority (e.g. for new(!) PV Charge requests)
-            self.WB2_SLAVEID = int(config['WALLBOX']['WB2_SLAVEID'])  # smaller numbers mean higher priority
-            self.WB_RTU_DEVICE = config['WALLBOX']['WB_RTU_DEVICE']
+            # each group is one RS485 bus. Slave IDs have to be unique over all groups
+            wb_groups = [name.strip() for name in config['WALLBOX'].get('WB_GROUPS', fallback='').split(',')
+                         if name.strip()]
+            for name in wb_groups:
+                section = config['WB_GROUP ' + name]
+                self.WB_GROUPS.append(WallboxGroupConfig(name, section['WB_RTU_DEVICE']
+                                                         , [int(i) for i in section['WB_SLAVEIDS'].split(',')]))
+            if not wb_groups:
+                self.WB1_SLAVEID = int(
+                    config['WALLBOX']['WB1_SLAVEID'])  # Slave ID is also Priority (e.g. for new(!) PV Charge requests)
+                self.WB2_SLAVEID = int(config['WALLBOX']['WB2_SLAVEID'])  # smaller numbers mean higher priority
+                self.WB_RTU_DEVICE = config['WALLBOX']['WB_RTU_DEVICE']
 
             self.WB_SYSTEM_MAX_CURRENT = float(config['WALLBOX']['WB_SYSTEM_MAX_CURRENT'])  # Ampere
             self.WB_MIN_CURRENT = float(config['WALLBOX']['WB_MIN_CURRENT'])  # Ampere
+            self.WB_SITE_MAX_CURRENT = config['WALLBOX'].getfloat('WB_SITE_MAX_CURRENT', fallback=self.WB_SITE_MAX_CURRENT)
+            self.WB_ALLOCATOR = config['WALLBOX'].get('WB_ALLOCATOR', fallback=self.WB_ALLOCATOR)
+            self.WB_TRANSPORT = config['WALLBOX'].get('WB_TRANSPORT', fallback=self.WB_TRANSPORT)
+            if self.WB_ALLOCATOR not in ('greedy', 'waterfill'):
+                raise ValueError('WB_ALLOCATOR must be greedy or waterfill, not ' + self.WB_ALLOCATOR)
             # Amp -> if we do not have enough PV power to reach the WB min, use this threshold value
             self.PV_CHARGE_AMP_TOLERANCE = float(config['WALLBOX']['PV_CHARGE_AMP_TOLERANCE'])
             # and take up to x Amp from grid
             self.REDUCE_AVAILABLE_CURRENT_BY = float(config['WALLBOX']['REDUCE_AVAILABLE_CURRENT_BY'])
             self.KEEP_CHARGE_CURRENT_STABLE_FOR = int(config['WALLBOX']['KEEP_CHARGE_CURRENT_STABLE_FOR'])
+            self.PV_FORECAST = config['WALLBOX'].getboolean('PV_FORECAST', fallback=self.PV_FORECAST)
+            self.PV_FORECAST_HORIZON = config['WALLBOX'].getfloat('PV_FORECAST_HORIZON', fallback=self.PV_FORECAST_HORIZON)
+            self.PV_FORECAST_SMOOTHING = config['WALLBOX'].getfloat('PV_FORECAST_SMOOTHING'
+                                                                    , fallback=self.PV_FORECAST_SMOOTHING)
+            self.PV_FORECAST_WINDOW = config['WALLBOX'].getint('PV_FORECAST_WINDOW', fallback=self.PV_FORECAST_WINDOW)
+            self.WB_REGISTER_VERIFY_EVERY = config['WALLBOX'].getint('WB_REGISTER_VERIFY_EVERY'
+                                                                     , fallback=self.WB_REGISTER_VERIFY_EVERY)
+            self.WB_TIMEOUT = config['WALLBOX'].getfloat('WB_TIMEOUT', fallback=self.WB_TIMEOUT)
+            self.WB_TIMEOUT_MIN = config['WALLBOX'].getfloat('WB_TIMEOUT_MIN', fallback=self.WB_TIMEOUT_MIN)
+            self.WB_BREAKER_FAILURES = config['WALLBOX'].getint('WB_BREAKER_FAILURES', fallback=self.WB_BREAKER_FAILURES)
+            self.WB_BREAKER_PROBE_EVERY = config['WALLBOX'].getfloat('WB_BREAKER_PROBE_EVERY'
+                                                                     , fallback=self.WB_BREAKER_PROBE_EVERY)
 
             # time constraints
             # secs. We want to charge at least for x secs before switch on->off (PV charge related)
@@ -34,8 +134,67 @@ class ConfigFile:
 
             self.GPIO_SWITCH = int(config['SWITCH']['GPIO_SWITCH'])
 
-            self.INFLUX_HOST = config['LOGGING']['INFLUX_HOST']
-            self.INFLUX_PORT = int(config['LOGGING']['INFLUX_PORT'])
-            self.INFLUX_USER = config['LOGGING']['INFLUX_USER']
-            self.INFLUX_PWD = config['LOGGING']['INFLUX_PWD']
-            self.INFLUX_DB_NAME = config['LOGGING']['INFLUX_DB_NAME']
+            self.read_logging(config['LOGGING'])
+
+            if config.has_section('RUNTIME'):
+                self.ASYNC_LOOP = config['RUNTIME'].getboolean('ASYNC_LOOP', fallback=self.ASYNC_LOOP)
+                self.CYCLE_TIME = config['RUNTIME'].getfloat('CYCLE_TIME', fallback=self.CYCLE_TIME)
+                self.POLL_FAST = config['RUNTIME'].getfloat('POLL_FAST', fallback=self.POLL_FAST)
+                self.POLL_SLOW = config['RUNTIME'].getfloat('POLL_SLOW', fallback=self.POLL_SLOW)
+                self.POLL_PV_DELTA_FAST = config['RUNTIME'].getint('POLL_PV_DELTA_FAST', fallback=self.POLL_PV_DELTA_FAST)
+                self.HISTORY_WINDOW = config['RUNTIME'].getint('HISTORY_WINDOW', fallback=self.HISTORY_WINDOW)
+                self.METRICS_PORT = config['RUNTIME'].getint('METRICS_PORT', fallback=self.METRICS_PORT)
+                self.METRICS_ADDRESS = config['RUNTIME'].get('METRICS_ADDRESS', fallback=self.METRICS_ADDRESS)
+                self.CONFIG_RELOAD = config['RUNTIME'].getboolean('CONFIG_RELOAD', fallback=self.CONFIG_RELOAD)
+
+    # where the data goes. Also used for the uplink of pv_supervisor, which has no other site settings
+    def read_logging(self, section: configparser.SectionProxy):
+        self.DATA_SINK = section.get('DATA_SINK', fallback=self.DATA_SINK)
+        if self.DATA_SINK == 'influx':  # the other sinks do without
+            self.INFLUX_HOST = section['INFLUX_HOST']
+            self.INFLUX_PORT = int(section['INFLUX_PORT'])
+            self.INFLUX_USER = section['INFLUX_USER']
+            self.INFLUX_PWD = section['INFLUX_PWD']
+            self.INFLUX_DB_NAME = section['INFLUX_DB_NAME']
+        self.INFLUX_QUEUE_SIZE = section.getint('INFLUX_QUEUE_SIZE', fallback=self.INFLUX_QUEUE_SIZE)
+        self.INFLUX_BATCH_DELAY = section.getfloat('INFLUX_BATCH_DELAY', fallback=self.INFLUX_BATCH_DELAY)
+        self.INFLUX_TIMEOUT = section.getint('INFLUX_TIMEOUT', fallback=self.INFLUX_TIMEOUT)
+        self.SPOOL_DIR = section.get('SPOOL_DIR', fallback=self.SPOOL_DIR)
+        self.SPOOL_SEGMENT_SIZE = section.getint('SPOOL_SEGMENT_SIZE', fallback=self.SPOOL_SEGMENT_SIZE)
+        self.SPOOL_MAX_SIZE = section.getint('SPOOL_MAX_SIZE', fallback=self.SPOOL_MAX_SIZE)
+        self.SPOOL_REPLAY_BATCH = section.getint('SPOOL_REPLAY_BATCH', fallback=self.SPOOL_REPLAY_BATCH)
+        self.SPOOL_REPLAY_EVERY = section.getint('SPOOL_REPLAY_EVERY', fallback=self.SPOOL_REPLAY_EVERY)
+        self.ROLLUP_RESOLUTIONS = [int(resolution) for resolution
+                                   in section.get('ROLLUP_RESOLUTIONS', fallback='').split(',')
+                                   if resolution.strip()]
+        if any(resolution <= 0 for resolution in self.ROLLUP_RESOLUTIONS):
+            raise ValueError('ROLLUP_RESOLUTIONS must be seconds > 0, not ' + str(self.ROLLUP_RESOLUTIONS))
+        self.SQLITE_PATH = section.get('SQLITE_PATH', fallback=self.SQLITE_PATH)
+        self.SQLITE_COMMIT_EVERY = section.getfloat('SQLITE_COMMIT_EVERY', fallback=self.SQLITE_COMMIT_EVERY)
+        self.SQLITE_RETENTION_DAYS = section.getfloat('SQLITE_RETENTION_DAYS', fallback=self.SQLITE_RETENTION_DAYS)
+        self.SQLITE_PRUNE_BUCKET = section.getint('SQLITE_PRUNE_BUCKET', fallback=self.SQLITE_PRUNE_BUCKET)
+
+    # all wallboxes, grouped by the RS485 bus they are connected to
+    def get_wallbox_groups(self) -> List[WallboxGroupConfig]:
+        if self.WB_GROUPS:
+            groups = self.WB_GROUPS
+        else:
+            groups = [WallboxGroupConfig('default', self.WB_RTU_DEVICE, [self.WB1_SLAVEID, self.WB2_SLAVEID])]
+
+        slave_ids = [slave_id for group in groups for slave_id in group.slave_ids]
+        if len(slave_ids) != len(set(slave_ids)):
+            raise ValueError('Wallbox Slave IDs have to be unique over all groups: ' + str(slave_ids))
+        return groups
+
+    # name -> (value here, value in other) of every setting that differs
+    def diff(self, other) -> dict:
+        names = set(vars(self)) | set(vars(other))
+        return {name: (getattr(self, name, None), getattr(other, name, None)) for name in sorted(names)
+                if getattr(self, name, None) != getattr(other, name, None)}
+
+
+def load_config(path: str) -> ConfigFile:
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        raise FileNotFoundError('Config file not found: ' + path)
+    return ConfigFile(config)
@@ -0,0 +1,104 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+EVENT_HEADER = struct.Struct('iIII')  # struct inotify_event: wd, mask, cookie, len. The name follows
+
+
+# Tells when the config file got written. Watches its directory with inotify (editors often write a new file and
+# rename it over the old one), through libc, so no extra package is needed. Without inotify the mtime gets polled.
+# on_change is called from the watcher thread; pending() tells the control loop between two cycles
+class ConfigWatcher:
+    def __init__(self, path: str, on_change=None, poll_every: float = 2.0):
+        self.path = os.path.abspath(path)
+        self.name = os.fsencode(os.path.basename(self.path))
+        self.on_change = on_change
+        self.poll_every = poll_every  # seconds between two mtime checks, without inotify
+        self.changed = threading.Event()
+        self.stop_event = threading.Event()
+        self.mtime = self._mtime()
+        self.fd = self._inotify(os.path.dirname(self.path))
+        self.stop_pipe = os.pipe()  # ends the select of the watcher thread
+        self.thread = threading.Thread(target=self._watch, name='config-watcher', daemon=True)
+
+    def _inotify(self, directory: str):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, 'inotify_add_watch failed')
+            return fd
+        except (OSError, AttributeError) as e:  # AttributeError: libc without inotify
+            logging.warning('No inotify (%s). Checking %s every %s s', str(e), self.path, self.poll_every)
+            return None
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    # names of the files in the events
+    @staticmethod
+    def _names(data: bytes) -> list:
+        names = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            names.append(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+        return names
+
+    def _notify(self):
+        logging.warning('Config file %s changed', self.path)
+        self.changed.set()
+        if self.on_change is not None:
+            self.on_change()
+
+    def _watch(self):
+        while not self.stop_event.is_set():
+            if self.fd is not None:
+                ready, _, _ = select.select([self.fd, self.stop_pipe[0]], [], [])
+                if self.fd not in ready:
+                    continue
+                try:
+                    data = os.read(self.fd, 4096)
+                except BlockingIOError:
+                    continue
+                if self.name in self._names(data):
+                    self._notify()
+            elif not self.stop_event.wait(self.poll_every):
+                mtime = self._mtime()
+                if mtime != self.mtime:
+                    self.mtime = mtime
+                    self._notify()
+
+    def start(self):
+        self.thread.start()
+
+    # True once after every change
+    def pending(self) -> bool:
+        if self.changed.is_set():
+            self.changed.clear()
+            return True
+        return False
+
+    def stop(self):
+        self.stop_event.set()
+        os.write(self.stop_pipe[1], b'x')
+        self.thread.join()
+        if self.fd is not None:
+            os.close(self.fd)
+        for fd in self.stop_pipe:
+            os.close(fd)
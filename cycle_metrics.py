@@ -0,0 +1,148 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
+import collections
+import threading
+import time
+
+
+# duration of one stage. Cumulative buckets as Prometheus expects them, plus quantiles of the last `window` cycles
+class StageHistogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, window: int):
+        self.bucket_counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def recent_quantiles(self) -> dict:
+        if not self.recent:
+            return {}
+        ordered = sorted(self.recent)
+        quantiles = {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in self.QUANTILES}
+        quantiles[1.0] = ordered[-1]
+        return quantiles
+
+
+# Timing per stage of the control cycle and Modbus errors per slave, rendered in the Prometheus text format
+class CycleMetrics:
+    def __init__(self, window: int = 100):
+        self.window = window
+        self.lock = threading.Lock()
+        self.histograms = {}  # stage -> StageHistogram
+        self.current_cycle = collections.defaultdict(float)  # stage -> seconds spent in this cycle so far
+        self.modbus_errors = collections.defaultdict(int)  # (slave, kind) -> count
+        self.gauges = {}  # (name, labels) -> value
+        self.counters = {}  # (name, labels) -> total, counted somewhere else (e.g. overruns of the poll scheduler)
+
+    # time spent in the block counts for the stage. A stage may be entered several times per cycle (e.g. writes)
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - start)
+
+    def add_stage_time(self, name: str, seconds: float):
+        with self.lock:
+            self.current_cycle[name] += seconds
+
+    def end_cycle(self, cycle_time: float):
+        with self.lock:
+            self.current_cycle['cycle'] = cycle_time
+            for name, seconds in self.current_cycle.items():
+                if name not in self.histograms:
+                    self.histograms[name] = StageHistogram(self.window)
+                self.histograms[name].observe(seconds)
+            self.current_cycle.clear()
+
+    # kind: 'error' (exception response, broken frame) or 'timeout' (no response at all)
+    def count_modbus_error(self, slave, kind: str):
+        with self.lock:
+            self.modbus_errors[(str(slave), kind)] += 1
+
+    def set_gauge(self, name: str, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    # name ends with _total. The value only goes up, or starts over at 0 (e.g. after a restart)
+    def set_counter(self, name: str, total, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] = total
+
+    @staticmethod
+    def _labels(**labels) -> str:
+        return '{' + ','.join('%s="%s"' % (k, v) for k, v in labels.items()) + '}'
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            lines.append('# HELP pv_cycle_stage_seconds Time spent per stage of a control cycle')
+            lines.append('# TYPE pv_cycle_stage_seconds histogram')
+            for stage, histogram in sorted(self.histograms.items()):
+                for bound, count in zip(StageHistogram.BUCKETS, histogram.bucket_counts):
+                    lines.append('pv_cycle_stage_seconds_bucket%s %s' % (self._labels(stage=stage, le=bound), count))
+                lines.append('pv_cycle_stage_seconds_bucket%s %s' % (self._labels(stage=stage, le='+Inf'), histogram.count))
+                lines.append('pv_cycle_stage_seconds_sum%s %s' % (self._labels(stage=stage), histogram.sum))
+                lines.append('pv_cycle_stage_seconds_count%s %s' % (self._labels(stage=stage), histogram.count))
+
+            lines.append('# HELP pv_cycle_stage_seconds_recent Quantiles of the stage time over the last %s cycles'
+                         % self.window)
+            lines.append('# TYPE pv_cycle_stage_seconds_recent gauge')
+            for stage, histogram in sorted(self.histograms.items()):
+                for quantile, seconds in histogram.recent_quantiles().items():
+                    lines.append('pv_cycle_stage_seconds_recent%s %s' % (self._labels(stage=stage, quantile=quantile)
+                                                                         , seconds))
+
+            lines.append('# HELP pv_modbus_errors_total Failed Modbus transactions per slave')
+            lines.append('# TYPE pv_modbus_errors_total counter')
+            for (slave, kind), count in sorted(self.modbus_errors.items()):
+                lines.append('pv_modbus_errors_total%s %s' % (self._labels(slave=slave, kind=kind), count))
+
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append('# TYPE %s %s' % (name, kind))
+                    for (metric, labels), value in sorted(values.items()):
+                        if metric == name:
+                            lines.append('%s%s %s' % (name, self._labels(**dict(labels)) if labels else '', value))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    def __init__(self, metrics: CycleMetrics, address: str, port: int):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # no access log on the console
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        self.address = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,60 @@
+from config_file import ConfigFile
+import logging
+import threading
+import time
+
+
+# Cycles start on fixed deadlines (monotonic clock), so the period does not drift with the time the I/O takes.
+# The period itself adapts: fast while charging or while PV output jumps, slow at night or without any plug.
+class AdaptivePollScheduler:
+    def __init__(self, cfg: ConfigFile):
+        self.cfg = cfg
+        self.next_deadline = time.monotonic()
+        self.last_pv_output = None
+        self.wake_event = threading.Event()
+
+        self.cycles = 0
+        self.overruns = 0
+        self.overrun_time = 0.0  # seconds we were late in total
+        self.period = cfg.CYCLE_TIME
+
+    def choose_period(self, charging_active: bool, plug_connected: bool, pv_output: int) -> float:
+        pv_delta = abs(pv_output - self.last_pv_output) if self.last_pv_output is not None else 0
+        self.last_pv_output = pv_output
+
+        if charging_active or pv_delta >= self.cfg.POLL_PV_DELTA_FAST:
+            self.period = self.cfg.POLL_FAST
+        elif not plug_connected or pv_output <= 0:  # nothing to charge or night
+            self.period = self.cfg.POLL_SLOW
+        else:
+            self.period = self.cfg.CYCLE_TIME
+        return self.period
+
+    # the first cycle starts now
+    def start(self):
+        self.next_deadline = time.monotonic()
+
+    # returns the seconds until the next cycle has to start
+    def schedule_next(self, period: float) -> float:
+        self.cycles += 1
+        self.next_deadline += period
+        now = time.monotonic()
+        if now > self.next_deadline:
+            self.overruns += 1
+            self.overrun_time += now - self.next_deadline
+            logging.error('Cycle overrun by %.2f s', now - self.next_deadline)
+            self.next_deadline = now  # do not try to catch up, just start the next one right away
+        return self.next_deadline - now
+
+    # sleep until the next cycle. wake() ends the wait early
+    def wait(self, delay: float):
+        if self.wake_event.wait(delay):
+            self.next_deadline = time.monotonic()  # the period starts over from here
+        self.wake_event.clear()
+
+    def wake(self):
+        self.wake_event.set()
+
+    def get_stats(self) -> dict:
+        return {'cycles': self.cycles, 'overruns': self.overruns, 'overrun_time': self.overrun_time,
+                'period': self.period}
@@ -0,0 +1,80 @@
+from pv_database import PVDataSink
+import importlib
+import time
+
+# kind -> name in the config -> 'module:class'.
+# The module of a backend (and with it pymodbus, influxdb or RPi.GPIO) is only imported if the config selects it
+BACKENDS = {
+    'data_sink': {'influx': 'pv_database:PVDatabase',
+                  'sqlite': 'pv_sqlite_database:PVSQLiteDatabase',
+                  'none': 'pv_backends:NullSink',
+                  'uplink': 'pv_site:UplinkSink'},
+    'wallbox_bus': {'modbus_rtu': 'pv_modbus_wallbox:ModbusRTUHeidelbergWB'},
+    'solarlog_bus': {'modbus_tcp': 'pv_modbus_solarlog:ModbusTCPSolarLog'},
+    'switch_input': {'gpio': 'switch_position:GPIOSwitchInput',
+                     'file': 'switch_position:FileSwitchInput'},
+}
+
+
+# data sink that forgets everything. For test setups without a DB
+class NullSink(PVDataSink):
+    def __init__(self, cfg=None):
+        pass
+
+    def write_solarlog_data(self, solar_log_data):
+        pass
+
+    def write_wallbox_data(self, wallboxes):
+        pass
+
+    def write_rollups(self, rollups):
+        pass
+
+    def write_lines(self, lines):
+        return True
+
+    def close(self, timeout: float = None):
+        pass
+
+
+# Imports the backends on first use and keeps track of what that cost.
+# A backend class may have a static import_dependencies(): the libraries it needs are imported there, so they count
+# as import time of the backend and not of whatever creates it first
+class BackendRegistry:
+    def __init__(self, backends: dict = None):
+        self.backends = BACKENDS if backends is None else backends
+        self.loaded = {}  # (kind, name) -> class
+        self.timings = {}  # (kind, name) -> [import seconds, init seconds, instances]
+
+    def load(self, kind: str, name: str):
+        key = (kind, name)
+        if key in self.loaded:
+            return self.loaded[key]
+        path = self.backends.get(kind, {}).get(name)
+        if path is None:
+            raise ValueError('Unknown %s backend %s. Known: %s' % (kind, name, ', '.join(sorted(self.backends.get(kind, {})))))
+
+        module_name, class_name = path.split(':')
+        start = time.perf_counter()
+        backend_class = getattr(importlib.import_module(module_name), class_name)
+        if hasattr(backend_class, 'import_dependencies'):
+            backend_class.import_dependencies()
+        self.timings[key] = [time.perf_counter() - start, 0.0, 0]
+        self.loaded[key] = backend_class
+        return backend_class
+
+    def create(self, kind: str, name: str, *args, **kwargs):
+        backend_class = self.load(kind, name)
+        start = time.perf_counter()
+        backend = backend_class(*args, **kwargs)
+        timing = self.timings[(kind, name)]
+        timing[1] += time.perf_counter() - start
+        timing[2] += 1
+        return backend
+
+    # one line per backend, in the order they were loaded. Libraries shared by backends (pymodbus) count for the first
+    def report(self) -> str:
+        lines = ['%-14s %-12s %10s %10s %5s' % ('kind', 'backend', 'import ms', 'init ms', 'count')]
+        for (kind, name), (import_time, init_time, count) in self.timings.items():
+            lines.append('%-14s %-12s %10.1f %10.1f %5s' % (kind, name, import_time * 1000, init_time * 1000, count))
+        return '\n'.join(lines)
@@ -0,0 +1,370 @@
+from pv_modbus_solarlog import ModbusTCPConfig, SolarLogReadInputs, SolarLogData, SolarLogState
+from pv_modbus_wallbox import ModbusRTUConfig, MultiBusHeidelbergWB
+from pv_modbus_wallbox import HeidelbergWBReadInputs, HeidelbergWBReadHolding, HeidelbergWBWriteHolding
+from wallbox_system_state import WBSystemState
+from pv_backends import BackendRegistry
+from pv_rollup import RollupAggregator
+from wallbox_proxy import WallboxProxy
+from toolbox import Toolbox, TimeTools
+from config_file import ConfigFile, load_config
+from config_watcher import ConfigWatcher
+from poll_scheduler import AdaptivePollScheduler
+from pv_forecast import PVForecast
+from rolling_window import RollingWindow
+from switch_position import PV_Switch
+from cycle_metrics import CycleMetrics, MetricsServer
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List
+import copy
+import math
+import logging
+import time
+import datetime
+
+
+# everything one control cycle needs. The stages can be run one after the other (run) or overlapped (see AsyncPVController)
+class PVController:
+    def __init__(self, cfg: ConfigFile, config_path: str = None):
+        self.cfg = cfg
+        self.config_path = config_path  # where cfg came from. Watched for changes
+
+        # SolarLog, WBs, DB and switch are only imported if the config selects them
+        self.backends = BackendRegistry()
+
+        self.wb_prox = WallboxProxy(cfg)
+        self.time_tools = TimeTools()
+
+        self.already_used_charging_power_for_car = 0
+        self.last_register_verify = TimeTools()
+
+        # SolarLog
+        config_solar_log = ModbusTCPConfig(cfg.SOLARLOG_IP, cfg.SOLARLOG_PORT, slave_id=cfg.SOLARLOG_SLAVEID
+                                           , timeout=cfg.SOLARLOG_TIMEOUT, backoff_min=cfg.SOLARLOG_BACKOFF_MIN
+                                           , backoff_max=cfg.SOLARLOG_BACKOFF_MAX)
+        self.solarlog_connection = self.backends.create('solarlog_bus', cfg.SOLARLOG_TRANSPORT, config_solar_log
+                                                        , SolarLogReadInputs())
+
+        # RTU. One connection per bus, each call goes to the bus of its WB
+        self.wallbox = []
+        self.wallbox_groups: List[List[WBSystemState]] = []
+        self.wallbox_connection = MultiBusHeidelbergWB()
+        for group in cfg.get_wallbox_groups():
+            config_wb_heidelberg = ModbusRTUConfig(method='rtu', port=group.rtu_device, timeout=cfg.WB_TIMEOUT, baudrate=19200,
+                                                   bytesize=8,
+                                                   parity='E',
+                                                   stopbits=1,
+                                                   strict=False,
+                                                   timeout_min=cfg.WB_TIMEOUT_MIN,
+                                                   breaker_failures=cfg.WB_BREAKER_FAILURES,
+                                                   breaker_probe_every=cfg.WB_BREAKER_PROBE_EVERY)
+            self.wallbox_connection.add_bus(self.backends.create('wallbox_bus', cfg.WB_TRANSPORT
+                                                                 , wb_config=config_wb_heidelberg
+                                                                 , wb_read_input=HeidelbergWBReadInputs()
+                                                                 , wb_read_holding=HeidelbergWBReadHolding()
+                                                                 , wb_write_holding=HeidelbergWBWriteHolding())
+                                            , group.slave_ids)
+            wallboxes = [WBSystemState(slave_id) for slave_id in group.slave_ids]
+            self.wallbox_groups.append(wallboxes)
+            self.wallbox.extend(wallboxes)
+        self.wallbox.sort(key=lambda x: x.slave_id)  # make the Slave ID also the priority of the WB
+
+        # every bus gets polled by its own thread. More buses -> more WBs in the same time
+        self.group_executor = ThreadPoolExecutor(max_workers=len(self.wallbox_groups), thread_name_prefix='wb-group')
+
+        # init last charge
+        for wb in self.wallbox:
+            wb.last_charge_activation = datetime.datetime.now()
+            wb.last_charge_deactivation = datetime.datetime.now()
+
+        self.solar_log_data = SolarLogData()
+        self.pv_forecast = PVForecast(cfg) if cfg.PV_FORECAST else None
+
+        # what we measured over the last cycles
+        self.pv_output_history = RollingWindow(cfg.HISTORY_WINDOW)
+        self.consumption_history = RollingWindow(cfg.HISTORY_WINDOW)
+        self.charge_current_history = {wb.slave_id: RollingWindow(cfg.HISTORY_WINDOW) for wb in self.wallbox}
+        self.database = self.backends.create('data_sink', cfg.DATA_SINK, cfg)
+        self.rollup = RollupAggregator(cfg.ROLLUP_RESOLUTIONS) if cfg.ROLLUP_RESOLUTIONS else None
+        self.poll_scheduler = AdaptivePollScheduler(cfg)
+
+        # set up switch. A flip starts the next cycle right away
+        self.pv_switch = None
+        if cfg.HAVE_SWITCH:
+            self.pv_switch = PV_Switch(self.backends.create('switch_input', cfg.SWITCH_INPUT, cfg), cfg.SWITCH_DEBOUNCE
+                                       , on_change=self.on_switch_change)
+
+        self.metrics = CycleMetrics()
+        self.wallbox_connection.set_metrics(self.metrics)
+        self.metrics_server = None
+        if cfg.METRICS_PORT:
+            self.metrics_server = MetricsServer(self.metrics, cfg.METRICS_ADDRESS, cfg.METRICS_PORT)
+            self.metrics_server.start()
+
+        # a changed config file starts the next cycle, which takes over the new settings first
+        self.config_watcher = None
+        if config_path and cfg.CONFIG_RELOAD:
+            self.config_watcher = ConfigWatcher(config_path, on_change=self.poll_scheduler.wake)
+            self.config_watcher.start()
+
+        self.on_cycle_end = None  # called with the cycle time after every cycle. pv_supervisor reports it
+
+    # from the debounce timer of the switch
+    def on_switch_change(self, pv_only: bool):
+        self.poll_scheduler.wake()
+
+    # if we lose communication to the WB, assume we lose it to all; and split max current of 16A evenly
+    def write_failsafe_current(self):
+        failsafe_current = int(self.cfg.WB_SYSTEM_MAX_CURRENT / len(self.wallbox))
+        if failsafe_current < self.cfg.WB_MIN_CURRENT:  # WB takes 0 or at least the min current
+            failsafe_current = 0
+        for wb in self.wallbox:
+            self.wallbox_connection.set_failsafe_max_current(wb.slave_id, failsafe_current*10)
+
+    # make sure that failsafe Current is always set
+    def set_failsafe_current(self):
+        while True:
+            try:
+                if self.wallbox_connection.connect_wb_heidelberg():
+                    self.write_failsafe_current()
+                    break
+                else:
+                    logging.fatal('connect_wb_heidelberg failed. Trying again.')
+                    time.sleep(5)
+            except Exception as e:
+                logging.fatal(str(e))
+                logging.fatal('Connection error. Could not connect to WB. Trying again.')
+                time.sleep(5)
+
+    # Takes over the changed RELOADABLE settings of the config file. Runs between two cycles, the new config is
+    # swapped in as a whole. Connections, WB timers and failsafe currents (unless their settings changed) stay.
+    # Returns name -> (old, new) of the settings that were applied
+    def reload_config(self) -> dict:
+        try:
+            new_cfg = load_config(self.config_path)
+            new_cfg.get_wallbox_groups()  # checks the Slave IDs
+        except Exception as e:
+            logging.error('Config file %s not taken over, it has errors: %s', self.config_path, str(e))
+            return {}
+
+        changes = self.cfg.diff(new_cfg)
+        needs_restart = [name for name in changes if name not in ConfigFile.RELOADABLE]
+        if needs_restart:
+            logging.error('Changed settings that need a restart: %s', ', '.join(needs_restart))
+        applied = {name: change for name, change in changes.items() if name in ConfigFile.RELOADABLE}
+        if not applied:
+            return applied
+
+        cfg = copy.copy(self.cfg)
+        for name, (old, new) in applied.items():
+            setattr(cfg, name, new)
+            logging.warning('Config changed: %s %s -> %s', name, old, new)
+        self.cfg = self.wb_prox.cfg = self.poll_scheduler.cfg = cfg
+
+        if 'WB_SYSTEM_MAX_CURRENT' in applied or 'WB_MIN_CURRENT' in applied:
+            try:
+                self.write_failsafe_current()
+            except Exception as e:
+                logging.fatal('Failsafe current not written: %s', str(e))
+        return applied
+
+    def reload_config_if_changed(self):
+        if self.config_watcher is not None and self.config_watcher.pending():
+            self.reload_config()
+
+    # check all WB for charge plug and charge request
+    # check for standby activation (.. saves 4 Watt if no Car is plugged in)
+    def poll_wallbox_group(self, wallboxes: List[WBSystemState]):
+        # the reads of the whole group get queued at once. The bus answers them one by one
+        reads = [self.wallbox_connection.submit_telemetry(wb.slave_id) for wb in wallboxes]
+        for wb, read in zip(wallboxes, reads):
+            telemetry = read.result()
+            if telemetry is not False:
+                if not wb.available:
+                    logging.warning('WB %s answers again', wb.slave_id)
+                wb.update_from_telemetry(telemetry)
+            else:  # failed or skipped by the breaker. Left out of the allocation until it answers again
+                if wb.available:
+                    logging.error('WB %s not available. No current for it until it answers again', wb.slave_id)
+                wb.mark_unavailable()
+            #set_standby_if_required(wallbox_connection, wb)
+            self.wb_prox.deactivate_standby(self.wallbox_connection, wb)
+
+    def poll_wallboxes(self):
+        list(self.group_executor.map(self.poll_wallbox_group, self.wallbox_groups))  # list() raises what went wrong
+
+        # writes are skipped if we think the WB already has the value. Check once in a while that this is still true.
+        # Not waited for: the reads are diagnostics, so the writes of the allocation go out before them
+        if self.last_register_verify.seconds_have_passed_since_trigger() >= self.cfg.WB_REGISTER_VERIFY_EVERY:
+            for wb in self.wallbox:
+                self.wallbox_connection.submit_verify_holding_registers(wb.slave_id).add_done_callback(
+                    lambda verify, slave_id=wb.slave_id: self.register_verify_done(slave_id, verify))
+            self.last_register_verify.trigger_time()
+
+    # on the bus thread. A mismatch already made the shadow forget the registers, so the next writes go out
+    @staticmethod
+    def register_verify_done(slave_id: int, verify: Future):
+        if verify.exception() is not None:
+            logging.error('WB %s holding registers not verified: %s', slave_id, str(verify.exception()))
+        elif not verify.result():
+            logging.error('WB %s holding registers not as expected. Writing them again', slave_id)
+
+    # check at Wallboxes how much we currently use for charging
+    def poll_charging_power(self):
+        self.already_used_charging_power_for_car = 0
+        now = time.monotonic()
+        for wb in self.wallbox:
+            if self.wb_prox.is_plug_connected_and_charge_ready(wb):
+                wb.actual_current_active = Toolbox.watt_to_amp(wb.actual_charge_power)
+                self.already_used_charging_power_for_car += wb.actual_charge_power
+            self.charge_current_history[wb.slave_id].add(now, Toolbox.watt_to_amp(wb.actual_charge_power))
+        logging.warning('Currently used power for charging: %s W', self.already_used_charging_power_for_car)
+
+    # get data for logger
+    # Get the PV data (all in Watt)
+    def poll_solarlog(self):
+        result = self.solarlog_connection.get_snapshot()
+        if result:
+            self.solar_log_data = result
+            now = time.monotonic()
+            self.pv_output_history.add(now, result.actual_output)
+            self.consumption_history.add(now, result.actual_consumption)
+            if self.pv_forecast is not None:
+                self.pv_forecast.add(now, result)
+        else:  # costs one stale reading, the cycle goes on with the last data
+            self.metrics.count_modbus_error('solarlog', result.kind)
+            logging.error('No new data from Solar Log (%s). Using the last one', result.kind)
+        logging.warning('Actual AC Output (PV): %s W', self.solar_log_data.actual_output)
+        logging.warning('Actual AC consumption: %s W', self.solar_log_data.actual_consumption)
+
+    def allocate(self):
+        # ===================
+        # check Switch Position: Charge all or only PV
+        # ===================
+        if self.pv_switch is not None:
+            pv_charge_only = self.pv_switch.is_switch_set_to_pv_only()
+        else:
+            pv_charge_only = True
+
+        # For later: Would be cool to have it defined per Wallbox. e.g. one car can always charge fully,
+        # the other one only when sun shines
+
+        # ===================
+        # charge max (11 kW overall)
+        # ===================
+        if not pv_charge_only:
+            # ===================
+            # Charge only from grid (implicitly includes PV when available)
+            # ===================
+            logging.warning('== Grid-Charge only active ==')
+            self.wb_prox.activate_grid_charge(self.wallbox_connection, self.wallbox)
+        else:
+            # ===================
+            # Charge only via PV
+            # ===================
+            logging.warning('== PV-Charge only active ==')
+            self.wb_prox.allocate_pv(self.wallbox_connection, self.wallbox, self.solar_log_data
+                                     , self.already_used_charging_power_for_car, self.pv_forecast)
+
+    # write PV into DB
+    # while charging, write any changed log. Otherwise only after x min
+    def write_database(self):
+        logging.info('DB write section')
+
+        # every cycle goes into the rollups, the DB only gets the finished intervals
+        if self.rollup is not None:
+            now = time.time()
+            self.rollup.add_solarlog(now, self.solar_log_data)
+            self.rollup.add_wallbox(now, self.wallbox)
+            rollups = self.rollup.collect(now)
+            if rollups:
+                self.database.write_rollups(rollups)
+            return
+
+        # use faster write cycle while charging is active
+        if self.wb_prox.is_charging_active(self.wallbox):
+            if self.time_tools.seconds_have_passed_since_trigger() >= 60:
+                self.database.write_solarlog_data_only_if_changed(self.solar_log_data)
+                self.database.write_wallbox_data_only_if_changed(self.wallbox)
+                self.time_tools.trigger_time()  # written
+        else:
+            # save every x seconds
+            if self.time_tools.seconds_have_passed_since_trigger() >= self.cfg.SOLARLOG_WRITE_EVERY:
+                self.database.write_solarlog_data_only_if_changed(self.solar_log_data)
+                self.database.write_wallbox_data(self.wallbox)
+                self.time_tools.trigger_time()  # written
+
+    # at shutdown. The rollups of the intervals that are not over yet get written too, then whatever is queued
+    def close(self, timeout: float = None):
+        if self.rollup is not None:
+            rollups = self.rollup.collect(math.inf)  # every open interval counts as over
+            if rollups:
+                self.database.write_rollups(rollups)
+        self.database.close(timeout)
+
+    # the time fn takes goes into the metrics of the stage
+    def run_stage(self, name: str, fn):
+        with self.metrics.stage(name):
+            return fn()
+
+    def end_cycle(self, cycle_time: float):
+        self.metrics.end_cycle(cycle_time)
+        stats = self.poll_scheduler.get_stats()
+        self.metrics.set_counter('pv_cycle_overruns_total', stats['overruns'])
+        self.metrics.set_gauge('pv_cycle_period_seconds', stats['period'])
+        for port, bus_stats in self.wallbox_connection.get_bus_stats().items():
+            self.metrics.set_gauge('pv_rtu_bus_queue_depth', bus_stats['queue_depth'], bus=port)
+        for slave_id, health in self.wallbox_connection.get_slave_health().items():
+            self.metrics.set_gauge('pv_wallbox_breaker_open', int(health['state'] != 'closed'), slave=slave_id)
+            self.metrics.set_gauge('pv_wallbox_timeout_seconds', health['timeout'], slave=slave_id)
+        self.metrics.set_gauge('pv_solarlog_connected'
+                               , int(self.solarlog_connection.state == SolarLogState.CONNECTED))
+        self.metrics.set_gauge('pv_solarlog_failures_in_a_row', self.solarlog_connection.failures)
+        for name, history in (('pv_output_watts', self.pv_output_history)
+                              , ('pv_consumption_watts', self.consumption_history)):
+            for stat in ('mean', 'min', 'max'):
+                self.metrics.set_gauge(name, getattr(history, stat)(), stat=stat)
+            self.metrics.set_gauge(name.replace('_watts', '_slope_watts_per_second'), history.slope())
+        for slave_id, history in self.charge_current_history.items():
+            self.metrics.set_gauge('pv_wallbox_charge_current_amps', history.mean(), slave=slave_id, stat='mean')
+        if self.on_cycle_end is not None:
+            self.on_cycle_end(cycle_time)
+
+    def run_cycle(self):
+        logging.info(' ')
+        logging.info('Next Calculation cycle starts')
+        logging.debug('%s', datetime.datetime.now())
+        cycle_start = time.perf_counter()
+
+        try:
+            self.run_stage('wallbox_poll', self.poll_wallboxes)
+            self.run_stage('solarlog_read', self.poll_solarlog)
+            self.run_stage('charge_power_poll', self.poll_charging_power)
+            self.run_stage('allocation', self.allocate)  # includes the Modbus writes, also counted as 'modbus_writes'
+
+            logging.debug('Calculation cycle ends')
+            logging.debug('')
+        except Exception as e:
+            logging.fatal(str(e))
+            logging.fatal('Unknown error occured with communication to WB. Trying again after some seconds.')
+
+        self.run_stage('db_write', self.write_database)
+        self.end_cycle(time.perf_counter() - cycle_start)
+
+    # seconds until the next cycle should start, based on what we saw in this one
+    def schedule_next_cycle(self) -> float:
+        plug_connected = any(self.wb_prox.is_plug_connected_and_charge_ready(wb) for wb in self.wallbox)
+        period = self.poll_scheduler.choose_period(self.wb_prox.is_charging_active(self.wallbox), plug_connected
+                                                   , self.solar_log_data.actual_output)
+        return self.poll_scheduler.schedule_next(period)
+
+    def run(self):
+        self.set_failsafe_current()
+        self.poll_scheduler.start()
+
+        # cowboy lucky (main) loop/luke
+        while True:
+            self.reload_config_if_changed()
+            self.run_cycle()
+
+            # chill for some secs
+            self.poll_scheduler.wait(self.schedule_next_cycle())
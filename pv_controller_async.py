@@ -0,0 +1,64 @@
+from pv_controller import PVController
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import datetime
+import logging
+import time
+
+
+# Runs the stages of PVController as asyncio tasks. SolarLog (TCP) and the wallboxes (RS485) are different links, so
+# both get polled at the same time. Allocation starts once both are done and works on data of this very cycle.
+# Each link has its own single thread, so there is never more than one transaction on a link at a time.
+class AsyncPVController:
+    def __init__(self, controller: PVController):
+        self.controller = controller
+        self.solarlog_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='solarlog')
+        self.rtu_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rtu-bus')
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+        self.db_task = None
+
+    async def run_cycle(self):
+        loop = asyncio.get_running_loop()
+        logging.info(' ')
+        logging.info('Next Calculation cycle starts')
+        logging.debug('%s', datetime.datetime.now())
+        cycle_start = time.perf_counter()
+
+        # the DB still works on the last cycle. It must not see half updated data
+        if self.db_task is not None:
+            try:
+                await self.db_task
+            except Exception as e:
+                logging.fatal('DB write section failed: %s', str(e))
+
+        try:
+            controller = self.controller
+            await asyncio.gather(loop.run_in_executor(self.solarlog_executor, controller.run_stage, 'solarlog_read'
+                                                      , controller.poll_solarlog)
+                                 , loop.run_in_executor(self.rtu_executor, controller.run_stage, 'wallbox_poll'
+                                                        , controller.poll_wallboxes))
+            controller.run_stage('charge_power_poll', controller.poll_charging_power)
+            await loop.run_in_executor(self.rtu_executor, controller.run_stage, 'allocation', controller.allocate)
+
+            logging.debug('Calculation cycle ends')
+            logging.debug('')
+        except Exception as e:
+            logging.fatal(str(e))
+            logging.fatal('Unknown error occured with communication to WB. Trying again after some seconds.')
+
+        # runs while we wait for the next cycle. Its time shows up in the metrics of the next cycle
+        self.controller.end_cycle(time.perf_counter() - cycle_start)
+        self.db_task = loop.run_in_executor(self.db_executor, self.controller.run_stage, 'db_write'
+                                            , self.controller.write_database)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.rtu_executor, self.controller.set_failsafe_current)
+        self.controller.poll_scheduler.start()
+
+        while True:
+            self.controller.reload_config_if_changed()
+            await self.run_cycle()
+
+            # chill for some secs
+            await loop.run_in_executor(None, self.controller.poll_scheduler.wait, self.controller.schedule_next_cycle())
@@ -1,48 +1,46 @@
-from influxdb import InfluxDBClient
 from pv_modbus_solarlog import SolarLogData
 from wallbox_system_state import WBSystemState
 from config_file import ConfigFile
+from pv_spool import PVSpool
+from pv_rollup import Rollup
+import abc
 import logging
-import copy
 import datetime
+import queue
+import threading
+import time
 from typing import List
 
+InfluxDBClient = None  # influxdb gets imported with the first PVDatabase, not with this module
 
-class PVDatabase:
-    solarlog_data: SolarLogData = None
+
+# what every data sink shares: unchanged data is not written again. Sinks implement the write_* methods and close
+class PVDataSink(abc.ABC):
+    solarlog_snapshot: tuple = None  # SolarLogData.snapshot() of the last write
     solarlog_lastwrite = None
-    wallbox_data: List[WBSystemState] = None
+    wallbox_snapshot: tuple = None  # WBSystemState.snapshot() of every WB of the last write
     wallbox_lastwrite = None
 
-    def __init__(self, cfg: ConfigFile):
-        self.cfg = cfg
-        self.solarlog_lastwrite = datetime.datetime.now()
-        self.wallbox_lastwrite = datetime.datetime.now()
-
+    @abc.abstractmethod
     def write_solarlog_data(self, solar_log_data: SolarLogData):
-        self.solarlog_data = copy.deepcopy(solar_log_data)
-        self.solarlog_lastwrite = datetime.datetime.now()
+        pass
 
-        try:
-            # Influx
-            influx = InfluxDBClient(host=self.cfg.INFLUX_HOST
-                                    , port=self.cfg.INFLUX_PORT
-                                    , username=self.cfg.INFLUX_USER
-                                    , password=self.cfg.INFLUX_PWD)
+    @abc.abstractmethod
+    def write_wallbox_data(self, wallboxes: List[WBSystemState]):
+        pass
 
-            line_solar = 'solarlog,sensor=solarlog1 pv_output=' + str(solar_log_data.actual_output) \
-                         + ',consumption=' + str(solar_log_data.actual_consumption)
+    @abc.abstractmethod
+    def write_rollups(self, rollups: List[Rollup]):
+        pass
 
-            if not influx.write([line_solar], params={'epoch': 's', 'db': self.cfg.INFLUX_DB_NAME}, expected_response_code=204, protocol='line'):
-                logging.error('SolarLog Data write failed')
-
-            influx.close()
-        except:
-            logging.fatal('DB Connection is gone')
+    # flush what is queued and stop writing
+    @abc.abstractmethod
+    def close(self, timeout: float = None):
+        pass
 
     def write_solarlog_data_only_if_changed(self, solar_log_data: SolarLogData):
-        if self.solarlog_data is not None:
-            if self.solarlog_data != solar_log_data:
+        if self.solarlog_snapshot is not None:
+            if self.solarlog_snapshot != solar_log_data.snapshot():
                 self.write_solarlog_data(solar_log_data)
                 logging.info('Solarlog Data written to DB')
             else:
@@ -50,47 +48,179 @@ class PVDatabase:
         else:
             self.write_solarlog_data(solar_log_data)  # first time writing. cant compare and just write
 
-    def write_wallbox_data(self, wallboxes: List[WBSystemState]):
-        self.wallbox_data = copy.deepcopy(wallboxes)
+    def write_wallbox_data_only_if_changed(self, wallboxes: List[WBSystemState]):
+        # None on the first write. Cant compare and just write
+        if self.wallbox_snapshot != tuple(wb.snapshot() for wb in wallboxes):
+            self.write_wallbox_data(wallboxes)
+            logging.info('Wallbox Data written to DB')
+        else:
+            logging.debug('Wallbox Data not changed. Not written to DB')
+
+
+class PVDatabase(PVDataSink):
+    @staticmethod
+    def import_dependencies():
+        global InfluxDBClient
+        if InfluxDBClient is None:
+            from influxdb import InfluxDBClient
+
+    def __init__(self, cfg: ConfigFile):
+        self.import_dependencies()
+        self.cfg = cfg
+        self.solarlog_lastwrite = datetime.datetime.now()
         self.wallbox_lastwrite = datetime.datetime.now()
 
+        # one long living client. Only the writer thread talks to it, so the main loop never waits for the DB
+        self.influx = InfluxDBClient(host=self.cfg.INFLUX_HOST
+                                     , port=self.cfg.INFLUX_PORT
+                                     , username=self.cfg.INFLUX_USER
+                                     , password=self.cfg.INFLUX_PWD
+                                     , timeout=self.cfg.INFLUX_TIMEOUT)
+
+        # bounded, so a stalled DB can not eat up our memory
+        self.write_queue = queue.Queue(maxsize=self.cfg.INFLUX_QUEUE_SIZE)
+
+        # keeps everything that could not be written, until the DB is back
+        self.spool = None
+        if self.cfg.SPOOL_DIR:
+            self.spool = PVSpool(self.cfg.SPOOL_DIR, self.cfg.SPOOL_SEGMENT_SIZE, self.cfg.SPOOL_MAX_SIZE)
+
+        self.writer_thread = threading.Thread(target=self._writer_loop, name='influx-writer', daemon=True)
+        self.writer_thread.start()
+
+    @staticmethod
+    def format_solarlog_line(solar_log_data: SolarLogData, timestamp: int) -> str:
+        return 'solarlog,sensor=solarlog1 pv_output=' + str(solar_log_data.actual_output) \
+               + ',consumption=' + str(solar_log_data.actual_consumption) \
+               + ' ' + str(timestamp)
+
+    @staticmethod
+    def format_wallbox_line(wb: WBSystemState, timestamp: int) -> str:
+        return 'wallbox,sensor=wallbox' + str(wb.slave_id) \
+               + ' charge_state=' + str(wb.charge_state) \
+               + ',pv_charge_active=' + str(wb.pv_charge_active) \
+               + ',grid_charge_active=' + str(wb.grid_charge_active) \
+               + ',max_current_active=' + str(wb.max_current_active) \
+               + ',actual_current_active=' + str(wb.actual_current_active) \
+               + ' ' + str(timestamp)
+
+    # e.g. solarlog_10s,sensor=solarlog1 pv_output_min=..,pv_output_max=..,pv_output_mean=..,pv_output_last=.. <start>
+    @staticmethod
+    def format_rollup_line(rollup: Rollup) -> str:
+        return rollup.measurement + '_' + str(rollup.resolution) + 's,sensor=' + rollup.sensor + ' ' \
+               + ','.join(name + '_min=' + str(minimum) + ',' + name + '_max=' + str(maximum)
+                          + ',' + name + '_mean=' + str(mean) + ',' + name + '_last=' + str(last)
+                          for name, (minimum, maximum, mean, last) in rollup.fields.items()) \
+               + ',samples=' + str(rollup.count) + ' ' + str(rollup.start)
+
+    # hand the lines over to the writer thread. Returns False if the queue is full and the lines were dropped
+    def _enqueue(self, lines: List[str]) -> bool:
+        try:
+            self.write_queue.put_nowait(lines)
+            return True
+        except queue.Full:
+            if self.spool is not None:
+                logging.error('DB write queue is full. Spooling %s lines', len(lines))
+                self.spool.append(lines)
+                return True
+            logging.error('DB write queue is full. Dropping %s lines', len(lines))
+            return False
+
+    def _send(self, lines: List[str]) -> bool:
         try:
-            # Influx
-            influx = InfluxDBClient(host=self.cfg.INFLUX_HOST
-                                    , port=self.cfg.INFLUX_PORT
-                                    , username=self.cfg.INFLUX_USER
-                                    , password=self.cfg.INFLUX_PWD)
-            for wb in wallboxes:
-                line_wallbox = 'wallbox,sensor=wallbox' + str(wb.slave_id)\
-                               + ' charge_state=' + str(wb.charge_state) \
-                               + ',pv_charge_active=' + str(wb.pv_charge_active) \
-                               + ',grid_charge_active=' + str(wb.grid_charge_active) \
-                               + ',max_current_active=' + str(wb.max_current_active) \
-                               + ',actual_current_active=' + str(wb.actual_current_active)
-
-                if not influx.write([line_wallbox], params={'epoch': 's', 'db': self.cfg.INFLUX_DB_NAME}, expected_response_code=204, protocol='line'):
-                    logging.error('Wallbox Data write failed')
-
-            influx.close()
-        except:
+            if not self.influx.write(lines, params={'db': self.cfg.INFLUX_DB_NAME, 'precision': 's'}
+                                     , expected_response_code=204, protocol='line'):
+                logging.error('Data write failed')
+                return False
+            return True
+        except Exception:
             logging.fatal('DB Connection is gone')
+            return False
 
-    def write_wallbox_data_only_if_changed(self, wallboxes: List[WBSystemState]):
-        data_changed = False
-        ctr = 0
-        if self.wallbox_data is not None:
-            for wb in wallboxes:
-                if self.wallbox_data[ctr] != wb:
-                    data_changed = True
-                    break
-                ctr += 1
-        else:
-            data_changed = True  # first time writing. cant compare and just write
+    # nothing must get lost: either it is in the DB, in the spool or the change detection writes it again
+    def _ship(self, lines: List[str]) -> bool:
+        if self._send(lines):
+            return True
 
-        if data_changed:
-            self.write_wallbox_data(wallboxes)
-            logging.info('Wallbox Data written to DB')
+        if self.spool is not None:
+            self.spool.append(lines)
+            logging.warning('%s lines spooled. Spool size: %s bytes', len(lines), self.spool.size())
         else:
-            logging.debug('Wallbox Data not changed. Not written to DB')
+            self.solarlog_snapshot = None
+            self.wallbox_snapshot = None
+        return False
+
+    # write the oldest spooled segment. Returns True if the DB took all of it
+    def _replay_spool(self) -> bool:
+        segment, lines = self.spool.read_oldest()
+        for start in range(0, len(lines), self.cfg.SPOOL_REPLAY_BATCH):
+            if not self._send(lines[start:start + self.cfg.SPOOL_REPLAY_BATCH]):
+                return False  # try again later. Whatever made it already will just be overwritten
+        self.spool.remove(segment)
+        logging.warning('Spool segment %s replayed (%s lines)', segment, len(lines))
+        return True
+
+    # collects everything that was queued within one cycle and writes it with a single request
+    def _writer_loop(self):
+        running = True
+        while running:
+            try:
+                # while there is something spooled, wake up regularly to check if the DB is back
+                spooled = self.spool is not None and not self.spool.is_empty()
+                lines = self.write_queue.get(timeout=self.cfg.SPOOL_REPLAY_EVERY if spooled else None)
+            except queue.Empty:
+                self._replay_spool()
+                continue
+            if lines is None:  # stop requested and nothing left
+                break
+
+            time.sleep(self.cfg.INFLUX_BATCH_DELAY)  # give the rest of this cycle a chance to arrive
+            batch = list(lines)
+            while True:
+                try:
+                    lines = self.write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if lines is None:
+                    running = False
+                    break
+                batch.extend(lines)
 
+            shipped = self._ship(batch)
+            logging.debug('%s lines shipped to DB', len(batch))
 
+            # DB is (back) up, so catch up with the spool
+            if shipped and running and self.spool is not None and not self.spool.is_empty():
+                self._replay_spool()
+
+    # flush what is queued and stop the writer thread
+    def close(self, timeout: float = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            self.write_queue.put(None, timeout=timeout)  # a stuck writer leaves the queue full
+        except queue.Full:
+            logging.error('DB write queue is still full. %s writes are not shipped', self.write_queue.qsize())
+        self.writer_thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        self.influx.close()
+        if self.spool is not None:
+            self.spool.close()
+
+    def write_solarlog_data(self, solar_log_data: SolarLogData):
+        line_solar = self.format_solarlog_line(solar_log_data, int(time.time()))
+        if self._enqueue([line_solar]):
+            self.solarlog_snapshot = solar_log_data.snapshot()
+            self.solarlog_lastwrite = datetime.datetime.now()
+
+    def write_wallbox_data(self, wallboxes: List[WBSystemState]):
+        timestamp = int(time.time())
+        lines_wallbox = [self.format_wallbox_line(wb, timestamp) for wb in wallboxes]
+        if self._enqueue(lines_wallbox):
+            self.wallbox_snapshot = tuple(wb.snapshot() for wb in wallboxes)
+            self.wallbox_lastwrite = datetime.datetime.now()
+
+    def write_rollups(self, rollups: List[Rollup]):
+        self._enqueue([self.format_rollup_line(rollup) for rollup in rollups])
+
+    # lines formatted somewhere else, e.g. by the sites of pv_supervisor
+    def write_lines(self, lines: List[str]) -> bool:
+        return self._enqueue(lines)
@@ -0,0 +1,48 @@
+from pv_modbus_solarlog import SolarLogData
+from config_file import ConfigFile
+from rolling_window import RollingWindow
+
+
+# Where the PV output will be in a few minutes: smoothed level plus the trend of the last samples.
+# Charge decisions based on this react earlier to clouds and clearing skies than a frozen value.
+# A handful of samples per cycle, cheap enough for a Pi.
+class PVForecast:
+    def __init__(self, cfg: ConfigFile):
+        self.horizon = cfg.PV_FORECAST_HORIZON
+        self.smoothing = cfg.PV_FORECAST_SMOOTHING
+        self.samples = RollingWindow(cfg.PV_FORECAST_WINDOW)  # (seconds, pv_output)
+        self.level = None
+        self.last_update_time = 0
+
+    # timestamp in seconds, any monotonic clock. Samples the SolarLog did not update in between are skipped
+    def add(self, timestamp: float, solar_log_data: SolarLogData):
+        if solar_log_data.last_update_time and solar_log_data.last_update_time == self.last_update_time:
+            return
+        self.last_update_time = solar_log_data.last_update_time
+
+        pv_output = solar_log_data.actual_output
+        if self.level is None:
+            self.level = float(pv_output)
+        else:
+            self.level += self.smoothing * (pv_output - self.level)
+        self.samples.add(timestamp, pv_output)
+
+    # W per second. Least squares over the samples in the window
+    def trend(self) -> float:
+        return self.samples.slope()
+
+    def predict(self, horizon: float = None) -> int:
+        if self.level is None:
+            return 0
+        if horizon is None:
+            horizon = self.horizon
+        return max(0, int(self.level + self.trend() * horizon))
+
+    # same data, but with the predicted PV output. Goes into Toolbox.calc_available_power
+    def forecast_data(self, solar_log_data: SolarLogData) -> SolarLogData:
+        forecast = SolarLogData()
+        forecast.last_update_time = solar_log_data.last_update_time
+        forecast.actual_output = self.predict()
+        forecast.actual_output_dc = solar_log_data.actual_output_dc
+        forecast.actual_consumption = solar_log_data.actual_consumption
+        return forecast
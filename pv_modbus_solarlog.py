@@ -1,52 +1,171 @@
-from pymodbus.client.sync import ModbusTcpClient
-from pv_register_config import SolarLogReadInputs
+from pv_register_config import SolarLogReadInputs, ModbusRegisters
 
 import logging
+import random
+import socket
+import time
+
+# pymodbus gets imported with the first ModbusTCPSolarLog, not with this module
+ModbusTcpClient = None
+ModbusIOException = None
 
 
 class ModbusTCPConfig:
-    def __init__(self, ip: str, port: int, slave_id):
+    def __init__(self, ip: str, port: int, slave_id, timeout: float = 3, backoff_min: float = 1
+                 , backoff_max: float = 60):
         self.IP = ip
         self.Port = port
         self.slave_id = slave_id
+        self.timeout = timeout  # seconds per request
+        self.backoff_min = backoff_min  # seconds before the first reconnect. Doubles with every failed one
+        self.backoff_max = backoff_max
+
+
+class SolarLogState:
+    CONNECTED = 0
+    DISCONNECTED = 1  # not connected yet or the connection failed. Reconnect after the backoff
+
+    NAMES = {CONNECTED: 'connected', DISCONNECTED: 'disconnected'}
+
 
+# what went wrong with a read. Falsy, so `if not result` works like it did with False
+class SolarLogError:
+    BACKOFF = 'backoff'  # not tried, we wait before the next reconnect
+    CONNECTION = 'connection'  # connect failed or the socket broke
+    TIMEOUT = 'timeout'  # no answer
+    EXCEPTION_RESPONSE = 'exception_response'  # the SolarLog answered, but with an error
 
+    def __init__(self, kind: str, message: str = ''):
+        self.kind = kind
+        self.message = message
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return 'SolarLogError(%s, %s)' % (self.kind, self.message)
+
+
+# One persistent TCP connection. Errors close it, the next read after the backoff (exponential, with jitter)
+# connects again. Reads never raise: they return the data or a SolarLogError
 class ModbusTCPSolarLog:
+    @staticmethod
+    def import_dependencies():
+        global ModbusTcpClient, ModbusIOException
+        # each on its own: tests patch the client before the first instance
+        if ModbusTcpClient is None:
+            from pymodbus.client.sync import ModbusTcpClient
+        if ModbusIOException is None:
+            from pymodbus.exceptions import ModbusIOException
+
     def __init__(self, solar_log_cfg: ModbusTCPConfig, solar_log_register: SolarLogReadInputs):
+        self.import_dependencies()
         self.solar_log_cfg = solar_log_cfg
         self.solar_log_register = solar_log_register
-        self.solar_log_handle = ModbusTcpClient(solar_log_cfg.IP, solar_log_cfg.Port, auto_open=True)
+        self.solar_log_handle = ModbusTcpClient(solar_log_cfg.IP, solar_log_cfg.Port, timeout=solar_log_cfg.timeout)
 
-    def connect_solar_log(self):
+        self.state = SolarLogState.DISCONNECTED
+        self.failures = 0  # in a row
+        self.next_attempt = 0.0  # monotonic time of the next reconnect
+
+    def connect_solar_log(self) -> bool:
         if not self.solar_log_handle.connect():
             logging.fatal('No Connection possible to Solar Log')
+            self._failed()
+            return False
+        # let the OS notice a dead SolarLog (e.g. power cut) on a connection that is idle between the cycles
+        if self.solar_log_handle.socket is not None:
+            self.solar_log_handle.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.state = SolarLogState.CONNECTED
+        return True
+
+    def close_solar_log(self):
+        self.solar_log_handle.close()
+        self.state = SolarLogState.DISCONNECTED
+
+    def _failed(self):
+        self.solar_log_handle.close()
+        self.state = SolarLogState.DISCONNECTED
+        self.failures += 1
+        backoff = min(self.solar_log_cfg.backoff_max, self.solar_log_cfg.backoff_min * 2 ** (self.failures - 1))
+        backoff *= random.uniform(0.5, 1.0)  # several controllers restarting at once do not all hit it together
+        self.next_attempt = time.monotonic() + backoff
+        logging.error('Solar Log connection lost (%s failures in a row). Next try in %.1f s', self.failures, backoff)
+
+    def _read(self, register_set: ModbusRegisters):
+        if self.state != SolarLogState.CONNECTED:
+            if time.monotonic() < self.next_attempt:
+                return SolarLogError(SolarLogError.BACKOFF)
+            if not self.connect_solar_log():
+                return SolarLogError(SolarLogError.CONNECTION, 'connect failed')
+
+        try:
+            read = self.solar_log_handle.read_input_registers(register_set.register
+                                                              , register_set.length
+                                                              , unit=self.solar_log_cfg.slave_id)
+        except Exception as e:
+            self._failed()
+            return SolarLogError(SolarLogError.CONNECTION, str(e))
+        if isinstance(read, ModbusIOException):
+            self._failed()
+            return SolarLogError(SolarLogError.TIMEOUT, str(read))
+        if read.isError():  # the connection itself is fine
+            logging.fatal('Could not read Registers %s to %s from Solar Log', register_set.register
+                          , register_set.register + register_set.length - 1)
+            return SolarLogError(SolarLogError.EXCEPTION_RESPONSE, str(read))
+
+        self.failures = 0
+        return read
+
+    # 32 bit values come low word first. Offset is relative to the first register that was read
+    @staticmethod
+    def _decode_uint32(registers, block: ModbusRegisters, register_set: ModbusRegisters) -> int:
+        offset = register_set.register - block.register
+        return (registers[offset + 1] << 16) + registers[offset]
 
     def get_actual_output_sync_ac(self):
-        # connect to SolarLog
-        read = self.solar_log_handle.read_input_registers(self.solar_log_register.P_AC.register
-                                                          , self.solar_log_register.P_AC.length
-                                                          , unit=self.solar_log_cfg.slave_id)
-        val = (read.registers[1] << 16) + read.registers[0]
-        return val  # in Watt
+        read = self._read(self.solar_log_register.P_AC)
+        if not read:
+            return read
+        return self._decode_uint32(read.registers, self.solar_log_register.P_AC, self.solar_log_register.P_AC)  # in Watt
 
     def get_actual_consumption_sync_ac(self):
-        # connect to SolarLog
-        read = self.solar_log_handle.read_input_registers(self.solar_log_register.P_AC_Consumption.register
-                                                          , self.solar_log_register.P_AC_Consumption.length
-                                                          , unit=self.solar_log_cfg.slave_id)
-        val = (read.registers[1] << 16) + read.registers[0]
-        return val  # in Watt
+        read = self._read(self.solar_log_register.P_AC_Consumption)
+        if not read:
+            return read
+        return self._decode_uint32(read.registers, self.solar_log_register.P_AC_Consumption
+                                   , self.solar_log_register.P_AC_Consumption)  # in Watt
+
+    # read all values with one request, so they are from the same SolarLog update
+    def get_snapshot(self):
+        block = self.solar_log_register.snapshot
+        read = self._read(block)
+        if not read:
+            return read
+
+        data = SolarLogData()
+        data.last_update_time = self._decode_uint32(read.registers, block, self.solar_log_register.lastUpdateTime)
+        data.actual_output = self._decode_uint32(read.registers, block, self.solar_log_register.P_AC)  # in Watt
+        data.actual_output_dc = self._decode_uint32(read.registers, block, self.solar_log_register.P_DC)  # in Watt
+        data.actual_consumption = self._decode_uint32(read.registers, block, self.solar_log_register.P_AC_Consumption)
+        return data
 
 
 class SolarLogData:
-    actual_output = 0
-    actual_consumption = 0
+    __slots__ = ('last_update_time', 'actual_output', 'actual_output_dc', 'actual_consumption')
 
     def __init__(self):
-        pass
+        self.last_update_time = 0  # unixtime of the SolarLog update
+        self.actual_output = 0
+        self.actual_output_dc = 0
+        self.actual_consumption = 0
+
+    # immutable copy of what gets saved to the DB
+    def snapshot(self) -> tuple:
+        return self.actual_output, self.actual_consumption
 
     def __eq__(self, other):
         if not isinstance(other, SolarLogData):
             return NotImplemented
 
-        return self.actual_output == other.actual_output and self.actual_consumption == other.actual_consumption
+        return self.snapshot() == other.snapshot()
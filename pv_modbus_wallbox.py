@@ -1,9 +1,16 @@
-from pymodbus.client.sync import ModbusSerialClient
 from pv_register_config import ModbusRegisters
 from pv_register_config import HeidelbergWBReadInputs
 from pv_register_config import HeidelbergWBReadHolding, HeidelbergWBWriteHolding
+from rtu_bus_scheduler import RTUBusScheduler, BusPriority, TransactionExpired, chain, gather
+from slave_health import SlaveHealth, BreakerState
 
+from concurrent.futures import Future
 import logging
+import time
+
+# pymodbus gets imported with the first ModbusRTUHeidelbergWB, not with this module
+ModbusSerialClient = None
+ModbusIOException = None
 
 
 class WBDef:
@@ -20,11 +27,42 @@ class WBDef:
     FAKE_WB_CONNECTION = False
 
 
+# decoded values of one bulk read of the input registers
+class HeidelbergWBTelemetry:
+    def __init__(self, registers, block: ModbusRegisters, wb_read_input: HeidelbergWBReadInputs):
+        def reg(register_set: ModbusRegisters):
+            return registers[register_set.register - block.register]
+
+        def reg32(register_set: ModbusRegisters):  # high word first
+            return (reg(register_set) << 16) + registers[register_set.register - block.register + 1]
+
+        self.layout_version = reg(wb_read_input.layoutVersion)
+        self.charge_state = reg(wb_read_input.chargingState)
+        self.current_l1 = reg(wb_read_input.currentL1) / 10  # A
+        self.current_l2 = reg(wb_read_input.currentL2) / 10
+        self.current_l3 = reg(wb_read_input.currentL3) / 10
+        self.pcb_temperature = reg(wb_read_input.PCB_Temperature)
+        if self.pcb_temperature >= 0x8000:  # int16
+            self.pcb_temperature -= 0x10000
+        self.pcb_temperature /= 10  # °C
+        self.voltage_l1 = reg(wb_read_input.voltageL1)  # V
+        self.voltage_l2 = reg(wb_read_input.voltageL2)
+        self.voltage_l3 = reg(wb_read_input.voltageL3)
+        self.extern_lock_state = reg(wb_read_input.externLockState)
+        self.actual_charge_power = reg(wb_read_input.actualChargePower)  # W
+        self.energy_since_power_on = reg32(wb_read_input.energySincePowerOn)  # VAh
+        self.energy_since_installation = reg32(wb_read_input.energySinceInstallation)  # VAh
+
+
 class ModbusRTUConfig:
-    def __init__(self, method: str, port: str, timeout: int, baudrate: int, bytesize: int, parity: str, stopbits: int, strict: bool):
+    def __init__(self, method: str, port: str, timeout: int, baudrate: int, bytesize: int, parity: str, stopbits: int, strict: bool
+                 , timeout_min: float = 0.2, breaker_failures: int = 3, breaker_probe_every: float = 60):
         self.method = method
         self.port = port
-        self.timeout = timeout
+        self.timeout = timeout  # seconds. Max. per transaction, the actual one adapts to each slave
+        self.timeout_min = timeout_min
+        self.breaker_failures = breaker_failures  # failures in a row until a slave gets skipped
+        self.breaker_probe_every = breaker_probe_every  # seconds between two tries of a skipped slave
         self.baudrate = baudrate
         self.bytesize = bytesize
         self.parity = parity
@@ -33,10 +71,20 @@ class ModbusRTUConfig:
 
 
 class ModbusRTUHeidelbergWB:
+    @staticmethod
+    def import_dependencies():
+        global ModbusSerialClient, ModbusIOException
+        # each on its own: tests patch the client before the first instance
+        if ModbusSerialClient is None:
+            from pymodbus.client.sync import ModbusSerialClient
+        if ModbusIOException is None:
+            from pymodbus.exceptions import ModbusIOException
+
     def __init__(self, wb_config: ModbusRTUConfig
                  , wb_read_input: HeidelbergWBReadInputs
                  , wb_read_holding: HeidelbergWBReadHolding
                  , wb_write_holding: HeidelbergWBWriteHolding):
+        self.import_dependencies()
         self.wb_config = wb_config
         self.wb_read_input = wb_read_input
         self.wb_read_holding = wb_read_holding
@@ -51,29 +99,189 @@ class ModbusRTUHeidelbergWB:
                                             , strict=wb_config.strict)
         self.wb_handle.inter_char_timeout = 0.05  # https://github.com/riptideio/pymodbus/issues/353
 
+        # all transactions on the serial port go through the scheduler, so urgent ones do not wait behind reads
+        self.bus_scheduler = RTUBusScheduler('rtu-bus ' + str(wb_config.port))
+
+        # what we believe is in the holding registers of each WB: slave_id -> {register: values}
+        # writes that would not change anything are skipped
+        self.holding_shadow = {}
+
+        self.metrics = None  # CycleMetrics. Counts failed transactions per slave and the time spent writing
+
+        self.slave_health = {}  # slave_id -> SlaveHealth
+        self.serial_settings_warned = False
+
+    def set_metrics(self, metrics):
+        self.metrics = metrics
+
+    def _count_error(self, slave_id, kind: str):
+        if self.metrics is not None and slave_id is not None:
+            self.metrics.count_modbus_error(slave_id, kind)
+
+    def _health(self, slave_id: int) -> SlaveHealth:
+        health = self.slave_health.get(slave_id)
+        if health is None:
+            health = self.slave_health.setdefault(slave_id, SlaveHealth(self.wb_config.timeout_min, self.wb_config.timeout
+                                                                        , self.wb_config.breaker_failures
+                                                                        , self.wb_config.breaker_probe_every))
+        return health
+
+    # runs on the bus thread: the timeout of this slave, then the transaction itself
+    def _timed(self, timeout: float, fn, *args, **kwargs):
+        self.wb_handle.timeout = timeout
+        serial_port = self.wb_handle.socket
+        if serial_port is not None and serial_port.timeout != timeout:
+            try:
+                serial_port.timeout = timeout
+            except Exception as e:
+                # pyserial takes the new timeout for reads before it writes the port settings again,
+                # which e.g. pseudo terminals refuse
+                if not self.serial_settings_warned:
+                    logging.warning('Port settings of %s could not be written again: %s', self.wb_config.port, str(e))
+                    self.serial_settings_warned = True
+        start = time.monotonic()
+        result = fn(*args, **kwargs)
+        return result, time.monotonic() - start
+
+    # queue fn on the bus without waiting for it. The future gives the response, or None if the transaction waited
+    # longer than its deadline or the slave is skipped. Whatever is queued, more urgent transactions still go first
+    def _submit_transaction(self, priority: int, fn, *args, **kwargs) -> Future:
+        slave_id = kwargs.get('unit')
+        if slave_id is None:  # connect, close
+            return chain(self.bus_scheduler.submit(priority, BusPriority.DEADLINES.get(priority), self._timed
+                                                   , self.wb_config.timeout, fn, *args, **kwargs)
+                         , lambda timed: timed[0])
+
+        health = self._health(slave_id)
+        if not health.allow_request(time.monotonic()):
+            logging.debug('WB %s does not answer. Transaction skipped', slave_id)
+            skipped = Future()
+            skipped.set_result(None)
+            return skipped
+        result = Future()
+
+        def done(transaction: Future):
+            try:
+                result.set_result(self._transaction_done(slave_id, health, transaction))
+            except Exception as e:  # whoever waits for it gets it, instead of waiting forever
+                result.set_exception(e)
+
+        self.bus_scheduler.submit(priority, BusPriority.DEADLINES.get(priority), self._timed, health.timeout(), fn
+                                  , *args, **kwargs).add_done_callback(done)
+        return result
+
+    # run fn on the bus and wait for it
+    def _transaction(self, priority: int, fn, *args, **kwargs):
+        return self._submit_transaction(priority, fn, *args, **kwargs).result()
+
+    # on the bus thread: error counters and circuit breaker of the slave
+    def _transaction_done(self, slave_id: int, health: SlaveHealth, transaction: Future):
+        try:
+            response, latency = transaction.result()
+        except TransactionExpired:
+            self._count_error(slave_id, 'expired')
+            health.cancel_probe()  # if this was the probe, it never went out. Try again next time
+            return None
+        except Exception:
+            self._count_error(slave_id, 'error')
+            health.record_failure(time.monotonic())
+            raise
+        if isinstance(response, ModbusIOException):  # pymodbus returns this if the slave did not answer in time
+            self._count_error(slave_id, 'timeout')
+            health.record_failure(time.monotonic())
+            if health.state == BreakerState.OPEN:
+                logging.error('WB %s does not answer. Skipped for the next %s s', slave_id
+                              , self.wb_config.breaker_probe_every)
+        else:
+            if hasattr(response, 'isError') and response.isError():
+                self._count_error(slave_id, 'error')
+            health.record_success(latency)
+        return response
+
+    # state of the circuit breaker, smoothed latency and current timeout per slave
+    def get_slave_health(self) -> dict:
+        result = {}
+        for slave_id, health in list(self.slave_health.items()):
+            stats = health.get_stats()
+            stats['timeout'] = health.timeout()
+            result[slave_id] = stats
+        return result
+
+    # forget what we know about the holding registers of a WB (or all WBs), so the next writes go out for sure
+    def invalidate_holding_shadow(self, slave_id: int = None):
+        if slave_id is None:
+            self.holding_shadow.clear()
+        else:
+            self.holding_shadow.pop(slave_id, None)
+
+    def _update_holding_shadow(self, slave_id: int, register: int, values):
+        self.holding_shadow.setdefault(slave_id, {})[register] = list(values)
+
+    def get_bus_stats(self) -> dict:
+        return self.bus_scheduler.get_stats()
+
     def connect_wb_heidelberg(self):
         if WBDef.FAKE_WB_CONNECTION:
             return True
 
-        result = self.wb_handle.connect()
+        result = self._transaction(BusPriority.CONTROL_WRITE, self.wb_handle.connect)
         if not result:
             logging.fatal('No Connection possible to WB Heidelberg')
         return result
 
     def close_wb_heidelberg(self):
-        self.wb_handle.close()
+        self._transaction(BusPriority.CONTROL_WRITE, self.wb_handle.close)
         logging.fatal('Closing connection to WB Heidelberg')
 
     # do all the Read Input Registers
-    def _call_remote_input_registers(self, slave_id: int, register_set: ModbusRegisters):
-        read = self.wb_handle.read_input_registers(register_set.register
-                                                   , register_set.length
-                                                   , unit=slave_id)
-        if not read.isError():
-            return read.registers[0]
-        else:
+    def _call_remote_input_registers(self, slave_id: int, register_set: ModbusRegisters
+                                     , priority: int = BusPriority.STATE_READ):
+        registers = self._submit_input_register_block(slave_id, register_set, priority).result()
+        return registers if registers is False else registers[0]
+
+    # the future gives the registers, False if they could not be read
+    def _submit_input_register_block(self, slave_id: int, register_set: ModbusRegisters
+                                     , priority: int = BusPriority.STATE_READ) -> Future:
+        return chain(self._submit_transaction(priority, self.wb_handle.read_input_registers
+                                              , register_set.register
+                                              , register_set.length
+                                              , unit=slave_id)
+                     , lambda read: self._input_registers_read(slave_id, register_set, read))
+
+    def _input_registers_read(self, slave_id: int, register_set: ModbusRegisters, read):
+        if read is not None and not read.isError():
+            return read.registers
+        if register_set.length == 1:
             logging.fatal('Could not read Register %s for WB %s', register_set.register, slave_id)
-            return False
+        else:
+            logging.fatal('Could not read Registers %s to %s for WB %s'
+                          , register_set.register, register_set.register + register_set.length - 1, slave_id)
+        self.invalidate_holding_shadow(slave_id)  # no idea what the WB went through
+        return False
+
+    # everything we want to know about the WB with a single transaction
+    def get_telemetry(self, slave_id: int):
+        return self.submit_telemetry(slave_id).result()
+
+    # same as get_telemetry, without waiting for the bus. The future gives the telemetry or False
+    def submit_telemetry(self, slave_id: int) -> Future:
+        block = self.wb_read_input.telemetry
+        if not WBDef.FAKE_WB_CONNECTION:
+            registers = self._submit_input_register_block(slave_id, block)
+        else:
+            logging.warning('Testmode active')
+            fake = [0] * block.length
+            fake[self.wb_read_input.chargingState.register - block.register] = WBDef.CHARGE_REQUEST1
+            fake[self.wb_read_input.actualChargePower.register - block.register] = 100
+            registers = Future()
+            registers.set_result(fake)
+        return chain(registers, lambda read: read if read is False else self._telemetry(slave_id, read))
+
+    def _telemetry(self, slave_id: int, registers) -> HeidelbergWBTelemetry:
+        telemetry = HeidelbergWBTelemetry(registers, self.wb_read_input.telemetry, self.wb_read_input)
+        logging.info('Charge state for WB %s: %s, charge power: %s', slave_id, telemetry.charge_state
+                     , telemetry.actual_charge_power)
+        return telemetry
 
     def get_charging_state(self, slave_id: int):
         if not WBDef.FAKE_WB_CONNECTION:
@@ -94,14 +302,31 @@ class ModbusRTUHeidelbergWB:
             return 100
 
     def get_pcb_temperature(self, slave_id: int):
-        return self._call_remote_input_registers(slave_id, self.wb_read_input.PCB_Temperature)
+        return self._call_remote_input_registers(slave_id, self.wb_read_input.PCB_Temperature, BusPriority.DIAGNOSTIC)
 
     # do all the Read Holding Registers
-    def _call_remote_read_holding_registers(self, slave_id: int, register_set: ModbusRegisters):
-        read = self.wb_handle.read_holding_registers(register_set.register
-                                                     , register_set.length
-                                                     , unit=slave_id)
+    def _call_remote_read_holding_registers(self, slave_id: int, register_set: ModbusRegisters
+                                            , priority: int = BusPriority.DIAGNOSTIC):
+        return self._submit_read_holding_registers(slave_id, register_set, priority).result()
+
+    # the future gives the registers, False if they could not be read
+    def _submit_read_holding_registers(self, slave_id: int, register_set: ModbusRegisters
+                                       , priority: int = BusPriority.DIAGNOSTIC) -> Future:
+        return chain(self._submit_transaction(priority, self.wb_handle.read_holding_registers
+                                              , register_set.register
+                                              , register_set.length
+                                              , unit=slave_id)
+                     , lambda read: self._holding_registers_read(slave_id, register_set, read))
+
+    # on the bus thread, so the shadow follows the reads and writes in the order they went out
+    def _holding_registers_read(self, slave_id: int, register_set: ModbusRegisters, read):
+        if read is None or read.isError():
+            logging.fatal('Could not read Register %s for WB %s', register_set.register, slave_id)
+            self.invalidate_holding_shadow(slave_id)
+            return False
         logging.info('%s', read.registers)
+        for offset in range(register_set.length):
+            self._update_holding_shadow(slave_id, register_set.register + offset, read.registers[offset:offset + 1])
         return read.registers
 
     def get_max_current(self, slave_id: int):
@@ -110,27 +335,154 @@ class ModbusRTUHeidelbergWB:
     def get_failsafe_max_current(self, slave_id: int):
         return self._call_remote_read_holding_registers(slave_id, self.wb_read_holding.failsafeMaxCurrent)
 
+    # read back the holding registers we write and compare them to the shadow. Returns True if all of them matched
+    def verify_holding_registers(self, slave_id: int) -> bool:
+        return self.submit_verify_holding_registers(slave_id).result()
+
+    # same as verify_holding_registers, without waiting for the bus. These are diagnostics: the writes of the
+    # allocation get ahead of them
+    def submit_verify_holding_registers(self, slave_id: int) -> Future:
+        reads = [chain(self._submit_transaction(BusPriority.DIAGNOSTIC, self.wb_handle.read_holding_registers
+                                                , register_set.register
+                                                , register_set.length
+                                                , unit=slave_id)
+                       , lambda read, register_set=register_set: self._holding_registers_verified(slave_id
+                                                                                                  , register_set, read))
+                 for register_set in (self.wb_read_holding.standByControl, self.wb_read_holding.currentBlock)]
+        return chain(gather(reads), all)
+
+    # on the bus thread: compare with what we believed right before the read, then take what the WB has
+    def _holding_registers_verified(self, slave_id: int, register_set: ModbusRegisters, read) -> bool:
+        expected = dict(self.holding_shadow.get(slave_id, {}))
+        if self._holding_registers_read(slave_id, register_set, read) is False:
+            return False
+
+        matched = True
+        for register in range(register_set.register, register_set.register + register_set.length):
+            actual = self.holding_shadow[slave_id][register]
+            if register in expected and actual != expected[register]:
+                logging.error('WB %s Register %s is %s, expected %s', slave_id, register, actual, expected[register])
+                matched = False
+        return matched
+
     # do all the write holding registers
-    def _call_remote_write_holding_registers(self, register_set: ModbusRegisters, val, slave_id: int):
+    def _call_remote_write_holding_registers(self, register_set: ModbusRegisters, val, slave_id: int
+                                             , priority: int = BusPriority.CONTROL_WRITE):
         if not WBDef.FAKE_WB_CONNECTION:
-            response = self.wb_handle.write_registers(register_set.register
-                                                      , values=val
+            values = list(val) if isinstance(val, (list, tuple)) else [val]
+            if self.holding_shadow.get(slave_id, {}).get(register_set.register) == values:
+                logging.debug('WB %s Register %s already is %s. Not written', slave_id, register_set.register, values)
+                return True
+
+            start = time.perf_counter()
+            response = chain(self._submit_transaction(priority, self.wb_handle.write_registers
+                                                      , register_set.register
+                                                      , values=values
                                                       , unit=slave_id)
-            if response.isError():
-                logging.fatal('Could not write Register %s', register_set.register)
-                return False
+                             , lambda write: self._holding_registers_written(slave_id, register_set, values, write)
+                             ).result()
+            if self.metrics is not None:
+                self.metrics.add_stage_time('modbus_writes', time.perf_counter() - start)
             return response
         else:
             logging.warning('Testmode active')
             return True
 
+    # on the bus thread, like the reads
+    def _holding_registers_written(self, slave_id: int, register_set: ModbusRegisters, values, write):
+        if write is None or write.isError():
+            logging.fatal('Could not write Register %s', register_set.register)
+            self.invalidate_holding_shadow(slave_id)
+            return False
+        self._update_holding_shadow(slave_id, register_set.register, values)
+        return write
+
     def set_standby_control(self, slave_id: int, val):
         return self._call_remote_write_holding_registers(self.wb_write_holding.standByControl, val, slave_id)
 
     def set_max_current(self, slave_id: int, val: int):
-        return self._call_remote_write_holding_registers(self.wb_write_holding.maxCurrent, val, slave_id)
+        return self._call_remote_write_holding_registers(self.wb_write_holding.maxCurrent, val, slave_id
+                                                         , BusPriority.CURRENT_WRITE)
 
     def set_failsafe_max_current(self, slave_id: int, val: int):
         return self._call_remote_write_holding_registers(self.wb_write_holding.failsafeMaxCurrent, val, slave_id)
 
 
+
+
+# WBs spread over several RS485 buses. Same interface as ModbusRTUHeidelbergWB, every call goes to the bus of the slave
+class MultiBusHeidelbergWB:
+    def __init__(self):
+        self.connections = []  # one ModbusRTUHeidelbergWB per bus
+        self.connection_by_slave = {}
+
+    def add_bus(self, connection: ModbusRTUHeidelbergWB, slave_ids):
+        self.connections.append(connection)
+        for slave_id in slave_ids:
+            self.connection_by_slave[slave_id] = connection
+
+    def connect_wb_heidelberg(self):
+        result = True
+        for connection in self.connections:
+            result = connection.connect_wb_heidelberg() and result
+        return result
+
+    def close_wb_heidelberg(self):
+        for connection in self.connections:
+            connection.close_wb_heidelberg()
+
+    def set_metrics(self, metrics):
+        for connection in self.connections:
+            connection.set_metrics(metrics)
+
+    def get_slave_health(self) -> dict:
+        result = {}
+        for connection in self.connections:
+            result.update(connection.get_slave_health())
+        return result
+
+    def get_bus_stats(self) -> dict:
+        return {connection.wb_config.port: connection.get_bus_stats() for connection in self.connections}
+
+    def get_telemetry(self, slave_id: int):
+        return self.connection_by_slave[slave_id].get_telemetry(slave_id)
+
+    def submit_telemetry(self, slave_id: int) -> Future:
+        return self.connection_by_slave[slave_id].submit_telemetry(slave_id)
+
+    def get_charging_state(self, slave_id: int):
+        return self.connection_by_slave[slave_id].get_charging_state(slave_id)
+
+    def get_actual_charge_power(self, slave_id: int):
+        return self.connection_by_slave[slave_id].get_actual_charge_power(slave_id)
+
+    def get_pcb_temperature(self, slave_id: int):
+        return self.connection_by_slave[slave_id].get_pcb_temperature(slave_id)
+
+    def get_max_current(self, slave_id: int):
+        return self.connection_by_slave[slave_id].get_max_current(slave_id)
+
+    def get_failsafe_max_current(self, slave_id: int):
+        return self.connection_by_slave[slave_id].get_failsafe_max_current(slave_id)
+
+    def verify_holding_registers(self, slave_id: int) -> bool:
+        return self.connection_by_slave[slave_id].verify_holding_registers(slave_id)
+
+    def submit_verify_holding_registers(self, slave_id: int) -> Future:
+        return self.connection_by_slave[slave_id].submit_verify_holding_registers(slave_id)
+
+    def invalidate_holding_shadow(self, slave_id: int = None):
+        if slave_id is None:
+            for connection in self.connections:
+                connection.invalidate_holding_shadow()
+        else:
+            self.connection_by_slave[slave_id].invalidate_holding_shadow(slave_id)
+
+    def set_standby_control(self, slave_id: int, val):
+        return self.connection_by_slave[slave_id].set_standby_control(slave_id, val)
+
+    def set_max_current(self, slave_id: int, val: int):
+        return self.connection_by_slave[slave_id].set_max_current(slave_id, val)
+
+    def set_failsafe_max_current(self, slave_id: int, val: int):
+        return self.connection_by_slave[slave_id].set_failsafe_max_current(slave_id, val)
@@ -7,19 +7,32 @@ class ModbusRegisters:
 
 
 class HeidelbergWBReadInputs:
+    layoutVersion = ModbusRegisters(4, 1)  # Modbus Register-Layouts Version uint16
     chargingState = ModbusRegisters(5, 1)  # uint16: 2=A1, 3=A2, 4=B1, 5=B2, 6=C1, 7=C2, 8=derating, 9=E, 10=F, 11=ERR
     # A No vehicle plugged
     # B Vehicle plugged without charging request
     # C Vehicle plugged with charging request
     # x1 Wallbox doesn't allow charging
     # x2 Wallbox allows charging
+    currentL1 = ModbusRegisters(6, 1)  # L1 - Current RMS in 0.1 A uint16: 160 = 16A
+    currentL2 = ModbusRegisters(7, 1)  # L2 - Current RMS
+    currentL3 = ModbusRegisters(8, 1)  # L3 - Current RMS
     PCB_Temperature = ModbusRegisters(9, 1)  # PCB-Temperatur in 0.1 °C. int16: 325 = +32.5 °C / -145 = -14.5 °C
+    voltageL1 = ModbusRegisters(10, 1)  # Voltage L1 - N rms in Volt uint16: 230 = 230V
+    voltageL2 = ModbusRegisters(11, 1)  # Voltage L2 - N
+    voltageL3 = ModbusRegisters(12, 1)  # Voltage L3 - N
+    externLockState = ModbusRegisters(13, 1)  # extern lock state uint16: 0 = locked, 1 = unlocked
     actualChargePower = ModbusRegisters(14, 1)  # Power (L1+L2+L3) in VA uint16: 1000 --> 1kW
+    energySincePowerOn = ModbusRegisters(15, 2)  # in VAh, high word first
+    energySinceInstallation = ModbusRegisters(17, 2)  # in VAh, high word first
+    telemetry = ModbusRegisters(4, 15)  # all of the above with a single request
 
 
 class HeidelbergWBReadHolding:
+    standByControl = ModbusRegisters(258, 1)  # Standby Function Control uint16
     maxCurrent = ModbusRegisters(261, 1)  # Maximal current command uint16  [0; 60 to 160] 100 = 10A
     failsafeMaxCurrent = ModbusRegisters(262, 1)  # FailSafe Current configuration
+    currentBlock = ModbusRegisters(261, 2)  # maxCurrent and failsafeMaxCurrent with a single request
 
 
 class HeidelbergWBWriteHolding:
@@ -36,3 +49,4 @@ class SolarLogReadInputs:
     P_AC = ModbusRegisters(3502, 2)  # Gesamte AC Leistung
     P_DC = ModbusRegisters(3504, 2)  # Gesamte DC Leistung
     P_AC_Consumption = ModbusRegisters(3518, 2)  # Momentaner Gesamtverbrauch AC
+    snapshot = ModbusRegisters(3500, 20)  # all of the above with a single request
@@ -0,0 +1,283 @@
+from pv_modbus_solarlog import SolarLogData
+from pv_modbus_wallbox import WBDef
+from wallbox_system_state import WBSystemState
+from wallbox_proxy import WallboxProxy
+from toolbox import Toolbox
+from pv_forecast import PVForecast
+from config_file import ConfigFile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+import argparse
+import configparser
+import copy
+import csv
+import datetime
+import itertools
+import json
+import logging
+
+# Replays recorded SolarLog and wallbox series through the PV charge logic with a simulated clock.
+# A day takes well under a second, so settings like KEEP_CHARGE_CURRENT_STABLE_FOR can be tuned on past data.
+
+WATT_PER_AMP = 230 * 3  # same as Toolbox.watt_to_amp
+
+
+# the recorded series. Times in unix seconds
+class ReplayTrace:
+    def __init__(self):
+        self.solarlog = []  # (time, pv_output, consumption). Consumption includes the cars, as the SolarLog sees it
+        self.wallbox: Dict[int, list] = {}  # slave_id -> [(time, charge_state, charge_power)]
+
+    def add_solarlog(self, timestamp: float, pv_output: int, consumption: int):
+        self.solarlog.append((timestamp, pv_output, consumption))
+
+    def add_wallbox(self, timestamp: float, slave_id: int, charge_state: int, charge_power: float):
+        self.wallbox.setdefault(slave_id, []).append((timestamp, charge_state, charge_power))
+
+    def sort(self):
+        self.solarlog.sort()
+        for series in self.wallbox.values():
+            series.sort()
+
+    def start(self) -> float:
+        return self.solarlog[0][0]
+
+    def end(self) -> float:
+        return self.solarlog[-1][0]
+
+    # what PVDatabase writes (and influx_inspect export returns). Timestamps in s or ns
+    @staticmethod
+    def from_line_protocol(path: str):
+        trace = ReplayTrace()
+        with open(path) as f:
+            for line in f:
+                if not line.startswith(('solarlog,', 'wallbox,')):
+                    continue
+                series, field_set, timestamp = line.split()
+                timestamp = float(timestamp)
+                if timestamp > 1e12:
+                    timestamp /= 1e9
+                fields = dict(field.split('=', 1) for field in field_set.split(','))
+                if series.startswith('solarlog'):
+                    trace.add_solarlog(timestamp, int(float(fields['pv_output'])), int(float(fields['consumption'])))
+                else:
+                    slave_id = int(series.split('sensor=wallbox')[1])
+                    trace.add_wallbox(timestamp, slave_id, int(float(fields['charge_state']))
+                                      , float(fields.get('actual_current_active', 0)) * WATT_PER_AMP)
+        trace.sort()
+        return trace
+
+    # solarlog columns: time, pv_output, consumption
+    # wallbox columns: time, slave_id, charge_state and optionally actual_current_active (A)
+    @staticmethod
+    def from_csv(solarlog_path: str, wallbox_path: str = None):
+        trace = ReplayTrace()
+        with open(solarlog_path, newline='') as f:
+            for row in csv.DictReader(f):
+                trace.add_solarlog(float(row['time']), int(row['pv_output']), int(row['consumption']))
+        if wallbox_path:
+            with open(wallbox_path, newline='') as f:
+                for row in csv.DictReader(f):
+                    trace.add_wallbox(float(row['time']), int(row['slave_id']), int(row['charge_state'])
+                                      , float(row.get('actual_current_active') or 0) * WATT_PER_AMP)
+        trace.sort()
+        return trace
+
+
+class ReplayClock:
+    def __init__(self, start: float):
+        self.time = start
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.time)
+
+
+# the WBs take every write
+class ReplayWallboxConnection:
+    def set_max_current(self, slave_id: int, val: int):
+        return True
+
+    def set_failsafe_max_current(self, slave_id: int, val: int):
+        return True
+
+    def set_standby_control(self, slave_id: int, val):
+        return True
+
+
+# last sample at or before a time
+class SeriesCursor:
+    def __init__(self, series: list):
+        self.series = series
+        self.index = 0
+
+    def at(self, timestamp: float):
+        while self.index + 1 < len(self.series) and self.series[self.index + 1][0] <= timestamp:
+            self.index += 1
+        return self.series[self.index]
+
+
+# One run of the PV charge strategy over the trace, one step every CYCLE_TIME seconds.
+# The house consumption is the recorded one without the recorded cars. The simulated cars take what their WB allows.
+def replay(cfg: ConfigFile, trace: ReplayTrace) -> dict:
+    clock = ReplayClock(trace.start())
+    wb_prox = WallboxProxy(cfg, clock.now)
+    connection = ReplayWallboxConnection()
+    pv_forecast = PVForecast(cfg) if cfg.PV_FORECAST else None
+
+    slave_ids = sorted(trace.wallbox) or [slave_id for group in cfg.get_wallbox_groups() for slave_id in group.slave_ids]
+    wallbox = [WBSystemState(slave_id) for slave_id in sorted(slave_ids)]
+    for wb in wallbox:
+        wb.last_charge_activation = clock.now()  # as after a start of the controller
+        wb.last_charge_deactivation = clock.now()
+    solarlog_cursor = SeriesCursor(trace.solarlog)
+    wallbox_cursors = {slave_id: SeriesCursor(series) for slave_id, series in trace.wallbox.items()}
+
+    step = cfg.CYCLE_TIME
+    pv_energy = used_pv_energy = grid_energy = car_energy = 0.0  # Wh
+    switches = 0
+    steps = 0
+
+    while clock.time <= trace.end():
+        _, pv_output, consumption = solarlog_cursor.at(clock.time)
+
+        # poll the WBs: plug state from the trace, charge power from what we set in the last step
+        recorded_car_power = 0
+        car_power = 0
+        for wb in wallbox:
+            cursor = wallbox_cursors.get(wb.slave_id)
+            if cursor is not None:
+                _, wb.charge_state, recorded_power = cursor.at(clock.time)
+                recorded_car_power += recorded_power
+            else:
+                wb.charge_state = WBDef.CHARGE_REQUEST1  # no series -> always plugged in
+            wb.actual_charge_power = 0
+            if wb_prox.is_plug_connected_and_charge_ready(wb) and wb.max_current_active >= cfg.WB_MIN_CURRENT:
+                wb.charge_state = WBDef.CHARGE_REQUEST2
+                wb.actual_charge_power = wb.max_current_active * WATT_PER_AMP
+            wb.actual_current_active = Toolbox.watt_to_amp(wb.actual_charge_power)
+            car_power += wb.actual_charge_power
+        house_consumption = max(0, consumption - recorded_car_power)
+
+        solar_log_data = SolarLogData()
+        solar_log_data.actual_output = pv_output
+        solar_log_data.actual_consumption = int(house_consumption + car_power)
+        if pv_forecast is not None:
+            pv_forecast.add(clock.time, solar_log_data)
+
+        # PV branch of PVController.allocate
+        was_active = [wb.pv_charge_active for wb in wallbox]
+        wb_prox.allocate_pv(connection, wallbox, solar_log_data, car_power, pv_forecast)
+        switches += sum(1 for wb, active in zip(wallbox, was_active) if wb.pv_charge_active != active)
+
+        # energy until the next step, with the currents that were just set
+        car_power = sum(wb.max_current_active * WATT_PER_AMP for wb in wallbox
+                        if wb_prox.is_plug_connected_and_charge_ready(wb) and wb.max_current_active >= cfg.WB_MIN_CURRENT)
+        load = house_consumption + car_power
+        pv_energy += pv_output * step / 3600
+        used_pv_energy += min(pv_output, load) * step / 3600
+        grid_energy += max(0, load - pv_output) * step / 3600
+        car_energy += car_power * step / 3600
+
+        clock.time += step
+        steps += 1
+
+    return {'steps': steps,
+            'pv_kwh': pv_energy / 1000,
+            'self_consumption': used_pv_energy / pv_energy if pv_energy else 0.0,
+            'grid_kwh': grid_energy / 1000,
+            'car_kwh': car_energy / 1000,
+            'switches': switches}
+
+
+# every worker gets the trace once, not with every config
+_worker_trace: ReplayTrace = None
+
+
+def _init_worker(trace: ReplayTrace):
+    global _worker_trace
+    _worker_trace = trace
+    logging.disable(logging.CRITICAL)
+
+
+def _replay_in_worker(cfg: ConfigFile) -> dict:
+    return replay(cfg, _worker_trace)
+
+
+# one replay per set of overrides, spread over processes
+def replay_many(cfg: ConfigFile, trace: ReplayTrace, overrides: List[dict], processes: int = None) -> List[dict]:
+    configs = []
+    for override in overrides:
+        config = copy.copy(cfg)
+        for name, value in override.items():
+            setattr(config, name, value)
+        configs.append(config)
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(trace,)) as pool:
+        return [dict(override, **result) for override, result in zip(overrides, pool.map(_replay_in_worker, configs))]
+
+
+# ['A=1,2', 'B=3'] -> [{'A': 1, 'B': 3}, {'A': 2, 'B': 3}]. Values get the type of the config default
+def parse_overrides(cfg: ConfigFile, settings: List[str]) -> List[dict]:
+    names = []
+    values = []
+    for setting in settings:
+        name, _, value_list = setting.partition('=')
+        if not name.isupper() or not hasattr(cfg, name):
+            raise ValueError('Unknown setting: ' + name)
+        names.append(name)
+        values.append([_parse_value(name, getattr(cfg, name), value.strip()) for value in value_list.split(',')])
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+# the way the config file would be read
+def _parse_value(name: str, default, value: str):
+    if isinstance(default, bool):
+        if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+            raise ValueError('%s must be yes/no, true/false, on/off or 1/0, not %s' % (name, value))
+        return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+    if not isinstance(default, (int, float, str)):
+        raise ValueError(name + ' can not be set here')
+    try:
+        return type(default)(value)
+    except ValueError:
+        raise ValueError('%s must be %s, not %s' % (name, type(default).__name__, value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay of recorded PV and wallbox data with other settings')
+    parser.add_argument('--config', default='pv_modbus_config.ini')
+    parser.add_argument('--influx', help='line protocol export with solarlog and wallbox series')
+    parser.add_argument('--solarlog', help='CSV with the columns time, pv_output, consumption')
+    parser.add_argument('--wallbox', help='CSV with the columns time, slave_id, charge_state, actual_current_active')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=V1,V2'
+                        , help='settings to try, e.g. KEEP_CHARGE_CURRENT_STABLE_FOR=20,60. All combinations are run')
+    parser.add_argument('--processes', type=int, help='default: one per CPU')
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)  # same as main.py
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    cfg = ConfigFile(config)
+    if args.influx:
+        trace = ReplayTrace.from_line_protocol(args.influx)
+    elif args.solarlog:
+        trace = ReplayTrace.from_csv(args.solarlog, args.wallbox)
+    else:
+        parser.error('--influx or --solarlog is required')
+
+    try:
+        overrides = parse_overrides(cfg, args.set)
+    except ValueError as e:
+        parser.error(str(e))
+    results = replay_many(cfg, trace, overrides, args.processes)
+    for result in results:
+        print('%s  self consumption %5.1f %%  grid %8.2f kWh  cars %8.2f kWh  switches %5s' % (
+            ' '.join('%s=%s' % (name, result[name]) for name in result if name.isupper()) or 'config'
+            , result['self_consumption'] * 100, result['grid_kwh'], result['car_kwh'], result['switches']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
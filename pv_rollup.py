@@ -0,0 +1,93 @@
+from pv_modbus_solarlog import SolarLogData
+from wallbox_system_state import WBSystemState
+from typing import Dict, List, Tuple
+
+SOLARLOG_FIELDS = ('pv_output', 'consumption')
+WALLBOX_FIELDS = ('charge_state', 'pv_charge_active', 'grid_charge_active', 'max_current_active', 'actual_current_active')
+
+
+# min, max, mean and last of every field of one series over one interval
+class Rollup:
+    __slots__ = ('measurement', 'sensor', 'resolution', 'start', 'count', 'fields')
+
+    def __init__(self, measurement: str, sensor: str, resolution: int, start: int, count: int
+                 , fields: Dict[str, Tuple[float, float, float, float]]):
+        self.measurement = measurement
+        self.sensor = sensor
+        self.resolution = resolution  # seconds
+        self.start = start  # unix seconds, multiple of the resolution
+        self.count = count  # samples folded in
+        self.fields = fields  # name -> (min, max, mean, last)
+
+
+# the interval that is still open. All fields of a series are sampled together, so they share the count
+class _OpenInterval:
+    __slots__ = ('start', 'count', 'mins', 'maxs', 'sums', 'lasts')
+
+    def __init__(self, start: int, values: tuple):
+        self.start = start
+        self.count = 1
+        self.mins = list(values)
+        self.maxs = list(values)
+        self.sums = [float(v) for v in values]
+        self.lasts = values
+
+    def add(self, values: tuple):
+        mins = self.mins
+        maxs = self.maxs
+        sums = self.sums
+        for i, value in enumerate(values):
+            if value < mins[i]:
+                mins[i] = value
+            elif value > maxs[i]:
+                maxs[i] = value
+            sums[i] += value
+        self.count += 1
+        self.lasts = values
+
+
+# Folds every polled sample into intervals of each resolution (e.g. 10 s and 5 min). Only finished intervals
+# are handed out, so the DB gets a handful of rollups instead of every raw point, without losing the peaks
+class RollupAggregator:
+    def __init__(self, resolutions: List[int]):
+        self.resolutions = sorted(resolutions)
+        self.open: Dict[tuple, _OpenInterval] = {}  # (resolution, measurement, sensor) -> interval
+        self.field_names = {'solarlog': SOLARLOG_FIELDS, 'wallbox': WALLBOX_FIELDS}
+        self.finished: List[Rollup] = []
+
+    def _close(self, key: tuple, interval: _OpenInterval):
+        resolution, measurement, sensor = key
+        fields = {name: (interval.mins[i], interval.maxs[i], interval.sums[i] / interval.count, interval.lasts[i])
+                  for i, name in enumerate(self.field_names[measurement])}
+        self.finished.append(Rollup(measurement, sensor, resolution, interval.start, interval.count, fields))
+
+    def add(self, timestamp: float, measurement: str, sensor: str, values: tuple):
+        for resolution in self.resolutions:
+            start = int(timestamp // resolution) * resolution
+            key = (resolution, measurement, sensor)
+            interval = self.open.get(key)
+            if interval is not None:
+                if interval.start == start:
+                    interval.add(values)
+                    continue
+                self._close(key, interval)
+            self.open[key] = _OpenInterval(start, values)
+
+    def add_solarlog(self, timestamp: float, solar_log_data: SolarLogData):
+        self.add(timestamp, 'solarlog', 'solarlog1', (solar_log_data.actual_output, solar_log_data.actual_consumption))
+
+    def add_wallbox(self, timestamp: float, wallboxes: List[WBSystemState]):
+        for wb in wallboxes:
+            self.add(timestamp, 'wallbox', 'wallbox' + str(wb.slave_id)
+                     , (wb.charge_state, int(wb.pv_charge_active), int(wb.grid_charge_active), wb.max_current_active
+                        , wb.actual_current_active))
+
+    # the rollups of all intervals that are over at `now`, also of series that got no sample since
+    def collect(self, now: float) -> List[Rollup]:
+        for key, interval in list(self.open.items()):
+            if now >= interval.start + key[0]:
+                self._close(key, interval)
+                del self.open[key]
+        finished = self.finished
+        self.finished = []
+        return finished
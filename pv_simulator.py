@@ -0,0 +1,252 @@
+from pymodbus.server.sync import ModbusTcpServer
+from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext, ModbusSequentialDataBlock
+from pymodbus.framer.rtu_framer import ModbusRtuFramer
+from pymodbus.factory import ServerDecoder
+from pv_register_config import SolarLogReadInputs, HeidelbergWBReadInputs, HeidelbergWBReadHolding
+from pv_modbus_wallbox import WBDef
+from typing import List
+import argparse
+import csv
+import logging
+import os
+import select
+import threading
+import time
+import tty
+
+
+# Stand-ins for the SolarLog (Modbus TCP) and Heidelberg wallboxes (Modbus RTU on a pseudo terminal).
+# With them the controller runs end to end without any hardware, e.g. to measure cycle time and bus load.
+
+
+# PV output and house consumption (without the cars) over time. Linear between the points, constant after the last one
+class PVProfile:
+    def __init__(self, points):
+        self.points = sorted(points)  # (seconds, pv_output, consumption)
+
+    @staticmethod
+    def constant(pv_output: int, consumption: int):
+        return PVProfile([(0, pv_output, consumption)])
+
+    # columns: seconds, pv_output, consumption
+    @staticmethod
+    def from_csv(path: str):
+        with open(path, newline='') as f:
+            return PVProfile([(float(row['seconds']), int(row['pv_output']), int(row['consumption']))
+                              for row in csv.DictReader(f)])
+
+    def at(self, seconds: float):
+        previous = self.points[0]
+        for point in self.points:
+            if point[0] >= seconds:
+                if point[0] == previous[0]:
+                    return point[1], point[2]
+                share = (seconds - previous[0]) / (point[0] - previous[0])
+                return (int(previous[1] + share * (point[1] - previous[1]))
+                        , int(previous[2] + share * (point[2] - previous[2])))
+            previous = point
+        return previous[1], previous[2]
+
+
+# every transaction touches the data block once, so this is the time one transaction takes
+class LatencyDataBlock(ModbusSequentialDataBlock):
+    def __init__(self, address, values, latency: float = 0.0):
+        super().__init__(address, values)
+        self.latency = latency
+
+    def getValues(self, address, count=1):
+        time.sleep(self.latency)
+        return super().getValues(address, count)
+
+    def setValues(self, address, values):
+        time.sleep(self.latency)
+        super().setValues(address, values)
+
+
+class SimulatedWallbox:
+    VOLTAGE = 230
+
+    def __init__(self, slave_id: int, charge_state: int = WBDef.CHARGE_REQUEST1, latency: float = 0.0):
+        self.slave_id = slave_id
+        self.charge_state = charge_state  # set it to simulate plugging in a car (e.g. WBDef.CHARGE_NOPLUG1)
+        self.charge_power = 0
+        self.energy = 0.0
+        self.read_input = HeidelbergWBReadInputs()
+        self.read_holding = HeidelbergWBReadHolding()
+
+        self.input_registers = LatencyDataBlock(0, [0] * 20, latency)
+        self.holding_registers = LatencyDataBlock(0, [0] * 263, latency)
+        self.input_registers.values[self.read_input.layoutVersion.register] = 0x0108
+        self.holding_registers.values[self.read_holding.standByControl.register] = WBDef.ENABLE_STANDBY
+        self.context = ModbusSlaveContext(ir=self.input_registers, hr=self.holding_registers, zero_mode=True)
+
+    # let the car take what the WB allows
+    def update(self, elapsed: float):
+        max_current = self.holding_registers.values[self.read_holding.maxCurrent.register] / 10
+        state = self.charge_state
+        current = 0.0
+        if state in (WBDef.CHARGE_REQUEST1, WBDef.CHARGE_REQUEST2):
+            if max_current >= 6:
+                state = WBDef.CHARGE_REQUEST2
+                current = max_current
+            else:
+                state = WBDef.CHARGE_REQUEST1
+        self.charge_power = int(current * self.VOLTAGE * 3)
+        self.energy += self.charge_power * elapsed / 3600
+
+        registers = self.input_registers.values
+        registers[self.read_input.chargingState.register] = state
+        for register_set in (self.read_input.currentL1, self.read_input.currentL2, self.read_input.currentL3):
+            registers[register_set.register] = int(current * 10)
+        for register_set in (self.read_input.voltageL1, self.read_input.voltageL2, self.read_input.voltageL3):
+            registers[register_set.register] = self.VOLTAGE
+        registers[self.read_input.PCB_Temperature.register] = 325
+        registers[self.read_input.externLockState.register] = 1
+        registers[self.read_input.actualChargePower.register] = self.charge_power
+        for register_set in (self.read_input.energySincePowerOn, self.read_input.energySinceInstallation):
+            registers[register_set.register] = int(self.energy) >> 16
+            registers[register_set.register + 1] = int(self.energy) & 0xFFFF
+
+
+class SolarLogSimulator:
+    def __init__(self, profile: PVProfile, wallboxes: List[SimulatedWallbox], address=('127.0.0.1', 5020)
+                 , slave_id: int = 1, latency: float = 0.0):
+        self.profile = profile
+        self.wallboxes = wallboxes
+        self.register = SolarLogReadInputs()
+        self.input_registers = LatencyDataBlock(0, [0] * 3520, latency)
+        context = ModbusServerContext(slaves={slave_id: ModbusSlaveContext(ir=self.input_registers, zero_mode=True)}
+                                      , single=False)
+        self.server = ModbusTcpServer(context, address=address, allow_reuse_address=True)
+        self.address = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever, name='solarlog-simulator', daemon=True)
+
+    def _set_uint32(self, register_set, val: int):  # low word first
+        self.input_registers.values[register_set.register] = val & 0xFFFF
+        self.input_registers.values[register_set.register + 1] = val >> 16
+
+    # the SolarLog sees the cars as part of the consumption
+    def update(self, seconds: float):
+        pv_output, consumption = self.profile.at(seconds)
+        consumption += sum(wb.charge_power for wb in self.wallboxes)
+        self._set_uint32(self.register.lastUpdateTime, int(time.time()))
+        self._set_uint32(self.register.P_AC, pv_output)
+        self._set_uint32(self.register.P_DC, int(pv_output * 1.04))
+        self._set_uint32(self.register.P_AC_Consumption, consumption)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# RTU slaves on a pseudo terminal. The controller opens self.port like a real serial adapter
+class HeidelbergBusSimulator:
+    def __init__(self, wallboxes: List[SimulatedWallbox]):
+        self.wallboxes = wallboxes
+        self.context = ModbusServerContext(slaves={wb.slave_id: wb.context for wb in wallboxes}, single=False)
+        self.framer = ModbusRtuFramer(ServerDecoder())
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+        self.transactions = 0
+        self.running = False
+        self.thread = threading.Thread(target=self._serve, name='wallbox-simulator', daemon=True)
+
+    def _execute(self, request):
+        try:
+            response = request.execute(self.context[request.unit_id])
+        except Exception as e:
+            logging.error('Simulated WB %s: %s', request.unit_id, str(e))
+            return
+        response.transaction_id = request.transaction_id
+        response.unit_id = request.unit_id
+        os.write(self.master_fd, self.framer.buildPacket(response))
+        self.transactions += 1
+
+    def _serve(self):
+        unit_ids = [wb.slave_id for wb in self.wallboxes]
+        while self.running:
+            readable, _, _ = select.select([self.master_fd], [], [], 0.1)
+            if readable:
+                self.framer.processIncomingPacket(os.read(self.master_fd, 256), self._execute, unit=unit_ids)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+
+# SolarLog and WBs together, driven by one clock. speed > 1 runs the profile faster than real time
+class PVSimulator:
+    def __init__(self, profile: PVProfile, slave_ids: List[int], address=('127.0.0.1', 5020), solarlog_slave_id: int = 1
+                 , tcp_latency: float = 0.0, rtu_latency: float = 0.0, speed: float = 1.0, step: float = 0.5):
+        self.wallboxes = [SimulatedWallbox(slave_id, latency=rtu_latency) for slave_id in slave_ids]
+        self.solarlog = SolarLogSimulator(profile, self.wallboxes, address, solarlog_slave_id, tcp_latency)
+        self.bus = HeidelbergBusSimulator(self.wallboxes)
+        self.speed = speed
+        self.step = step
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._clock, name='simulator-clock', daemon=True)
+
+    def update(self, seconds: float, elapsed: float):
+        for wb in self.wallboxes:
+            wb.update(elapsed)
+        self.solarlog.update(seconds)
+
+    def _clock(self):
+        start = last = time.monotonic()
+        while not self.stopped.wait(self.step):
+            now = time.monotonic()
+            self.update((now - start) * self.speed, (now - last) * self.speed)
+            last = now
+
+    def start(self):
+        self.update(0, 0)
+        self.solarlog.start()
+        self.bus.start()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.bus.stop()
+        self.solarlog.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SolarLog and Heidelberg wallbox simulator')
+    parser.add_argument('--profile', help='CSV with the columns seconds, pv_output, consumption')
+    parser.add_argument('--pv', type=int, default=6000, help='constant PV output in W, if there is no profile')
+    parser.add_argument('--consumption', type=int, default=500, help='constant house consumption in W')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5020, help='Modbus TCP port of the SolarLog')
+    parser.add_argument('--slaves', default='1,2', help='Slave IDs of the wallboxes')
+    parser.add_argument('--tcp-latency', type=float, default=0.0, help='seconds per SolarLog transaction')
+    parser.add_argument('--rtu-latency', type=float, default=0.0, help='seconds per wallbox transaction')
+    parser.add_argument('--speed', type=float, default=1.0, help='run the profile x times faster than real time')
+    args = parser.parse_args()
+
+    profile = PVProfile.from_csv(args.profile) if args.profile else PVProfile.constant(args.pv, args.consumption)
+    simulator = PVSimulator(profile, [int(i) for i in args.slaves.split(',')], (args.host, args.port)
+                            , tcp_latency=args.tcp_latency, rtu_latency=args.rtu_latency, speed=args.speed)
+    simulator.start()
+    print('SolarLog: %s:%s' % simulator.solarlog.address)
+    print('WB_RTU_DEVICE = %s' % simulator.bus.port)
+    try:
+        while True:
+            time.sleep(10)
+            print('%s wallbox transactions' % simulator.bus.transactions)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
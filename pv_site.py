@@ -0,0 +1,94 @@
+from pv_modbus_solarlog import SolarLogData
+from wallbox_system_state import WBSystemState
+from pv_database import PVDataSink, PVDatabase
+from pv_rollup import Rollup
+from config_file import ConfigFile, load_config
+from pv_controller import PVController
+from typing import List
+import datetime
+import logging
+import signal
+import sys
+import threading
+import time
+
+# One site of pv_supervisor, in its own process. Its own module and not part of pv_supervisor.py: started as a
+# script, pv_supervisor would be __main__ in the site process, and the backend registry would load a second copy of it
+
+
+# The site end of the pipe to the supervisor. Messages: ('lines', [line protocol]) and ('cycle', {health})
+class SiteLink:
+    def __init__(self, name: str, connection):
+        self.name = name
+        self.connection = connection
+        self.lock = threading.Lock()  # the DB write of the async loop runs in another thread
+
+    # raises (BrokenPipeError) if the supervisor is gone, which ends the site
+    def send(self, kind: str, payload):
+        with self.lock:
+            self.connection.send((kind, payload))
+
+
+_site_link: SiteLink = None  # of this site process
+
+
+# DATA_SINK = uplink: the lines go to the supervisor, tagged with the site
+class UplinkSink(PVDataSink):
+    def __init__(self, cfg: ConfigFile):
+        if _site_link is None:
+            raise ValueError('DATA_SINK = uplink only works for the sites of pv_supervisor')
+        self.link = _site_link
+        self.solarlog_lastwrite = datetime.datetime.now()
+        self.wallbox_lastwrite = datetime.datetime.now()
+
+    # e.g. solarlog,site=carport_north,sensor=solarlog1 ...
+    def tag_site(self, line: str) -> str:
+        return line.replace(',sensor=', ',site=' + self.link.name + ',sensor=', 1)
+
+    def _send(self, lines: List[str]):
+        self.link.send('lines', [self.tag_site(line) for line in lines])
+
+    def write_solarlog_data(self, solar_log_data: SolarLogData):
+        self._send([PVDatabase.format_solarlog_line(solar_log_data, int(time.time()))])
+        self.solarlog_snapshot = solar_log_data.snapshot()
+        self.solarlog_lastwrite = datetime.datetime.now()
+
+    def write_wallbox_data(self, wallboxes: List[WBSystemState]):
+        timestamp = int(time.time())
+        self._send([PVDatabase.format_wallbox_line(wb, timestamp) for wb in wallboxes])
+        self.wallbox_snapshot = tuple(wb.snapshot() for wb in wallboxes)
+        self.wallbox_lastwrite = datetime.datetime.now()
+
+    def write_rollups(self, rollups: List[Rollup]):
+        self._send([PVDatabase.format_rollup_line(rollup) for rollup in rollups])
+
+    def close(self, timeout: float = None):
+        pass
+
+
+# entry point of a site process. Started fresh (spawn): nothing of the supervisor, like its threads, gets inherited
+def run_site(name: str, config_path: str, connection):
+    global _site_link
+    logging.basicConfig(level=logging.CRITICAL, format='%(asctime)s ' + name + ' %(levelname)s %(message)s'
+                        , force=True)
+    _site_link = SiteLink(name, connection)
+
+    cfg = load_config(config_path)
+    controller = PVController(cfg, config_path)
+
+    def report_cycle(cycle_time: float):
+        stats = controller.poll_scheduler.get_stats()
+        _site_link.send('cycle', {'cycle_time': cycle_time, 'cycles': stats['cycles'], 'overruns': stats['overruns'],
+                                  'period': stats['period']})
+    controller.on_cycle_end = report_cycle
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # stopped by the supervisor: close the controller
+    try:
+        if cfg.ASYNC_LOOP:
+            import asyncio
+            from pv_controller_async import AsyncPVController
+            asyncio.run(AsyncPVController(controller).run())
+        else:
+            controller.run()
+    finally:
+        controller.close(timeout=1)
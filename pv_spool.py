@@ -0,0 +1,101 @@
+import logging
+import os
+import threading
+from typing import List, Tuple
+
+
+# Append only store for line protocol records that could not be written to the DB.
+# Records go into numbered segment files. A segment is only deleted after all of its records were written to the DB,
+# so a crash at any time can at most lead to records being written twice (which the DB ignores: same series and time).
+class PVSpool:
+    SEGMENT_SUFFIX = '.lp'
+
+    def __init__(self, spool_dir: str, segment_size: int, max_size: int):
+        self.spool_dir = spool_dir
+        self.segment_size = segment_size  # bytes. Start a new segment after this size
+        self.max_size = max_size  # bytes. Oldest segments get dropped above this size
+        self.lock = threading.Lock()
+
+        os.makedirs(spool_dir, exist_ok=True)
+        self.segments = {}  # segment number -> size in bytes
+        for name in os.listdir(spool_dir):
+            if name.endswith(self.SEGMENT_SUFFIX):
+                self.segments[int(name[:-len(self.SEGMENT_SUFFIX)])] = os.path.getsize(os.path.join(spool_dir, name))
+        if self.segments:
+            logging.warning('Spool contains %s segments (%s bytes) from last run', len(self.segments), self.size())
+
+        # never append to a segment of an earlier run. It might end with a half written record
+        self.active_segment = max(self.segments, default=0) + 1
+        self.active_handle = None
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.spool_dir, '%08d%s' % (segment, self.SEGMENT_SUFFIX))
+
+    def size(self) -> int:
+        return sum(self.segments.values())
+
+    def is_empty(self) -> bool:
+        return not self.segments
+
+    def _rotate(self):
+        if self.active_handle is not None:
+            self.active_handle.close()
+            self.active_handle = None
+        self.active_segment += 1
+
+    def _evict(self):
+        while self.size() > self.max_size and len(self.segments) > 1:
+            oldest = min(self.segments)
+            logging.error('Spool is full. Dropping oldest segment %s (%s bytes)', oldest, self.segments[oldest])
+            self._remove(oldest)
+
+    def _remove(self, segment: int):
+        if segment == self.active_segment:
+            self._rotate()
+        try:
+            os.remove(self._segment_path(segment))
+        except FileNotFoundError:
+            pass
+        del self.segments[segment]
+
+    def append(self, lines: List[str]):
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        with self.lock:
+            if self.active_handle is None:
+                self.active_handle = open(self._segment_path(self.active_segment), 'ab')
+                self.segments[self.active_segment] = 0
+            self.active_handle.write(data)
+            self.active_handle.flush()
+            os.fsync(self.active_handle.fileno())
+            self.segments[self.active_segment] += len(data)
+
+            if self.segments[self.active_segment] >= self.segment_size:
+                self._rotate()
+            self._evict()
+
+    # returns the oldest segment and its complete records. Appending continues in a new segment from now on
+    def read_oldest(self) -> Tuple[int, List[str]]:
+        with self.lock:
+            if not self.segments:
+                return 0, []
+            oldest = min(self.segments)
+            if oldest == self.active_segment:
+                self._rotate()
+            with open(self._segment_path(oldest), 'rb') as f:
+                data = f.read()
+
+        # a crash while appending can leave a partial record at the end. It has no newline yet
+        records = data.decode('utf-8', errors='replace').split('\n')
+        return oldest, [record for record in records[:-1] if record]
+
+    # call after the records of the segment were written to the DB
+    def remove(self, segment: int):
+        with self.lock:
+            if segment in self.segments:
+                self._remove(segment)
+
+    def close(self):
+        with self.lock:
+            if self.active_handle is not None:
+                self.active_handle.close()
+                self.active_handle = None
@@ -0,0 +1,172 @@
+from pv_modbus_solarlog import SolarLogData
+from wallbox_system_state import WBSystemState
+from pv_database import PVDataSink
+from pv_rollup import Rollup
+from config_file import ConfigFile
+import logging
+import datetime
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import List
+
+# Rows are kept per sensor in time order: the primary key is the only index, so an insert touches one B-tree
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS solarlog (sensor TEXT NOT NULL, time INTEGER NOT NULL'
+    ', pv_output INTEGER, consumption INTEGER'
+    ', PRIMARY KEY (sensor, time)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS wallbox (sensor TEXT NOT NULL, time INTEGER NOT NULL'
+    ', charge_state INTEGER, pv_charge_active INTEGER, grid_charge_active INTEGER'
+    ', max_current_active REAL, actual_current_active REAL'
+    ', PRIMARY KEY (sensor, time)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS rollup (sensor TEXT NOT NULL, time INTEGER NOT NULL, resolution INTEGER NOT NULL'
+    ', field TEXT NOT NULL, min REAL, max REAL, mean REAL, last REAL, samples INTEGER'
+    ', PRIMARY KEY (sensor, time, resolution, field)) WITHOUT ROWID',
+)
+TABLES = ('solarlog', 'wallbox', 'rollup')
+
+
+# Local time series store for sites without an InfluxDB server. Same rows as PVDatabase writes, in a SQLite file.
+# The cycle only queues the rows. A writer thread commits everything of SQLITE_COMMIT_EVERY seconds in one
+# transaction, so the SD card sees one WAL append per commit and not one per row
+class PVSQLiteDatabase(PVDataSink):
+    INSERTS = {'solarlog': 'INSERT OR REPLACE INTO solarlog VALUES (?, ?, ?, ?)',
+               'wallbox': 'INSERT OR REPLACE INTO wallbox VALUES (?, ?, ?, ?, ?, ?, ?)',
+               'rollup': 'INSERT OR REPLACE INTO rollup VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'}
+    QUEUE_SIZE = 1000  # writes. Only fills up if the disk hangs
+
+    def __init__(self, cfg: ConfigFile):
+        self.cfg = cfg
+        self.solarlog_lastwrite = datetime.datetime.now()
+        self.wallbox_lastwrite = datetime.datetime.now()
+
+        directory = os.path.dirname(cfg.SQLITE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # opened here, so a broken path shows up at startup. Only the writer thread uses it afterwards
+        self.connection = sqlite3.connect(cfg.SQLITE_PATH, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # fsync at checkpoints only. A power cut may lose the last commits, but never breaks the file
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('PRAGMA journal_size_limit=%d' % (4 * 1024 * 1024))  # WAL shrinks back after a checkpoint
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+        self.sensors = {table: {row[0] for row in self.connection.execute('SELECT DISTINCT sensor FROM ' + table)}
+                        for table in TABLES}  # for the retention, which deletes per sensor
+        self.pruned_bucket = None
+
+        self.write_queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.writer_thread = threading.Thread(target=self._writer_loop, name='sqlite-writer', daemon=True)
+        self.writer_thread.start()
+
+    @staticmethod
+    def solarlog_row(solar_log_data: SolarLogData, timestamp: int) -> tuple:
+        return 'solarlog1', timestamp, solar_log_data.actual_output, solar_log_data.actual_consumption
+
+    @staticmethod
+    def wallbox_row(wb: WBSystemState, timestamp: int) -> tuple:
+        return ('wallbox' + str(wb.slave_id), timestamp, wb.charge_state, int(wb.pv_charge_active)
+                , int(wb.grid_charge_active), wb.max_current_active, wb.actual_current_active)
+
+    # one row per field
+    @staticmethod
+    def rollup_rows(rollup: Rollup) -> List[tuple]:
+        return [(rollup.sensor, rollup.start, rollup.resolution, name, minimum, maximum, mean, last, rollup.count)
+                for name, (minimum, maximum, mean, last) in rollup.fields.items()]
+
+    def _enqueue(self, table: str, rows: List[tuple]) -> bool:
+        try:
+            self.write_queue.put_nowait((table, rows))
+            return True
+        except queue.Full:
+            logging.error('SQLite write queue is full. Dropping %s rows', len(rows))
+            return False
+
+    # one transaction, one prepared statement per table
+    def _commit(self, rows: dict) -> bool:
+        try:
+            with self.connection:
+                for table, table_rows in rows.items():
+                    if table_rows:
+                        self.connection.executemany(self.INSERTS[table], table_rows)
+        except sqlite3.Error as e:
+            logging.fatal('SQLite write failed: %s', str(e))
+            self.solarlog_snapshot = None  # written again with the next cycle
+            self.wallbox_snapshot = None
+            return False
+        for table in rows:
+            self.sensors[table].update(row[0] for row in rows[table])
+        return True
+
+    # Drops everything older than SQLITE_RETENTION_DAYS, a whole SQLITE_PRUNE_BUCKET at a time.
+    # The freed pages are reused by the next inserts, so the file stops growing once the retention is reached
+    def _prune(self, now: float):
+        if not self.cfg.SQLITE_RETENTION_DAYS:
+            return
+        bucket = int(now // self.cfg.SQLITE_PRUNE_BUCKET)
+        if bucket == self.pruned_bucket:
+            return
+        cutoff = bucket * self.cfg.SQLITE_PRUNE_BUCKET - self.cfg.SQLITE_RETENTION_DAYS * 86400
+        try:
+            with self.connection:
+                for table, sensors in self.sensors.items():
+                    self.connection.executemany('DELETE FROM %s WHERE sensor = ? AND time < ?' % table
+                                                , [(sensor, cutoff) for sensor in sensors])
+        except sqlite3.Error as e:
+            logging.error('SQLite retention failed: %s', str(e))
+            return
+        self.pruned_bucket = bucket
+
+    def _writer_loop(self):
+        running = True
+        while running:
+            item = self.write_queue.get()
+            if item is None:
+                break
+            rows = {table: [] for table in TABLES}
+            rows[item[0]].extend(item[1])
+
+            # everything that arrives until the commit is due goes into the same transaction
+            commit_at = time.monotonic() + self.cfg.SQLITE_COMMIT_EVERY
+            while True:
+                try:
+                    item = self.write_queue.get(timeout=max(0.0, commit_at - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                rows[item[0]].extend(item[1])
+
+            self._commit(rows)
+            logging.debug('%s rows written to SQLite', sum(len(table_rows) for table_rows in rows.values()))
+            self._prune(time.time())
+
+    # write what is queued and stop the writer thread
+    def close(self, timeout: float = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            self.write_queue.put(None, timeout=timeout)  # a stuck writer leaves the queue full
+        except queue.Full:
+            logging.error('SQLite write queue is still full. %s writes are not stored', self.write_queue.qsize())
+        self.writer_thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        if not self.writer_thread.is_alive():
+            self.connection.close()
+
+    def write_solarlog_data(self, solar_log_data: SolarLogData):
+        if self._enqueue('solarlog', [self.solarlog_row(solar_log_data, int(time.time()))]):
+            self.solarlog_snapshot = solar_log_data.snapshot()
+            self.solarlog_lastwrite = datetime.datetime.now()
+
+    def write_wallbox_data(self, wallboxes: List[WBSystemState]):
+        timestamp = int(time.time())
+        if self._enqueue('wallbox', [self.wallbox_row(wb, timestamp) for wb in wallboxes]):
+            self.wallbox_snapshot = tuple(wb.snapshot() for wb in wallboxes)
+            self.wallbox_lastwrite = datetime.datetime.now()
+
+    def write_rollups(self, rollups: List[Rollup]):
+        self._enqueue('rollup', [row for rollup in rollups for row in self.rollup_rows(rollup)])
@@ -0,0 +1,248 @@
+from pv_backends import BackendRegistry
+from pv_site import run_site
+from config_file import ConfigFile
+from cycle_metrics import CycleMetrics, MetricsServer
+from typing import Dict
+import multiprocessing
+import multiprocessing.connection
+import argparse
+import configparser
+import logging
+import re
+import signal
+import threading
+import time
+
+# Runs many sites on one gateway: one control loop (PVController) per site config, each in its own process, so the
+# sites share nothing but the host and spread over its cores. Crashed or hung sites are restarted with backoff.
+# The sites send their data (DATA_SINK = uplink) and the end of every cycle to the supervisor, which writes the data
+# of all sites through one batched uplink and publishes the health of every site as metrics. The site side is pv_site.
+
+SITE_NAME = re.compile(r'[A-Za-z0-9_\-]+')  # also the site tag in the line protocol, so nothing to escape
+
+
+class SupervisorConfig:
+    def __init__(self, config=None):
+        self.SITES: Dict[str, str] = {}  # site name -> config file of the site
+        self.RESTART_BACKOFF_MIN = 1.0  # seconds before a crashed site is started again. Doubles with every crash
+        self.RESTART_BACKOFF_MAX = 300.0  # seconds
+        self.RESTART_RESET_AFTER = 600.0  # seconds a site has to run until the backoff starts over
+        self.SITE_HANG_TIMEOUT = 300.0  # seconds without a finished cycle until a site is restarted. 0 -> never
+        self.METRICS_PORT = 0  # health of all sites for Prometheus. 0 -> disabled
+        self.METRICS_ADDRESS = '127.0.0.1'
+        self.uplink = ConfigFile()  # DATA_SINK and its settings for the data of all sites
+        self.uplink.DATA_SINK = 'none'
+
+        if config is not None:
+            if config.has_section('SUPERVISOR'):
+                section = config['SUPERVISOR']
+                self.RESTART_BACKOFF_MIN = section.getfloat('RESTART_BACKOFF_MIN', fallback=self.RESTART_BACKOFF_MIN)
+                self.RESTART_BACKOFF_MAX = section.getfloat('RESTART_BACKOFF_MAX', fallback=self.RESTART_BACKOFF_MAX)
+                self.RESTART_RESET_AFTER = section.getfloat('RESTART_RESET_AFTER', fallback=self.RESTART_RESET_AFTER)
+                self.SITE_HANG_TIMEOUT = section.getfloat('SITE_HANG_TIMEOUT', fallback=self.SITE_HANG_TIMEOUT)
+                self.METRICS_PORT = section.getint('METRICS_PORT', fallback=self.METRICS_PORT)
+                self.METRICS_ADDRESS = section.get('METRICS_ADDRESS', fallback=self.METRICS_ADDRESS)
+
+            self.SITES = {name: path for name, path in config['SITES'].items() if name not in config.defaults()}
+            for name in self.SITES:
+                if not SITE_NAME.fullmatch(name):
+                    raise ValueError('Site names may only have letters, digits, _ and -: ' + name)
+
+            if config.has_section('LOGGING'):
+                self.uplink.read_logging(config['LOGGING'])
+
+
+def load_supervisor_config(path: str) -> SupervisorConfig:
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        raise FileNotFoundError('Config file not found: ' + path)
+    return SupervisorConfig(config)
+
+
+# one site as the supervisor sees it. Times are time.monotonic() of the supervisor
+class SiteWorker:
+    def __init__(self, name: str, config_path: str):
+        self.name = name
+        self.config_path = config_path
+        self.process = None
+        self.connection = None  # supervisor end of the pipe
+        self.started = None
+        self.next_start = 0.0
+        self.backoff = 0.0  # seconds
+        self.restarts = 0
+        self.last_cycle = None  # when the last cycle was reported
+        self.cycle = {}  # last reported cycle: cycle_time, cycles, overruns, period
+
+    def health(self, now: float) -> dict:
+        up = self.process is not None and self.process.is_alive()
+        return dict(self.cycle, up=up, pid=self.process.pid if up else None, restarts=self.restarts,
+                    last_cycle_age=None if self.last_cycle is None else now - self.last_cycle)
+
+
+class Supervisor:
+    CHECK_EVERY = 1.0  # seconds between two checks of the site processes
+
+    def __init__(self, cfg: SupervisorConfig):
+        self.cfg = cfg
+        self.context = multiprocessing.get_context('spawn')
+        self.sites = {name: SiteWorker(name, path) for name, path in cfg.SITES.items()}
+        self.stop_event = threading.Event()
+
+        # the uplink gets whole lines. Its writer thread batches what all sites sent within INFLUX_BATCH_DELAY
+        self.backends = BackendRegistry()
+        if not hasattr(self.backends.load('data_sink', cfg.uplink.DATA_SINK), 'write_lines'):
+            raise ValueError('The uplink takes line protocol. DATA_SINK can not be ' + cfg.uplink.DATA_SINK)
+        self.uplink = self.backends.create('data_sink', cfg.uplink.DATA_SINK, cfg.uplink)
+
+        self.metrics = CycleMetrics()
+        self.metrics_server = None
+        if cfg.METRICS_PORT:
+            self.metrics_server = MetricsServer(self.metrics, cfg.METRICS_ADDRESS, cfg.METRICS_PORT)
+
+    # a pipe per site and not one shared queue: a site killed while sending can only break its own pipe
+    def start_site(self, site: SiteWorker, now: float):
+        site.connection, site_end = self.context.Pipe(duplex=False)
+        site.process = self.context.Process(target=run_site, args=(site.name, site.config_path, site_end)
+                                            , name='site-' + site.name, daemon=True)
+        site.process.start()
+        site_end.close()  # only the site writes. Gives an EOF once it is gone
+        site.started = now
+        site.last_cycle = None
+        site.cycle = {}
+        logging.warning('Site %s started with %s (pid %s)', site.name, site.config_path, site.process.pid)
+
+    # start what is due, notice crashed and hung sites
+    def check_sites(self, now: float):
+        for site in self.sites.values():
+            if site.process is None:
+                if now >= site.next_start:
+                    self.start_site(site, now)
+            elif not site.process.is_alive():
+                site.process.join()
+                # what it sent before it was gone still goes to the uplink. Then its pipe goes, before it gets a new one
+                while site.connection is not None and site.connection.poll() and self._receive_from(site):
+                    pass
+                if site.connection is not None:
+                    site.connection.close()
+                    site.connection = None
+                if now - site.started >= self.cfg.RESTART_RESET_AFTER:
+                    site.backoff = 0.0  # ran long enough. Not a crash loop
+                site.backoff = min(max(site.backoff * 2, self.cfg.RESTART_BACKOFF_MIN), self.cfg.RESTART_BACKOFF_MAX)
+                site.next_start = now + site.backoff
+                site.restarts += 1
+                logging.fatal('Site %s exited with code %s. Restart in %s s', site.name, site.process.exitcode
+                              , site.backoff)
+                site.process = None
+            elif self.cfg.SITE_HANG_TIMEOUT and now - (site.last_cycle if site.last_cycle is not None
+                                                       else site.started) > self.cfg.SITE_HANG_TIMEOUT:
+                logging.fatal('Site %s finished no cycle for %s s. Killing it', site.name, self.cfg.SITE_HANG_TIMEOUT)
+                site.process.kill()  # restarted by the next check
+
+    # False once the site is gone
+    def _receive_from(self, site: SiteWorker) -> bool:
+        try:
+            kind, payload = site.connection.recv()
+        except (EOFError, OSError):
+            site.connection.close()
+            site.connection = None
+            return False
+        if kind == 'lines':
+            self.uplink.write_lines(payload)
+        elif kind == 'cycle':
+            site.last_cycle = time.monotonic()
+            site.cycle = payload
+        return True
+
+    # whatever the sites send, for up to timeout seconds. Returns early if a site is gone, so it gets restarted
+    def receive(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while not self.stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            connections = {site.connection: site for site in self.sites.values() if site.connection is not None}
+            if not connections:
+                self.stop_event.wait(remaining)
+                return
+            for connection in multiprocessing.connection.wait(list(connections), remaining):
+                if not self._receive_from(connections[connection]):
+                    return
+
+    # site name -> up, pid, restarts, cycle_time, cycles, overruns, period and seconds since the last cycle
+    def get_health(self, now: float = None) -> Dict[str, dict]:
+        now = time.monotonic() if now is None else now
+        return {name: site.health(now) for name, site in self.sites.items()}
+
+    def update_metrics(self, now: float):
+        for name, health in self.get_health(now).items():
+            self.metrics.set_gauge('pv_site_up', int(health['up']), site=name)
+            self.metrics.set_counter('pv_site_restarts_total', health['restarts'], site=name)
+            # of the current process of the site. Start over at 0 after a restart, as counters do
+            for key, counter in (('cycles', 'pv_site_cycles_total'), ('overruns', 'pv_site_cycle_overruns_total')):
+                if health.get(key) is not None:
+                    self.metrics.set_counter(counter, health[key], site=name)
+            for key, gauge in (('cycle_time', 'pv_site_cycle_seconds'), ('period', 'pv_site_cycle_period_seconds')
+                               , ('last_cycle_age', 'pv_site_last_cycle_age_seconds')):
+                if health.get(key) is not None:
+                    self.metrics.set_gauge(gauge, health[key], site=name)
+
+    def run(self):
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        try:
+            while not self.stop_event.is_set():
+                now = time.monotonic()
+                self.check_sites(now)
+                self.update_metrics(now)
+                self.receive(self.CHECK_EVERY)
+        finally:
+            self.shutdown()
+
+    # from another thread or a signal handler. run() returns after shutting everything down
+    def stop(self):
+        self.stop_event.set()
+
+    def shutdown(self):
+        for site in self.sites.values():
+            if site.process is not None:
+                site.process.terminate()
+
+        # what the sites write while closing (e.g. the open rollups) still goes to the uplink
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            connections = {site.connection: site for site in self.sites.values() if site.connection is not None}
+            if not connections:
+                break
+            for connection in multiprocessing.connection.wait(list(connections), deadline - time.monotonic()):
+                self._receive_from(connections[connection])
+
+        for site in self.sites.values():
+            if site.process is not None:
+                site.process.join(max(0.0, deadline - time.monotonic()))
+                if site.process.is_alive():
+                    site.process.kill()
+                    site.process.join()
+            if site.connection is not None:
+                site.connection.close()
+                site.connection = None
+        self.uplink.close(timeout=5)
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PV charge control for many sites on one gateway')
+    parser.add_argument('--config', default='pv_supervisor_config.ini')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    supervisor = Supervisor(load_supervisor_config(args.config))
+    signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stop())
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass  # run() already shut the sites down
+
+
+if __name__ == "__main__":
+    main()
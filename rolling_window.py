@@ -0,0 +1,123 @@
+from array import array
+
+
+# A double ended queue of sample numbers in a preallocated ring. Keeps min/max of the window in O(1) (amortized)
+class _MonotonicQueue:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.items = array('q', bytes(8 * capacity))
+        self.start = 0
+        self.length = 0
+
+    def front(self) -> int:
+        return self.items[self.start]
+
+    def back(self) -> int:
+        return self.items[(self.start + self.length - 1) % self.capacity]
+
+    def pop_front(self):
+        self.start = (self.start + 1) % self.capacity
+        self.length -= 1
+
+    def pop_back(self):
+        self.length -= 1
+
+    def push_back(self, item: int):
+        self.items[(self.start + self.length) % self.capacity] = item
+        self.length += 1
+
+
+# The last `capacity` samples (timestamp, value) of a series. Everything is allocated up front, so adding a sample
+# never allocates. Mean, min, max and slope are kept up to date with every sample; percentiles are calculated on demand
+class RollingWindow:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.added = 0  # samples added ever. Sample n is in slot n % capacity
+        self.min_queue = _MonotonicQueue(capacity)
+        self.max_queue = _MonotonicQueue(capacity)
+
+        # sums for mean and slope. Times relative to time_base, so the squares stay small
+        self.time_base = 0.0
+        self.sum_t = 0.0
+        self.sum_v = 0.0
+        self.sum_tt = 0.0
+        self.sum_tv = 0.0
+
+    def __len__(self) -> int:
+        return min(self.added, self.capacity)
+
+    def add(self, timestamp: float, value: float):
+        n = self.added
+        slot = n % self.capacity
+        if n >= self.capacity:  # the oldest sample leaves the window
+            t = self.times[slot] - self.time_base
+            v = self.values[slot]
+            self.sum_t -= t
+            self.sum_v -= v
+            self.sum_tt -= t * t
+            self.sum_tv -= t * v
+            if self.min_queue.front() == n - self.capacity:
+                self.min_queue.pop_front()
+            if self.max_queue.front() == n - self.capacity:
+                self.max_queue.pop_front()
+        elif n == 0:
+            self.time_base = timestamp
+
+        self.times[slot] = timestamp
+        self.values[slot] = value
+        t = timestamp - self.time_base
+        self.sum_t += t
+        self.sum_v += value
+        self.sum_tt += t * t
+        self.sum_tv += t * value
+
+        while self.min_queue.length and self.values[self.min_queue.back() % self.capacity] >= value:
+            self.min_queue.pop_back()
+        self.min_queue.push_back(n)
+        while self.max_queue.length and self.values[self.max_queue.back() % self.capacity] <= value:
+            self.max_queue.pop_back()
+        self.max_queue.push_back(n)
+
+        self.added += 1
+        if self.added % self.capacity == 0:  # once per round: no rounding errors piling up in the sums
+            self._recalculate_sums()
+
+    def _recalculate_sums(self):
+        self.time_base = self.times[self.added % self.capacity]  # the oldest one
+        self.sum_t = self.sum_v = self.sum_tt = self.sum_tv = 0.0
+        for slot in range(len(self)):
+            t = self.times[slot] - self.time_base
+            v = self.values[slot]
+            self.sum_t += t
+            self.sum_v += v
+            self.sum_tt += t * t
+            self.sum_tv += t * v
+
+    def latest(self) -> float:
+        return self.values[(self.added - 1) % self.capacity] if self.added else 0.0
+
+    def mean(self) -> float:
+        return self.sum_v / len(self) if self.added else 0.0
+
+    def min(self) -> float:
+        return self.values[self.min_queue.front() % self.capacity] if self.added else 0.0
+
+    def max(self) -> float:
+        return self.values[self.max_queue.front() % self.capacity] if self.added else 0.0
+
+    # change of the value per second. Least squares over the window
+    def slope(self) -> float:
+        n = len(self)
+        denominator = n * self.sum_tt - self.sum_t * self.sum_t
+        if n < 2 or denominator <= 1e-12 * n * self.sum_tt:
+            return 0.0
+        return (n * self.sum_tv - self.sum_t * self.sum_v) / denominator
+
+    # q from 0 to 100. Sorts a copy of the window, so better not every cycle on big windows
+    def percentile(self, q: float) -> float:
+        if not self.added:
+            return 0.0
+        ordered = sorted(self.values[:len(self)])
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
@@ -0,0 +1,133 @@
+from concurrent.futures import Future
+import itertools
+import logging
+import queue
+import threading
+import time
+
+
+class BusPriority:
+    CURRENT_WRITE = 0  # max current changes. Get them out as fast as possible
+    CONTROL_WRITE = 1  # standby, failsafe, connect
+    STATE_READ = 2  # charging state, charge power
+    DIAGNOSTIC = 3  # PCB temperature, read back of holding registers
+
+    NAMES = {CURRENT_WRITE: 'current_write', CONTROL_WRITE: 'control_write', STATE_READ: 'state_read',
+             DIAGNOSTIC: 'diagnostic'}
+    # seconds a transaction may wait for the bus. Old diagnostics are not worth the bus time
+    DEADLINES = {DIAGNOSTIC: 10}
+
+
+class TransactionExpired(Exception):
+    pass
+
+
+# future for fn(result of future). fn runs where the future completes, usually on the bus thread,
+# so it sees the transactions of a bus in the order they went out
+def chain(future: Future, fn) -> Future:
+    chained = Future()
+
+    def done(completed: Future):
+        try:
+            chained.set_result(fn(completed.result()))
+        except Exception as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(done)
+    return chained
+
+
+# future for the list of results of all futures. Raises the first exception of them
+def gather(futures) -> Future:
+    gathered = Future()
+    lock = threading.Lock()
+    pending = [len(futures)]
+
+    def done(_):
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        try:
+            gathered.set_result([future.result() for future in futures])
+        except Exception as e:
+            gathered.set_exception(e)
+
+    for future in futures:
+        future.add_done_callback(done)
+    return gathered
+
+
+# Owns the RS485 bus: a single thread runs all transactions, most important first.
+# A transaction with a deadline that waited too long in the queue is not sent at all.
+class RTUBusScheduler:
+    def __init__(self, name: str = 'rtu-bus'):
+        self.name = name
+        self.transactions = queue.PriorityQueue()
+        self.sequence = itertools.count()  # keeps FIFO order within one priority
+        self.stats_lock = threading.Lock()
+        self.stats = {priority: {'transactions': 0, 'expired': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+                      for priority in BusPriority.NAMES}
+
+        self.worker = threading.Thread(target=self._worker_loop, name=name, daemon=True)
+        self.worker.start()
+
+    # deadline: max. seconds the transaction may wait for the bus. None -> wait forever
+    def submit(self, priority: int, deadline, fn, *args, **kwargs) -> Future:
+        future = Future()
+        expires = time.monotonic() + deadline if deadline is not None else None
+        self.transactions.put((priority, next(self.sequence), time.monotonic(), expires, future, fn, args, kwargs))
+        return future
+
+    # submit and wait for the result. Exceptions of the transaction are raised here
+    def call(self, priority: int, fn, *args, deadline=None, **kwargs):
+        return self.submit(priority, deadline, fn, *args, **kwargs).result()
+
+    def queue_depth(self) -> int:
+        return self.transactions.qsize()
+
+    def get_stats(self) -> dict:
+        with self.stats_lock:
+            stats = {'queue_depth': self.queue_depth()}
+            for priority, values in self.stats.items():
+                executed = values['transactions'] - values['expired']
+                stats[BusPriority.NAMES[priority]] = {
+                    'transactions': values['transactions'],
+                    'expired': values['expired'],
+                    'wait_avg': values['wait_total'] / executed if executed else 0.0,
+                    'wait_max': values['wait_max'],
+                }
+            return stats
+
+    def close(self):
+        self.transactions.put((len(BusPriority.NAMES), next(self.sequence), 0, None, None, None, None, None))
+        self.worker.join()
+
+    def _worker_loop(self):
+        while True:
+            priority, _, queued, expires, future, fn, args, kwargs = self.transactions.get()
+            if future is None:  # closed
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            now = time.monotonic()
+            with self.stats_lock:
+                stats = self.stats[priority]
+                stats['transactions'] += 1
+                if expires is not None and now > expires:
+                    stats['expired'] += 1
+                else:
+                    stats['wait_total'] += now - queued
+                    stats['wait_max'] = max(stats['wait_max'], now - queued)
+
+            if expires is not None and now > expires:
+                logging.error('%s: %s transaction expired after %.2f s in the queue'
+                              , self.name, BusPriority.NAMES[priority], now - queued)
+                future.set_exception(TransactionExpired())
+                continue
+
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
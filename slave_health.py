@@ -0,0 +1,81 @@
+import threading
+
+
+class BreakerState:
+    CLOSED = 0  # slave answers, transactions go out
+    OPEN = 1  # slave is dead, transactions are skipped
+    HALF_OPEN = 2  # one probe is out to see if it is back
+
+    NAMES = {CLOSED: 'closed', OPEN: 'open', HALF_OPEN: 'half_open'}
+
+
+# Response times and circuit breaker of one RTU slave.
+# The timeout follows the observed latency (mean + 4 x mean deviation, like TCP does it), so a dead slave costs
+# a fraction of a second instead of the full serial timeout. After `max_failures` failures in a row the slave
+# is skipped and only probed every `probe_every` seconds, so the other WBs on the bus keep their cadence.
+class SlaveHealth:
+    SMOOTHING = 0.125  # weight of a new latency sample
+    DEVIATION_SMOOTHING = 0.25
+
+    def __init__(self, timeout_min: float, timeout_max: float, max_failures: int, probe_every: float):
+        self.timeout_min = timeout_min
+        self.timeout_max = timeout_max
+        self.max_failures = max_failures
+        self.probe_every = probe_every
+        self.lock = threading.Lock()
+
+        self.state = BreakerState.CLOSED
+        self.latency = None  # seconds, smoothed
+        self.latency_deviation = 0.0
+        self.failures = 0  # in a row
+        self.next_probe = 0.0  # monotonic
+        self.skipped = 0  # transactions not sent because the breaker was open
+
+    # seconds to wait for an answer
+    def timeout(self) -> float:
+        with self.lock:
+            if self.latency is None or self.state != BreakerState.CLOSED:  # nothing known or probing: be patient
+                return self.timeout_max
+            return min(self.timeout_max, max(self.timeout_min, self.latency + 4 * self.latency_deviation))
+
+    # may a transaction go out now? In OPEN state one probe is let through every probe_every seconds
+    def allow_request(self, now: float) -> bool:
+        with self.lock:
+            if self.state == BreakerState.CLOSED:
+                return True
+            if self.state == BreakerState.OPEN and now >= self.next_probe:
+                self.state = BreakerState.HALF_OPEN
+                return True
+            self.skipped += 1
+            return False
+
+    # the slave answered (also with an exception response: it is alive)
+    def record_success(self, latency: float):
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+                self.latency_deviation = latency / 2
+            else:
+                self.latency_deviation += self.DEVIATION_SMOOTHING * (abs(latency - self.latency) - self.latency_deviation)
+                self.latency += self.SMOOTHING * (latency - self.latency)
+            self.failures = 0
+            self.state = BreakerState.CLOSED
+
+    def record_failure(self, now: float):
+        with self.lock:
+            self.failures += 1
+            if self.state == BreakerState.HALF_OPEN or self.failures >= self.max_failures:
+                self.state = BreakerState.OPEN
+                self.next_probe = now + self.probe_every
+
+    # the probe was not sent after all
+    def cancel_probe(self):
+        with self.lock:
+            if self.state == BreakerState.HALF_OPEN:
+                self.state = BreakerState.OPEN
+                self.next_probe = 0.0
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {'state': BreakerState.NAMES[self.state], 'latency': self.latency, 'failures': self.failures,
+                    'skipped': self.skipped}
@@ -1,11 +1,107 @@
-import RPi.GPIO as GPIO
+import logging
+import threading
 
+GPIO = None  # RPi.GPIO only exists on the Pi. Imported with the first GPIOSwitchInput
 
-class PV_Switch:
-    def __init__(self, gpio_number):
-        self.gpio_number = gpio_number
+
+# The switch on a GPIO pin. RPi.GPIO calls back on both edges, from its own thread
+class GPIOSwitchInput:
+    @staticmethod
+    def import_dependencies():
+        global GPIO
+        if GPIO is None:
+            import RPi.GPIO as GPIO
+
+    def __init__(self, cfg):
+        self.import_dependencies()
+        self.gpio_number = cfg.GPIO_SWITCH
         GPIO.setmode(GPIO.BCM)
-        GPIO.setup(gpio_number, GPIO.IN)
+        GPIO.setup(self.gpio_number, GPIO.IN)
 
-    def is_switch_set_to_pv_only(self):
+    def read(self) -> bool:
         return not GPIO.input(self.gpio_number)  # the switch is installed in a way that True -> no PV, False -> PV
+
+    def start(self, on_edge):
+        # no bouncetime here: RPi.GPIO drops the edges within it and could miss the one the contact settles on
+        GPIO.add_event_detect(self.gpio_number, GPIO.BOTH, callback=lambda channel: on_edge())
+
+    def stop(self):
+        GPIO.remove_event_detect(self.gpio_number)
+
+
+# The switch as a file: '0' -> grid charge, anything else -> PV only. Stand-in for tests and setups without GPIO.
+# A thread watches the file and reports every change like an edge
+class FileSwitchInput:
+    POLL_EVERY = 0.02  # seconds
+
+    def __init__(self, cfg):
+        self.path = cfg.SWITCH_FILE
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def read(self) -> bool:
+        try:
+            with open(self.path) as f:
+                return f.read().strip() != '0'
+        except OSError:
+            return True  # no file -> PV only, as without a switch
+
+    def _watch(self, on_edge, level: bool):
+        while not self.stop_event.wait(self.POLL_EVERY):
+            if self.read() != level:
+                level = not level
+                on_edge()
+
+    def start(self, on_edge):
+        self.thread = threading.Thread(target=self._watch, args=(on_edge, self.read()), name='switch-file', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+# PV only / grid charge switch with software debounce. Every edge (re)starts the debounce timer; the position counts
+# once the input was stable for `debounce` seconds. on_change(pv_only) is called right then, from the timer thread,
+# so the control loop can react without waiting for its next cycle
+class PV_Switch:
+    def __init__(self, switch_input, debounce: float, on_change=None):
+        self.switch_input = switch_input
+        self.debounce = debounce
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        self.timer = None
+        self.pv_only = switch_input.read()
+        self.changes = 0
+        switch_input.start(self._edge)
+
+    def _edge(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.debounce, self._settled)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _settled(self):
+        pv_only = self.switch_input.read()
+        with self.lock:
+            self.timer = None
+            if pv_only == self.pv_only:  # just bounced
+                return
+            self.pv_only = pv_only
+            self.changes += 1
+        logging.warning('Switch set to %s', 'PV only' if pv_only else 'grid charge')
+        if self.on_change is not None:
+            self.on_change(pv_only)
+
+    # the debounced position. If the input differs and no edge is pending (an edge got lost), debounce it now
+    def is_switch_set_to_pv_only(self) -> bool:
+        if self.timer is None and self.switch_input.read() != self.pv_only:
+            self._edge()
+        return self.pv_only
+
+    def stop(self):
+        self.switch_input.stop()
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
@@ -0,0 +1,101 @@
+from config_file import ConfigFile, load_config
+import configparser
+import pytest
+
+CONFIG = """
+[SOLARLOG]
+SOLARLOG_IP = 192.168.178.103
+SOLARLOG_PORT = 502
+SOLARLOG_SLAVEID = 1
+
+[WALLBOX]
+WB1_SLAVEID = 2
+WB2_SLAVEID = 1
+WB_RTU_DEVICE = /dev/serial0
+WB_SYSTEM_MAX_CURRENT = 16.0
+WB_MIN_CURRENT = 6.0
+PV_CHARGE_AMP_TOLERANCE = 0.0
+REDUCE_AVAILABLE_CURRENT_BY = 1.0
+KEEP_CHARGE_CURRENT_STABLE_FOR = 20
+
+[TIME]
+MIN_TIME_PV_CHARGE = 360
+MIN_WAIT_BEFORE_PV_ON = 60
+
+[LOGGING]
+SOLARLOG_WRITE_EVERY = 120
+INFLUX_DB_NAME = pv_modbus
+INFLUX_HOST = 127.0.0.1
+INFLUX_PORT = 8086
+INFLUX_USER = pv_modbus
+INFLUX_PWD = #
+
+[SWITCH]
+HAVE_SWITCH = no
+GPIO_SWITCH = 24
+"""
+
+
+def read_config(extra: str = '') -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read_string(CONFIG)
+    config.read_string(extra)
+    return config
+
+
+@pytest.mark.config
+def test_default_wallbox_group():
+    cfg = ConfigFile(read_config())
+    groups = cfg.get_wallbox_groups()
+    assert len(groups) == 1
+    assert groups[0].rtu_device == '/dev/serial0'
+    assert groups[0].slave_ids == [2, 1]
+
+
+@pytest.mark.config
+def test_wallbox_groups():
+    config = read_config("""
+[WB_GROUP garage]
+WB_RTU_DEVICE = /dev/ttyUSB0
+WB_SLAVEIDS = 1, 2, 3
+
+[WB_GROUP carport]
+WB_RTU_DEVICE = /dev/ttyUSB1
+WB_SLAVEIDS = 4,5
+""")
+    config['WALLBOX']['WB_GROUPS'] = 'garage, carport'
+    groups = ConfigFile(config).get_wallbox_groups()
+    assert [group.name for group in groups] == ['garage', 'carport']
+    assert [group.rtu_device for group in groups] == ['/dev/ttyUSB0', '/dev/ttyUSB1']
+    assert [group.slave_ids for group in groups] == [[1, 2, 3], [4, 5]]
+
+    config['WB_GROUP carport']['WB_SLAVEIDS'] = '3, 4'
+    with pytest.raises(ValueError):
+        ConfigFile(config).get_wallbox_groups()
+
+
+@pytest.mark.config
+def test_diff():
+    cfg = ConfigFile(read_config())
+    other = ConfigFile(read_config('[WALLBOX]\nWB_MIN_CURRENT = 8.0\nWB_GROUPS = garage\n'
+                                   '[WB_GROUP garage]\nWB_RTU_DEVICE = /dev/ttyUSB0\nWB_SLAVEIDS = 1, 2\n'))
+    assert cfg.diff(ConfigFile(read_config())) == {}
+    changes = cfg.diff(other)
+    assert changes['WB_MIN_CURRENT'] == (6.0, 8.0)
+    assert 'WB_GROUPS' in changes
+    assert 'WB_GROUPS' not in other.diff(ConfigFile(read_config('[WALLBOX]\nWB_GROUPS = garage\n'
+                                                                '[WB_GROUP garage]\nWB_RTU_DEVICE = /dev/ttyUSB0\n'
+                                                                'WB_SLAVEIDS = 1, 2\n')))
+
+
+@pytest.mark.config
+def test_rollup_resolutions():
+    assert ConfigFile(read_config('[LOGGING]\nROLLUP_RESOLUTIONS = 10, 300\n')).ROLLUP_RESOLUTIONS == [10, 300]
+    with pytest.raises(ValueError, match='ROLLUP_RESOLUTIONS'):
+        ConfigFile(read_config('[LOGGING]\nROLLUP_RESOLUTIONS = 10, 0\n'))
+
+
+@pytest.mark.config
+def test_load_config_without_file(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        load_config(str(tmp_path / 'missing.ini'))
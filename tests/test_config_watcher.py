@@ -0,0 +1,55 @@
+from config_watcher import ConfigWatcher
+import os
+import threading
+import time
+import pytest
+
+
+def wait_for(event: threading.Event, seconds: float = 2) -> bool:
+    return event.wait(seconds)
+
+
+@pytest.mark.config
+def test_write_in_place_is_noticed(tmp_path):
+    path = tmp_path / 'pv_modbus_config.ini'
+    path.write_text('[RUNTIME]\nCYCLE_TIME = 5\n')
+    changed = threading.Event()
+    watcher = ConfigWatcher(str(path), on_change=changed.set, poll_every=0.05)
+    assert watcher.fd is not None  # Linux: inotify
+    watcher.start()
+
+    (tmp_path / 'other.ini').write_text('x')  # other files in the directory do not count
+    time.sleep(0.1)
+    assert not watcher.pending()
+
+    path.write_text('[RUNTIME]\nCYCLE_TIME = 2\n')
+    assert wait_for(changed)
+    assert watcher.pending()
+    assert not watcher.pending()  # once per change
+    watcher.stop()
+
+
+@pytest.mark.config
+def test_rename_over_the_file_is_noticed(tmp_path):
+    path = tmp_path / 'pv_modbus_config.ini'
+    path.write_text('a')
+    changed = threading.Event()
+    watcher = ConfigWatcher(str(path), on_change=changed.set, poll_every=0.05)
+    watcher.start()
+    (tmp_path / 'pv_modbus_config.ini.tmp').write_text('b')
+    os.rename(tmp_path / 'pv_modbus_config.ini.tmp', path)  # like most editors save
+    assert wait_for(changed)
+    watcher.stop()
+
+
+@pytest.mark.config
+def test_mtime_without_inotify(tmp_path, mocker):
+    mocker.patch.object(ConfigWatcher, '_inotify', return_value=None)
+    path = tmp_path / 'pv_modbus_config.ini'
+    path.write_text('a')
+    changed = threading.Event()
+    watcher = ConfigWatcher(str(path), on_change=changed.set, poll_every=0.02)
+    watcher.start()
+    os.utime(path, ns=(0, 1000000000))
+    assert wait_for(changed)
+    watcher.stop()
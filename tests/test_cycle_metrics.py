@@ -0,0 +1,52 @@
+from cycle_metrics import CycleMetrics, MetricsServer
+import urllib.request
+import urllib.error
+import pytest
+
+
+@pytest.mark.metrics
+def test_stage_histogram_and_recent_quantiles():
+    metrics = CycleMetrics(window=3)
+    for seconds in (0.02, 0.2, 2.0, 0.04):
+        metrics.add_stage_time('allocation', seconds)
+        metrics.end_cycle(seconds)
+
+    text = metrics.render()
+    assert 'pv_cycle_stage_seconds_bucket{stage="allocation",le="0.025"} 1' in text
+    assert 'pv_cycle_stage_seconds_bucket{stage="allocation",le="0.25"} 3' in text
+    assert 'pv_cycle_stage_seconds_bucket{stage="allocation",le="+Inf"} 4' in text
+    assert 'pv_cycle_stage_seconds_count{stage="cycle"} 4' in text
+    # only the last 3 cycles are in the window
+    assert 'pv_cycle_stage_seconds_recent{stage="allocation",quantile="0.5"} 0.2' in text
+    assert 'pv_cycle_stage_seconds_recent{stage="allocation",quantile="1.0"} 2.0' in text
+
+
+@pytest.mark.metrics
+def test_stage_time_adds_up_within_a_cycle():
+    metrics = CycleMetrics()
+    metrics.add_stage_time('modbus_writes', 0.1)
+    metrics.add_stage_time('modbus_writes', 0.2)
+    metrics.end_cycle(1.0)
+    assert metrics.histograms['modbus_writes'].sum == pytest.approx(0.3)
+    assert metrics.histograms['modbus_writes'].count == 1
+
+
+@pytest.mark.metrics
+def test_metrics_endpoint():
+    metrics = CycleMetrics()
+    metrics.count_modbus_error(2, 'timeout')
+    metrics.set_gauge('pv_rtu_bus_queue_depth', 0, bus='/dev/serial0')
+    metrics.set_counter('pv_cycle_overruns_total', 3)
+    server = MetricsServer(metrics, '127.0.0.1', 0)
+    server.start()
+    try:
+        url = 'http://%s:%s' % server.address
+        text = urllib.request.urlopen(url + '/metrics', timeout=5).read().decode()
+        assert 'pv_modbus_errors_total{slave="2",kind="timeout"} 1' in text
+        assert 'pv_rtu_bus_queue_depth{bus="/dev/serial0"} 0' in text
+        assert '# TYPE pv_cycle_overruns_total counter\npv_cycle_overruns_total 3\n' in text
+        assert '# TYPE pv_rtu_bus_queue_depth gauge' in text
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + '/', timeout=5)
+    finally:
+        server.stop()
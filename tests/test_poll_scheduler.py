@@ -0,0 +1,59 @@
+from poll_scheduler import AdaptivePollScheduler
+from config_file import ConfigFile
+import threading
+import time
+import pytest
+
+
+@pytest.fixture
+def setup_scheduler():
+    cfg = ConfigFile()
+    cfg.CYCLE_TIME = 5
+    cfg.POLL_FAST = 2
+    cfg.POLL_SLOW = 30
+    cfg.POLL_PV_DELTA_FAST = 500
+    return AdaptivePollScheduler(cfg)
+
+
+@pytest.mark.scheduler
+def test_choose_period(setup_scheduler):
+    scheduler = setup_scheduler
+    assert scheduler.choose_period(charging_active=False, plug_connected=True, pv_output=3000) == 5
+    assert scheduler.choose_period(charging_active=True, plug_connected=True, pv_output=3000) == 2
+    assert scheduler.choose_period(charging_active=False, plug_connected=True, pv_output=2000) == 2  # cloud
+    assert scheduler.choose_period(charging_active=False, plug_connected=True, pv_output=1900) == 5
+    assert scheduler.choose_period(charging_active=False, plug_connected=False, pv_output=1900) == 30
+    assert scheduler.choose_period(charging_active=False, plug_connected=True, pv_output=0) == 2  # sunset jump
+    assert scheduler.choose_period(charging_active=False, plug_connected=True, pv_output=0) == 30  # night
+
+
+@pytest.mark.scheduler
+def test_deadlines_do_not_drift(setup_scheduler):
+    scheduler = setup_scheduler
+    scheduler.start()
+    start = scheduler.next_deadline
+
+    time.sleep(0.05)  # I/O of the cycle
+    delay = scheduler.schedule_next(0.2)
+    assert 0.1 < delay < 0.16
+    assert scheduler.next_deadline == pytest.approx(start + 0.2)
+    assert scheduler.overruns == 0
+
+
+@pytest.mark.scheduler
+def test_overrun(setup_scheduler):
+    scheduler = setup_scheduler
+    scheduler.start()
+    time.sleep(0.05)
+    assert scheduler.schedule_next(0.01) == 0
+    assert scheduler.get_stats()['overruns'] == 1
+    assert scheduler.get_stats()['overrun_time'] >= 0.04
+
+
+@pytest.mark.scheduler
+def test_wake(setup_scheduler):
+    scheduler = setup_scheduler
+    threading.Timer(0.05, scheduler.wake).start()
+    start = time.monotonic()
+    scheduler.wait(5)
+    assert time.monotonic() - start < 1
@@ -0,0 +1,75 @@
+from pv_backends import BackendRegistry, NullSink, BACKENDS
+from pv_database import PVDataSink
+from config_file import ConfigFile
+from pv_controller import PVController
+import os
+import subprocess
+import sys
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeBackend:
+    dependencies_imported = 0
+
+    @staticmethod
+    def import_dependencies():
+        FakeBackend.dependencies_imported += 1
+
+    def __init__(self, value):
+        self.value = value
+
+
+@pytest.mark.backends
+def test_registry_loads_once_and_times_each_backend():
+    FakeBackend.dependencies_imported = 0
+    registry = BackendRegistry({'data_sink': {'fake': __name__ + ':FakeBackend'}})
+
+    first = registry.create('data_sink', 'fake', 1)
+    second = registry.create('data_sink', 'fake', value=2)
+
+    assert isinstance(first, FakeBackend) and second.value == 2
+    assert FakeBackend.dependencies_imported == 1
+    import_time, init_time, count = registry.timings[('data_sink', 'fake')]
+    assert import_time >= 0 and init_time >= 0 and count == 2
+    assert 'data_sink' in registry.report().splitlines()[1]
+
+
+@pytest.mark.backends
+def test_unknown_backend_is_a_config_error():
+    with pytest.raises(ValueError, match='influx, none, sqlite'):
+        BackendRegistry().load('data_sink', 'mongo')
+
+
+@pytest.mark.backends
+def test_every_data_sink_implements_the_interface():
+    registry = BackendRegistry()
+    for name in BACKENDS['data_sink']:
+        sink_class = registry.load('data_sink', name)
+        assert issubclass(sink_class, PVDataSink) and not sink_class.__abstractmethods__, name
+
+
+@pytest.mark.backends
+def test_controller_without_db():
+    cfg = ConfigFile()
+    cfg.HAVE_SWITCH = False
+    cfg.SOLARLOG_IP = '127.0.0.1'
+    cfg.SOLARLOG_PORT = 502
+    cfg.SOLARLOG_SLAVEID = 1
+    cfg.WB1_SLAVEID = 1
+    cfg.WB2_SLAVEID = 2
+    cfg.WB_RTU_DEVICE = '/dev/serial0'
+    cfg.DATA_SINK = 'none'
+    controller = PVController(cfg)
+    assert isinstance(controller.database, NullSink)
+    assert ('wallbox_bus', 'modbus_rtu') in controller.backends.timings
+
+
+# a fresh interpreter, so nothing the other tests imported counts
+@pytest.mark.backends
+def test_no_backend_library_imported_with_the_controller():
+    code = ('import sys, pv_controller, main; '
+            'print(sorted(m for m in ("pymodbus", "influxdb", "RPi") if m in sys.modules))')
+    result = subprocess.run([sys.executable, '-c', code], cwd=REPO, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == '[]'
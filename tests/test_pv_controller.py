@@ -0,0 +1,320 @@
+from pv_modbus_solarlog import SolarLogData, SolarLogError
+from pv_modbus_wallbox import WBDef, HeidelbergWBTelemetry, HeidelbergWBReadInputs
+from config_file import ConfigFile, WallboxGroupConfig, load_config
+import pv_database
+from pv_controller import PVController
+from pv_controller_async import AsyncPVController
+from pymodbus.exceptions import ModbusIOException
+from concurrent.futures import Future
+import asyncio
+import datetime
+import time
+import pytest
+
+
+def make_telemetry(charge_state, charge_power):
+    read_input = HeidelbergWBReadInputs()
+    registers = [0] * read_input.telemetry.length
+    registers[read_input.chargingState.register - read_input.telemetry.register] = charge_state
+    registers[read_input.actualChargePower.register - read_input.telemetry.register] = charge_power
+    return HeidelbergWBTelemetry(registers, read_input.telemetry, read_input)
+
+
+# what submit_telemetry gives once the bus answered
+def answered(telemetry) -> Future:
+    read = Future()
+    read.set_result(telemetry)
+    return read
+
+
+@pytest.fixture
+def setup_config():
+    cfg = ConfigFile()
+    cfg.HAVE_SWITCH = False
+    cfg.SOLARLOG_IP = '127.0.0.1'
+    cfg.SOLARLOG_PORT = 502
+    cfg.SOLARLOG_SLAVEID = 1
+    cfg.WB1_SLAVEID = 2
+    cfg.WB2_SLAVEID = 1
+    cfg.WB_RTU_DEVICE = '/dev/serial0'
+    cfg.WB_SYSTEM_MAX_CURRENT = 16.0
+    cfg.WB_MIN_CURRENT = 6.0
+    cfg.PV_CHARGE_AMP_TOLERANCE = 0.0
+    cfg.REDUCE_AVAILABLE_CURRENT_BY = 0.0
+    cfg.KEEP_CHARGE_CURRENT_STABLE_FOR = -1
+    cfg.MIN_TIME_PV_CHARGE = 60
+    cfg.MIN_WAIT_BEFORE_PV_ON = -1
+    cfg.SOLARLOG_WRITE_EVERY = 0
+    return cfg
+
+
+@pytest.fixture
+def setup_controller(mocker, setup_config):
+    mocker.patch.object(pv_database, 'PVDatabase')
+    controller = PVController(setup_config)
+
+    solar_log_data = SolarLogData()
+    solar_log_data.actual_output = 6000
+    solar_log_data.actual_consumption = 500
+    mocker.patch.object(controller.solarlog_connection, 'get_snapshot', return_value=solar_log_data)
+    mocker.patch.object(controller.wallbox_connection, 'submit_telemetry'
+                        , return_value=answered(make_telemetry(WBDef.CHARGE_REQUEST1, 0)))
+    mocker.patch.object(controller.wallbox_connection, 'set_standby_control', return_value=True)
+    mocker.patch.object(controller.wallbox_connection, 'set_max_current', return_value=True)
+    return controller
+
+
+@pytest.mark.controller
+def test_run_cycle(setup_controller):
+    controller = setup_controller
+    assert [wb.slave_id for wb in controller.wallbox] == [1, 2]
+    controller.time_tools.time_start -= datetime.timedelta(seconds=61)
+
+    controller.run_cycle()
+
+    assert controller.solar_log_data.actual_output == 6000
+    assert controller.wallbox[0].charge_state == WBDef.CHARGE_REQUEST1
+    assert controller.wallbox[0].pv_charge_active
+    assert controller.wallbox[0].max_current_active == 7.9
+    assert not controller.wallbox[1].pv_charge_active
+    controller.database.write_solarlog_data_only_if_changed.assert_called_once()
+
+    text = controller.metrics.render()
+    for stage in ('wallbox_poll', 'solarlog_read', 'charge_power_poll', 'allocation', 'db_write', 'cycle'):
+        assert 'pv_cycle_stage_seconds_count{stage="%s"} 1' % stage in text
+    assert 'pv_output_watts{stat="max"} 6000.0' in text
+    assert controller.consumption_history.latest() == 500
+
+
+@pytest.mark.controller
+def test_rollups_instead_of_raw_points(mocker, setup_config):
+    mocker.patch.object(pv_database, 'PVDatabase')
+    setup_config.ROLLUP_RESOLUTIONS = [10]
+    controller = PVController(setup_config)
+    clock = mocker.patch('time.time', return_value=1700000001)
+    controller.write_database()
+    controller.write_database()
+    controller.database.write_rollups.assert_not_called()  # interval not over yet
+
+    clock.return_value = 1700000011
+    controller.write_database()
+    rollups = controller.database.write_rollups.call_args[0][0]
+    assert sorted(r.sensor for r in rollups) == ['solarlog1', 'wallbox1', 'wallbox2']
+    assert all(r.start == 1700000000 and r.count == 2 for r in rollups)
+    controller.database.write_solarlog_data_only_if_changed.assert_not_called()
+    controller.database.write_wallbox_data.assert_not_called()
+
+    # the interval of the last sample is not over yet, but must not get lost
+    controller.database.write_rollups.reset_mock()
+    controller.close(timeout=1)
+    rollups = controller.database.write_rollups.call_args[0][0]
+    assert all(r.start == 1700000010 and r.count == 1 for r in rollups) and len(rollups) == 3
+    controller.database.close.assert_called_once_with(1)
+
+
+@pytest.mark.controller
+def test_switch_flip_starts_the_next_cycle(mocker, setup_config, tmp_path):
+    mocker.patch.object(pv_database, 'PVDatabase')
+    setup_config.HAVE_SWITCH = True
+    setup_config.SWITCH_INPUT = 'file'
+    setup_config.SWITCH_FILE = str(tmp_path / 'switch')
+    controller = PVController(setup_config)
+    controller.poll_scheduler.start()
+
+    (tmp_path / 'switch').write_text('0')
+    start = time.monotonic()
+    controller.poll_scheduler.wait(5)
+    assert time.monotonic() - start < 1
+    assert not controller.pv_switch.is_switch_set_to_pv_only()
+    controller.pv_switch.stop()
+
+
+SITE_CONFIG = """
+[SOLARLOG]
+SOLARLOG_IP = 127.0.0.1
+SOLARLOG_PORT = 502
+SOLARLOG_SLAVEID = 1
+
+[WALLBOX]
+WB1_SLAVEID = 2
+WB2_SLAVEID = 1
+WB_RTU_DEVICE = /dev/serial0
+WB_SYSTEM_MAX_CURRENT = 16.0
+WB_MIN_CURRENT = 6.0
+PV_CHARGE_AMP_TOLERANCE = 0.0
+REDUCE_AVAILABLE_CURRENT_BY = 0.0
+KEEP_CHARGE_CURRENT_STABLE_FOR = 20
+
+[TIME]
+MIN_TIME_PV_CHARGE = 60
+
+[LOGGING]
+SOLARLOG_WRITE_EVERY = 120
+INFLUX_DB_NAME = pv_modbus
+INFLUX_HOST = 127.0.0.1
+INFLUX_PORT = 8086
+INFLUX_USER = pv_modbus
+INFLUX_PWD = #
+
+[SWITCH]
+HAVE_SWITCH = no
+GPIO_SWITCH = 24
+"""
+
+
+@pytest.mark.controller
+def test_reload_config_between_cycles(mocker, tmp_path):
+    mocker.patch.object(pv_database, 'PVDatabase')
+    path = tmp_path / 'pv_modbus_config.ini'
+    path.write_text(SITE_CONFIG)
+    controller = PVController(load_config(str(path)), str(path))
+    failsafe = mocker.patch.object(controller.wallbox_connection, 'set_failsafe_max_current', return_value=True)
+    activation = controller.wallbox[0].last_charge_activation
+    old_cfg = controller.cfg
+
+    path.write_text(SITE_CONFIG.replace('KEEP_CHARGE_CURRENT_STABLE_FOR = 20', 'KEEP_CHARGE_CURRENT_STABLE_FOR = 5')
+                    .replace('SOLARLOG_PORT = 502', 'SOLARLOG_PORT = 503'))
+    deadline = time.monotonic() + 2
+    while not controller.config_watcher.changed.is_set() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert controller.poll_scheduler.wake_event.is_set()  # the next cycle starts right away
+
+    controller.reload_config_if_changed()
+    assert controller.cfg is not old_cfg and old_cfg.KEEP_CHARGE_CURRENT_STABLE_FOR == 20
+    assert controller.cfg.KEEP_CHARGE_CURRENT_STABLE_FOR == 5
+    assert controller.wb_prox.cfg is controller.cfg and controller.poll_scheduler.cfg is controller.cfg
+    assert controller.cfg.SOLARLOG_PORT == 502  # needs a restart
+    assert controller.wallbox[0].last_charge_activation == activation
+    failsafe.assert_not_called()
+
+    path.write_text(SITE_CONFIG.replace('WB_SYSTEM_MAX_CURRENT = 16.0', 'WB_SYSTEM_MAX_CURRENT = 32.0'))
+    assert controller.reload_config() == {'WB_SYSTEM_MAX_CURRENT': (16.0, 32.0), 'KEEP_CHARGE_CURRENT_STABLE_FOR': (5, 20)}
+    failsafe.assert_any_call(1, 160)
+
+    path.write_text(SITE_CONFIG.replace('WB_MIN_CURRENT = 6.0', 'WB_MIN_CURRENT = six'))
+    assert controller.reload_config() == {}
+    assert controller.cfg.WB_MIN_CURRENT == 6.0
+    controller.config_watcher.stop()
+
+
+@pytest.mark.controller
+def test_async_cycle_overlaps_solarlog_and_wallboxes(setup_controller):
+    controller = setup_controller
+
+    def slow_snapshot():
+        time.sleep(0.2)
+        return SolarLogData()
+
+    def slow_telemetry(slave_id):
+        time.sleep(0.1)
+        return answered(make_telemetry(WBDef.CHARGE_NOPLUG1, 0))
+
+    controller.solarlog_connection.get_snapshot.side_effect = slow_snapshot
+    controller.wallbox_connection.submit_telemetry.side_effect = slow_telemetry
+
+    async def one_cycle():
+        runner = AsyncPVController(controller)
+        await runner.run_cycle()
+        await runner.db_task
+
+    start = time.monotonic()
+    asyncio.run(one_cycle())
+    assert time.monotonic() - start < 0.35  # 0.2 s SolarLog next to 2 x 0.1 s wallboxes
+    assert controller.wallbox[1].charge_state == WBDef.CHARGE_NOPLUG1
+
+
+@pytest.mark.controller
+def test_wallbox_groups_on_several_buses(mocker, setup_config):
+    mocker.patch.object(pv_database, 'PVDatabase')
+    setup_config.WB_GROUPS = [WallboxGroupConfig('garage', '/dev/ttyUSB0', [3, 1]),
+                              WallboxGroupConfig('carport', '/dev/ttyUSB1', [2])]
+    controller = PVController(setup_config)
+    assert [wb.slave_id for wb in controller.wallbox] == [1, 2, 3]
+    assert len(controller.wallbox_connection.connections) == 2
+    assert controller.wallbox_connection.connection_by_slave[2].wb_config.port == '/dev/ttyUSB1'
+
+    telemetry = mocker.patch.object(controller.wallbox_connection, 'submit_telemetry'
+                                    , return_value=answered(make_telemetry(WBDef.CHARGE_REQUEST1, 1000)))
+    mocker.patch.object(controller.wallbox_connection, 'set_standby_control', return_value=True)
+    controller.poll_wallboxes()
+    controller.poll_charging_power()
+    assert telemetry.call_count == 3
+    assert controller.already_used_charging_power_for_car == 3000
+
+
+@pytest.mark.controller
+def test_dead_wallbox_is_left_out(mocker, setup_config):
+    mocker.patch.object(pv_database, 'PVDatabase')
+    controller = PVController(setup_config)
+    connection = controller.wallbox_connection.connection_by_slave[1]
+    read_input = HeidelbergWBReadInputs()
+    charging = mocker.MagicMock(registers=[0] * read_input.telemetry.length)
+    charging.isError.return_value = False
+    charging.registers[read_input.chargingState.register - read_input.telemetry.register] = WBDef.CHARGE_REQUEST1
+    charging.registers[read_input.actualChargePower.register - read_input.telemetry.register] = 2000
+    dead = set()
+    mocker.patch.object(connection.wb_handle, 'read_input_registers'
+                        , side_effect=lambda register, count, unit: ModbusIOException('No response') if unit in dead
+                        else charging)
+    written = mocker.patch.object(connection.wb_handle, 'write_registers')
+    written.return_value.isError.return_value = False
+
+    controller.poll_wallboxes()
+    controller.poll_charging_power()
+    assert controller.already_used_charging_power_for_car == 4000
+    controller.wallbox[0].pv_charge_active = True
+    controller.wallbox[0].max_current_active = 8.7
+
+    # WB 1 is gone while it charges. Once the breaker is open it is not even asked anymore
+    dead.add(1)
+    for _ in range(4):
+        controller.poll_wallboxes()
+    assert connection.get_slave_health()[1]['state'] == 'open'
+    controller.poll_charging_power()
+    assert not controller.wallbox[0].available
+    assert controller.wallbox[0].actual_charge_power == 0
+    assert controller.already_used_charging_power_for_car == 2000
+
+    controller.solar_log_data = SolarLogData()
+    controller.solar_log_data.actual_output = 6000
+    controller.solar_log_data.actual_consumption = 2500
+    controller.allocate()
+    assert not controller.wallbox[0].pv_charge_active
+    assert controller.wallbox[0].max_current_active == 0
+    assert controller.wallbox[1].pv_charge_active
+
+    dead.clear()
+    connection.slave_health[1].next_probe = 0.0
+    controller.poll_wallboxes()
+    assert controller.wallbox[0].available
+    assert controller.wallbox[0].actual_charge_power == 2000
+
+
+@pytest.mark.controller
+def test_allocate_with_pv_forecast(mocker, setup_config):
+    mocker.patch.object(pv_database, 'PVDatabase')
+    setup_config.PV_FORECAST = True
+    controller = PVController(setup_config)
+    for t, pv_output in ((0, 9000), (5, 8000), (10, 7000)):  # clouds coming
+        solar_log_data = SolarLogData()
+        solar_log_data.actual_output = pv_output
+        solar_log_data.actual_consumption = 500
+        controller.pv_forecast.add(t, solar_log_data)
+    controller.solar_log_data = solar_log_data
+
+    controller.allocate()
+    assert controller.wb_prox.available_power == 0  # -200 W/s for 120 s, no PV left to charge with
+    assert not controller.wallbox[0].pv_charge_active
+
+
+@pytest.mark.controller
+def test_solarlog_error_keeps_last_data(setup_controller):
+    controller = setup_controller
+    controller.run_cycle()
+    controller.solarlog_connection.get_snapshot.return_value = SolarLogError(SolarLogError.TIMEOUT)
+    controller.wallbox[0].max_current_active = 0
+
+    controller.run_cycle()
+    assert controller.solar_log_data.actual_output == 6000  # the stale one
+    assert controller.wallbox[0].max_current_active == 7.9  # allocation still ran
+    assert controller.metrics.modbus_errors[('solarlog', 'timeout')] == 1
@@ -0,0 +1,156 @@
+from pv_modbus_solarlog import SolarLogData
+from wallbox_system_state import WBSystemState
+from config_file import ConfigFile
+import pv_database
+from pv_database import PVDatabase
+from pv_rollup import RollupAggregator
+import time
+import pytest
+
+
+@pytest.fixture
+def setup_config():
+    cfg = ConfigFile()
+    cfg.INFLUX_HOST = '127.0.0.1'
+    cfg.INFLUX_PORT = 8086
+    cfg.INFLUX_USER = 'pv_modbus'
+    cfg.INFLUX_PWD = '#'
+    cfg.INFLUX_DB_NAME = 'pv_modbus'
+    cfg.INFLUX_BATCH_DELAY = 0.05
+    return cfg
+
+
+@pytest.fixture
+def setup_database(mocker, setup_config):
+    mocker.patch.object(pv_database, 'InfluxDBClient')
+    database = PVDatabase(setup_config)
+    yield database
+    database.close(timeout=1)
+
+
+@pytest.mark.database
+def test_format_lines():
+    solar_log_data = SolarLogData()
+    solar_log_data.actual_output = 6000
+    solar_log_data.actual_consumption = 4500
+    assert PVDatabase.format_solarlog_line(solar_log_data, 1700000000) == \
+        'solarlog,sensor=solarlog1 pv_output=6000,consumption=4500 1700000000'
+
+    wb = WBSystemState(2)
+    wb.pv_charge_active = True
+    wb.max_current_active = 8
+    assert PVDatabase.format_wallbox_line(wb, 1700000000) == \
+        'wallbox,sensor=wallbox2 charge_state=0,pv_charge_active=True,grid_charge_active=False' \
+        ',max_current_active=8,actual_current_active=0 1700000000'
+
+
+@pytest.mark.database
+def test_one_request_per_cycle(setup_database):
+    database = setup_database
+    database.write_solarlog_data(SolarLogData())
+    database.write_wallbox_data([WBSystemState(1), WBSystemState(2), WBSystemState(3)])
+    database.close(timeout=1)
+
+    assert database.influx.write.call_count == 1
+    lines = database.influx.write.call_args[0][0]
+    assert len(lines) == 4
+    assert lines[0].startswith('solarlog,')
+    assert lines[3].startswith('wallbox,sensor=wallbox3 ')
+
+
+@pytest.mark.database
+def test_full_queue_does_not_update_cache(mocker, setup_config):
+    mocker.patch.object(pv_database, 'InfluxDBClient')
+    setup_config.INFLUX_QUEUE_SIZE = 1
+    database = PVDatabase(setup_config)
+    database.close(timeout=1)  # writer gone, nothing gets drained anymore
+
+    database.write_solarlog_data(SolarLogData())
+    assert database.solarlog_snapshot == (0, 0)
+
+    solar_log_data = SolarLogData()
+    solar_log_data.actual_output = 100
+    database.write_solarlog_data_only_if_changed(solar_log_data)  # queue full -> dropped
+    assert database.solarlog_snapshot == (0, 0)
+
+
+@pytest.mark.database
+def test_spool_while_db_is_gone(mocker, setup_config, tmp_path):
+    influx_client = mocker.patch.object(pv_database, 'InfluxDBClient')
+    setup_config.SPOOL_DIR = str(tmp_path)
+
+    influx_client.return_value.write.side_effect = Exception('gone')
+    database = PVDatabase(setup_config)
+    database.write_solarlog_data(SolarLogData())
+    database.write_wallbox_data([WBSystemState(1)])
+    database.close(timeout=1)
+    assert not database.spool.is_empty()
+
+    # DB is back
+    influx_client.return_value = mocker.MagicMock()
+    database = PVDatabase(setup_config)
+    database.write_solarlog_data(SolarLogData())
+    for _ in range(100):
+        if database.spool.is_empty():
+            break
+        time.sleep(0.01)
+    database.close(timeout=1)
+    assert database.spool.is_empty()
+    assert database.influx.write.call_count == 2
+    assert len(database.influx.write.call_args_list[1][0][0]) == 2  # the spooled ones
+
+
+@pytest.mark.database
+def test_wallbox_written_only_if_changed(mocker, setup_database):
+    database = setup_database
+    write = mocker.spy(database, 'write_wallbox_data')
+    wallbox = [WBSystemState(1), WBSystemState(2)]
+    database.write_wallbox_data_only_if_changed(wallbox)
+    database.write_wallbox_data_only_if_changed(wallbox)
+    assert write.call_count == 1
+
+    wallbox[1].max_current_active = 8  # the cache is no copy of the WBs, it still has to see this as a change
+    database.write_wallbox_data_only_if_changed(wallbox)
+    assert write.call_count == 2
+    assert database.wallbox_snapshot[1] == (0, False, False, 8, 0)
+
+
+@pytest.mark.database
+def test_rollups_as_lines(setup_database):
+    database = setup_database
+    aggregator = RollupAggregator([10])
+    wb = WBSystemState(2)
+    for t, current in ((100, 6), (105, 8)):
+        wb.max_current_active = current
+        aggregator.add_wallbox(t, [wb])
+    database.write_rollups(aggregator.collect(110))
+    database.close(timeout=1)
+
+    assert database.influx.write.call_args[0][0] == [
+        'wallbox_10s,sensor=wallbox2 charge_state_min=0,charge_state_max=0,charge_state_mean=0.0,charge_state_last=0'
+        ',pv_charge_active_min=0,pv_charge_active_max=0,pv_charge_active_mean=0.0,pv_charge_active_last=0'
+        ',grid_charge_active_min=0,grid_charge_active_max=0,grid_charge_active_mean=0.0,grid_charge_active_last=0'
+        ',max_current_active_min=6,max_current_active_max=8,max_current_active_mean=7.0,max_current_active_last=8'
+        ',actual_current_active_min=0,actual_current_active_max=0,actual_current_active_mean=0.0'
+        ',actual_current_active_last=0,samples=2 100']
+
+
+@pytest.mark.database
+def test_close_is_bounded_with_a_stuck_writer(mocker, setup_config):
+    influx_client = mocker.patch.object(pv_database, 'InfluxDBClient')
+    setup_config.INFLUX_QUEUE_SIZE = 1
+    setup_config.INFLUX_BATCH_DELAY = 0
+    stuck = pv_database.threading.Event()
+    influx_client.return_value.write.side_effect = lambda *args, **kwargs: stuck.wait()
+    database = PVDatabase(setup_config)
+    database.write_solarlog_data(SolarLogData())  # the writer hangs on this one
+    for _ in range(100):
+        if database.influx.write.called:
+            break
+        time.sleep(0.01)
+    database.write_solarlog_data(SolarLogData())  # queue full
+
+    start = time.monotonic()
+    database.close(timeout=0.2)
+    assert time.monotonic() - start < 1
+    stuck.set()
@@ -0,0 +1,56 @@
+from pv_modbus_solarlog import SolarLogData
+from config_file import ConfigFile
+from pv_forecast import PVForecast
+import pytest
+
+
+def solar_log(pv_output: int, last_update_time: int = 0) -> SolarLogData:
+    data = SolarLogData()
+    data.actual_output = pv_output
+    data.actual_consumption = 500
+    data.last_update_time = last_update_time
+    return data
+
+
+@pytest.fixture
+def setup_forecast():
+    cfg = ConfigFile()
+    cfg.PV_FORECAST_HORIZON = 60
+    cfg.PV_FORECAST_SMOOTHING = 1.0  # level is the last sample, makes the numbers easy
+    cfg.PV_FORECAST_WINDOW = 4
+    return PVForecast(cfg)
+
+
+@pytest.mark.forecast
+def test_constant_output(setup_forecast):
+    forecast = setup_forecast
+    assert forecast.predict() == 0  # nothing seen yet
+    for t in range(0, 50, 10):
+        forecast.add(t, solar_log(5000))
+    assert forecast.trend() == 0.0
+    assert forecast.predict() == 5000
+
+
+@pytest.mark.forecast
+def test_trend_over_window(setup_forecast):
+    forecast = setup_forecast
+    forecast.add(0, solar_log(9000))  # drops out of the window
+    for t, pv_output in ((10, 6000), (20, 5000), (30, 4000), (40, 3000)):
+        forecast.add(t, solar_log(pv_output))
+    assert forecast.trend() == pytest.approx(-100.0)
+    assert forecast.predict(20) == 1000
+    assert forecast.predict() == 0  # never below 0
+
+    data = forecast.forecast_data(solar_log(3000))
+    assert data.actual_output == 0
+    assert data.actual_consumption == 500
+
+
+@pytest.mark.forecast
+def test_same_solarlog_update_counted_once(setup_forecast):
+    forecast = setup_forecast
+    forecast.add(0, solar_log(5000, 1700000000))
+    forecast.add(5, solar_log(5000, 1700000000))
+    assert len(forecast.samples) == 1
+    forecast.add(10, solar_log(5500, 1700000015))
+    assert len(forecast.samples) == 2
@@ -0,0 +1,92 @@
+import pv_modbus_solarlog
+from pv_modbus_solarlog import ModbusTCPSolarLog, ModbusTCPConfig, SolarLogReadInputs, SolarLogError, SolarLogState
+from pymodbus.exceptions import ModbusIOException, ConnectionException
+import pytest
+
+
+class FakeRead:
+    def __init__(self, registers, error=False):
+        self.registers = registers
+        self.error = error
+
+    def isError(self):
+        return self.error
+
+
+@pytest.fixture
+def setup_solarlog(mocker):
+    solarlog = ModbusTCPSolarLog(ModbusTCPConfig('127.0.0.1', 502, slave_id=1, backoff_min=1, backoff_max=4)
+                                 , SolarLogReadInputs())
+    mocker.patch.object(solarlog.solar_log_handle, 'connect', return_value=True)
+    solarlog.solar_log_handle.socket = mocker.MagicMock()
+    return solarlog
+
+
+@pytest.mark.solarlog
+def test_get_snapshot_with_one_request(setup_solarlog, mocker):
+    registers = [0] * 20
+    registers[0:2] = [0x5E80, 0x6553]  # 1699962496
+    registers[2:4] = [0x1170, 0x0001]  # P_AC 70000 W
+    registers[4:6] = [6200, 0]  # P_DC
+    registers[18:20] = [4500, 0]  # P_AC_Consumption
+    read = mocker.patch.object(setup_solarlog.solar_log_handle, 'read_input_registers', return_value=FakeRead(registers))
+
+    data = setup_solarlog.get_snapshot()
+
+    read.assert_called_once_with(3500, 20, unit=1)
+    assert data.last_update_time == 1699962496
+    assert data.actual_output == 70000
+    assert data.actual_output_dc == 6200
+    assert data.actual_consumption == 4500
+
+
+@pytest.mark.solarlog
+def test_get_snapshot_error(setup_solarlog, mocker):
+    mocker.patch.object(setup_solarlog.solar_log_handle, 'read_input_registers', return_value=FakeRead([], error=True))
+    result = setup_solarlog.get_snapshot()
+    assert not result
+    assert result.kind == SolarLogError.EXCEPTION_RESPONSE
+    assert setup_solarlog.state == SolarLogState.CONNECTED  # it did answer
+
+
+@pytest.mark.solarlog
+def test_reconnect_with_backoff(setup_solarlog, mocker):
+    solarlog = setup_solarlog
+    monotonic = mocker.patch('pv_modbus_solarlog.time.monotonic', return_value=100.0)
+    mocker.patch('pv_modbus_solarlog.random.uniform', return_value=1.0)
+    read = mocker.patch.object(solarlog.solar_log_handle, 'read_input_registers'
+                               , side_effect=ConnectionException('reset by peer'))
+
+    assert solarlog.get_snapshot().kind == SolarLogError.CONNECTION
+    assert solarlog.state == SolarLogState.DISCONNECTED
+    assert solarlog.next_attempt == 101.0
+
+    assert solarlog.get_snapshot().kind == SolarLogError.BACKOFF  # not even tried
+    assert read.call_count == 1
+
+    monotonic.return_value = 101.5
+    read.side_effect = None
+    read.return_value = ModbusIOException('No response')
+    assert solarlog.get_snapshot().kind == SolarLogError.TIMEOUT
+    assert solarlog.next_attempt == 103.5  # doubled
+
+    for _ in range(3):
+        monotonic.return_value = solarlog.next_attempt
+        solarlog.get_snapshot()
+    assert solarlog.next_attempt - monotonic.return_value == 4.0  # backoff_max
+
+    monotonic.return_value = solarlog.next_attempt
+    read.return_value = FakeRead([0] * 20)
+    assert solarlog.get_snapshot().actual_output == 0
+    assert solarlog.state == SolarLogState.CONNECTED
+    assert solarlog.failures == 0
+
+
+@pytest.mark.solarlog
+def test_client_patched_before_the_first_instance(mocker):
+    mocker.patch.object(pv_modbus_solarlog, 'ModbusIOException', None)  # nothing imported yet
+    client = mocker.patch.object(pv_modbus_solarlog, 'ModbusTcpClient')
+    client.return_value.read_input_registers.return_value = FakeRead([0] * 20)
+
+    solarlog = ModbusTCPSolarLog(ModbusTCPConfig('127.0.0.1', 502, slave_id=1), SolarLogReadInputs())
+    assert solarlog.get_snapshot().actual_output == 0
@@ -0,0 +1,209 @@
+from wallbox_system_state import WBSystemState
+import pv_modbus_wallbox
+from pv_modbus_wallbox import WBDef
+from cycle_metrics import CycleMetrics
+from pymodbus.exceptions import ModbusIOException
+import threading
+import time
+import pytest
+
+
+class FakeResponse:
+    def __init__(self, registers=None, error=False):
+        self.registers = registers
+        self.error = error
+
+    def isError(self):
+        return self.error
+
+
+@pytest.fixture
+def setup_wallbox_connection():
+    config_wb_heidelberg = pv_modbus_wallbox.ModbusRTUConfig('rtu', '/dev/serial0', timeout=3, baudrate=19200,
+                                                             bytesize=8,
+                                                             parity='E',
+                                                             stopbits=1,
+                                                             strict=False)
+    return pv_modbus_wallbox.ModbusRTUHeidelbergWB(wb_config=config_wb_heidelberg
+                                                   , wb_read_input=pv_modbus_wallbox.HeidelbergWBReadInputs()
+                                                   , wb_read_holding=pv_modbus_wallbox.HeidelbergWBReadHolding()
+                                                   , wb_write_holding=pv_modbus_wallbox.HeidelbergWBWriteHolding())
+
+
+@pytest.mark.wallbox
+def test_get_telemetry_with_one_request(setup_wallbox_connection, mocker):
+    #            4    5  6    7    8    9     10   11   12   13 14    15 16     17 18
+    registers = [264, 7, 160, 159, 161, 0xFF6F, 230, 231, 229, 1, 11000, 1, 1000, 2, 2000]
+    read = mocker.patch.object(setup_wallbox_connection.wb_handle, 'read_input_registers'
+                               , return_value=FakeResponse(registers))
+
+    telemetry = setup_wallbox_connection.get_telemetry(3)
+    read.assert_called_once_with(4, 15, unit=3)
+
+    wb = WBSystemState(3)
+    wb.update_from_telemetry(telemetry)
+    assert wb.layout_version == 264
+    assert wb.charge_state == WBDef.CHARGE_REQUEST2
+    assert (wb.current_l1, wb.current_l2, wb.current_l3) == (16.0, 15.9, 16.1)
+    assert wb.pcb_temperature == -14.5
+    assert (wb.voltage_l1, wb.voltage_l2, wb.voltage_l3) == (230, 231, 229)
+    assert wb.extern_lock_state == 1
+    assert wb.actual_charge_power == 11000
+    assert wb.energy_since_power_on == 66536
+    assert wb.energy_since_installation == 133072
+
+
+@pytest.mark.wallbox
+def test_client_patched_before_the_first_instance(mocker):
+    mocker.patch.object(pv_modbus_wallbox, 'ModbusIOException', None)  # nothing imported yet
+    client = mocker.patch.object(pv_modbus_wallbox, 'ModbusSerialClient')
+    client.return_value.read_input_registers.return_value = FakeResponse([WBDef.CHARGE_REQUEST2])
+
+    connection = pv_modbus_wallbox.ModbusRTUHeidelbergWB(pv_modbus_wallbox.ModbusRTUConfig('rtu', '/dev/serial0', 3
+                                                                                           , 19200, 8, 'E', 1, False)
+                                                         , pv_modbus_wallbox.HeidelbergWBReadInputs()
+                                                         , pv_modbus_wallbox.HeidelbergWBReadHolding()
+                                                         , pv_modbus_wallbox.HeidelbergWBWriteHolding())
+    assert connection.get_charging_state(3) == WBDef.CHARGE_REQUEST2
+
+
+@pytest.mark.wallbox
+def test_error_after_the_transaction_reaches_the_caller(setup_wallbox_connection, mocker):
+    mocker.patch.object(setup_wallbox_connection.wb_handle, 'read_input_registers', side_effect=IOError('no response'))
+    mocker.patch.object(setup_wallbox_connection, '_count_error', side_effect=RuntimeError('metrics broken'))
+    with pytest.raises(RuntimeError):  # and does not wait forever
+        setup_wallbox_connection.get_telemetry(3)
+
+
+@pytest.mark.wallbox
+def test_get_telemetry_error(setup_wallbox_connection, mocker):
+    mocker.patch.object(setup_wallbox_connection.wb_handle, 'read_input_registers'
+                        , return_value=FakeResponse(error=True))
+    assert setup_wallbox_connection.get_telemetry(3) is False
+
+
+@pytest.mark.wallbox
+def test_unchanged_writes_are_skipped(setup_wallbox_connection, mocker):
+    connection = setup_wallbox_connection
+    write = mocker.patch.object(connection.wb_handle, 'write_registers', return_value=FakeResponse())
+
+    assert connection.set_max_current(1, 80)
+    assert connection.set_max_current(1, 80)
+    assert connection.set_max_current(2, 80)
+    assert write.call_count == 2
+
+    assert connection.set_max_current(1, 60)
+    assert write.call_count == 3
+
+    # comm error: we do not know anymore what the WB has
+    write.return_value = FakeResponse(error=True)
+    assert not connection.set_max_current(1, 80)
+    write.return_value = FakeResponse()
+    assert connection.set_max_current(1, 60)
+    assert write.call_count == 5
+
+
+@pytest.mark.wallbox
+def test_verify_holding_registers(setup_wallbox_connection, mocker):
+    connection = setup_wallbox_connection
+    write = mocker.patch.object(connection.wb_handle, 'write_registers', return_value=FakeResponse())
+    read = mocker.patch.object(connection.wb_handle, 'read_holding_registers')
+    connection.set_standby_control(1, WBDef.DISABLE_STANDBY)
+    connection.set_max_current(1, 80)
+
+    read.side_effect = [FakeResponse([WBDef.DISABLE_STANDBY]), FakeResponse([80, 0])]
+    assert connection.verify_holding_registers(1)
+
+    # WB was restarted and forgot the max current
+    read.side_effect = [FakeResponse([WBDef.DISABLE_STANDBY]), FakeResponse([160, 0])]
+    assert not connection.verify_holding_registers(1)
+    assert connection.set_max_current(1, 80)
+    assert write.call_count == 3
+
+
+@pytest.mark.wallbox
+def test_modbus_errors_counted_per_slave(setup_wallbox_connection, mocker):
+    metrics = CycleMetrics()
+    setup_wallbox_connection.set_metrics(metrics)
+    mocker.patch.object(setup_wallbox_connection.wb_handle, 'read_input_registers'
+                        , return_value=ModbusIOException('No response'))
+    mocker.patch.object(setup_wallbox_connection.wb_handle, 'write_registers', return_value=FakeResponse(error=True))
+
+    assert setup_wallbox_connection.get_telemetry(3) is False
+    assert setup_wallbox_connection.set_max_current(4, 60) is False
+
+    assert metrics.modbus_errors == {('3', 'timeout'): 1, ('4', 'error'): 1}
+    assert metrics.current_cycle['modbus_writes'] > 0
+
+
+@pytest.mark.wallbox
+def test_dead_slave_is_skipped(setup_wallbox_connection, mocker):
+    connection = setup_wallbox_connection
+    read = mocker.patch.object(connection.wb_handle, 'read_input_registers'
+                               , return_value=ModbusIOException('No response'))
+    for _ in range(3):
+        assert connection.get_telemetry(5) is False
+    assert connection.get_slave_health()[5]['state'] == 'open'
+
+    assert connection.get_telemetry(5) is False
+    assert read.call_count == 3  # not sent anymore
+
+    connection.slave_health[5].next_probe = 0.0  # probe time has come, and the WB is back
+    read.return_value = FakeResponse([0] * 15)
+    assert connection.get_telemetry(5) is not False
+    assert read.call_count == 4
+    assert connection.get_slave_health()[5]['state'] == 'closed'
+
+
+@pytest.mark.wallbox
+def test_timeout_per_slave(setup_wallbox_connection, mocker):
+    connection = setup_wallbox_connection
+    timeouts = []
+
+    def read_input_registers(register, count, unit):
+        timeouts.append(connection.wb_handle.timeout)
+        return FakeResponse([0] * count)
+
+    mocker.patch.object(connection.wb_handle, 'read_input_registers', side_effect=read_input_registers)
+    for _ in range(3):
+        connection.get_telemetry(1)
+    assert timeouts[0] == 3  # nothing known yet
+    assert timeouts[-1] == 0.2  # answers fast -> timeout_min
+    assert connection.get_slave_health()[1]['timeout'] == 0.2
+
+
+@pytest.mark.wallbox
+def test_current_write_overtakes_queued_reads(setup_wallbox_connection, mocker):
+    connection = setup_wallbox_connection
+    executed = []
+    release = threading.Event()
+
+    def read_holding_registers(register, count, unit):
+        executed.append(('read', unit))
+        release.wait()  # the first one keeps the bus busy
+        return FakeResponse([0] * count)
+
+    def write_registers(register, values, unit):
+        executed.append(('write', unit))
+        return FakeResponse()
+
+    mocker.patch.object(connection.wb_handle, 'read_holding_registers', side_effect=read_holding_registers)
+    mocker.patch.object(connection.wb_handle, 'write_registers', side_effect=write_registers)
+
+    # one thread queues the diagnostics of the cycle, another one changes a max current meanwhile
+    verifies = [connection.submit_verify_holding_registers(slave_id) for slave_id in (1, 2, 3)]
+    written = []
+    writer = threading.Thread(target=lambda: written.append(connection.set_max_current(4, 80)))
+    writer.start()
+    for _ in range(100):
+        if connection.get_bus_stats()['queue_depth'] == 6:  # 5 reads and the write wait for the bus
+            break
+        time.sleep(0.01)
+    assert connection.get_bus_stats()['queue_depth'] == 6
+
+    release.set()
+    writer.join(timeout=1)
+    assert all(verify.result(timeout=1) for verify in verifies)
+    assert written and written[0]
+    assert executed[:2] == [('read', 1), ('write', 4)]
+    assert len(executed) == 7
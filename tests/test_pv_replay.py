@@ -0,0 +1,107 @@
+from pv_modbus_solarlog import SolarLogData
+from pv_modbus_wallbox import WBDef
+from wallbox_system_state import WBSystemState
+from pv_database import PVDatabase
+from config_file import ConfigFile
+from wallbox_proxy import WallboxProxy
+from pv_replay import ReplayTrace, replay, replay_many, parse_overrides
+import pytest
+
+START = 1700000000
+
+
+@pytest.fixture
+def setup_config():
+    cfg = ConfigFile()
+    cfg.WB1_SLAVEID = 1
+    cfg.WB2_SLAVEID = 2
+    cfg.WB_RTU_DEVICE = '/dev/serial0'
+    cfg.WB_SYSTEM_MAX_CURRENT = 16.0
+    cfg.WB_MIN_CURRENT = 6.0
+    cfg.PV_CHARGE_AMP_TOLERANCE = 2.0
+    cfg.REDUCE_AVAILABLE_CURRENT_BY = 1.0
+    cfg.MIN_TIME_PV_CHARGE = 60
+    cfg.MIN_WAIT_BEFORE_PV_ON = 60
+    cfg.KEEP_CHARGE_CURRENT_STABLE_FOR = 20
+    return cfg
+
+
+# one hour of sun with clouds every 10 min, WB 1 plugged in, WB 2 not
+@pytest.fixture
+def setup_trace():
+    trace = ReplayTrace()
+    for minute in range(61):
+        trace.add_solarlog(START + minute * 60, 2000 if minute % 10 < 3 else 8000, 500)
+    trace.add_wallbox(START, 1, WBDef.CHARGE_REQUEST1, 0)
+    trace.add_wallbox(START, 2, WBDef.CHARGE_NOPLUG1, 0)
+    trace.sort()
+    return trace
+
+
+@pytest.mark.replay
+def test_replay(setup_config, setup_trace):
+    result = replay(setup_config, setup_trace)
+    assert result['steps'] == 721
+    assert result['pv_kwh'] == pytest.approx(0.3 * 2 + 0.7 * 8, abs=0.05)
+    assert result['car_kwh'] > 2
+    assert 0.5 < result['self_consumption'] <= 1
+    # on with the first sun. In the clouds the available current is below the activation threshold,
+    # so the allocation is not run at all and the WB keeps its current
+    assert result['switches'] == 1
+
+
+@pytest.mark.replay
+def test_replay_runs_the_pv_branch_of_the_controller(setup_config, setup_trace, mocker):
+    allocate_pv = mocker.spy(WallboxProxy, 'allocate_pv')
+    result = replay(setup_config, setup_trace)
+    assert allocate_pv.call_count == result['steps']
+
+
+@pytest.mark.replay
+def test_replay_many_with_overrides(setup_config, setup_trace):
+    overrides = parse_overrides(setup_config, ['REDUCE_AVAILABLE_CURRENT_BY=1,4', 'MIN_TIME_PV_CHARGE=60'])
+    assert overrides == [{'REDUCE_AVAILABLE_CURRENT_BY': 1.0, 'MIN_TIME_PV_CHARGE': 60},
+                         {'REDUCE_AVAILABLE_CURRENT_BY': 4.0, 'MIN_TIME_PV_CHARGE': 60}]
+
+    results = replay_many(setup_config, setup_trace, overrides, processes=2)
+    assert results[0]['REDUCE_AVAILABLE_CURRENT_BY'] == 1.0
+    assert results[1]['car_kwh'] < results[0]['car_kwh']
+    assert results[1]['grid_kwh'] < results[0]['grid_kwh']
+
+
+@pytest.mark.replay
+def test_parse_overrides_like_the_config_file(setup_config):
+    assert parse_overrides(setup_config, ['PV_FORECAST=no,yes']) == [{'PV_FORECAST': False}, {'PV_FORECAST': True}]
+    assert parse_overrides(setup_config, ['MIN_TIME_PV_CHARGE=30, 90', 'WB_MIN_CURRENT=6']) == \
+        [{'MIN_TIME_PV_CHARGE': 30, 'WB_MIN_CURRENT': 6.0}, {'MIN_TIME_PV_CHARGE': 90, 'WB_MIN_CURRENT': 6.0}]
+    assert isinstance(parse_overrides(setup_config, ['WB_MIN_CURRENT=6'])[0]['WB_MIN_CURRENT'], float)
+
+    for setting in ('PV_FORECAST=maybe', 'MIN_TIME_PV_CHARGE=1.5', 'NO_SUCH_SETTING=1', 'read_logging=1'):
+        with pytest.raises(ValueError):
+            parse_overrides(setup_config, [setting])
+
+
+@pytest.mark.replay
+def test_trace_from_line_protocol(tmp_path):
+    solar_log_data = SolarLogData()
+    solar_log_data.actual_output = 6000
+    solar_log_data.actual_consumption = 4600
+    wb = WBSystemState(2)
+    wb.charge_state = WBDef.CHARGE_REQUEST2
+    wb.actual_current_active = 6.0
+    path = tmp_path / 'export.lp'
+    path.write_text('# DML\n'
+                    + PVDatabase.format_solarlog_line(solar_log_data, START) + '\n'
+                    + PVDatabase.format_wallbox_line(wb, START * 1000000000) + '\n')
+
+    trace = ReplayTrace.from_line_protocol(str(path))
+    assert trace.solarlog == [(START, 6000, 4600)]
+    assert trace.wallbox == {2: [(START, WBDef.CHARGE_REQUEST2, 4140.0)]}
+
+
+@pytest.mark.replay
+def test_replay_with_pv_forecast(setup_config, setup_trace):
+    setup_config.PV_FORECAST = True
+    result = replay(setup_config, setup_trace)
+    assert result['steps'] == 721
+    assert result['car_kwh'] > 0
@@ -0,0 +1,54 @@
+from pv_modbus_solarlog import SolarLogData
+from wallbox_system_state import WBSystemState
+from pv_rollup import RollupAggregator
+import pytest
+
+
+def solarlog(pv_output, consumption):
+    solar_log_data = SolarLogData()
+    solar_log_data.actual_output = pv_output
+    solar_log_data.actual_consumption = consumption
+    return solar_log_data
+
+
+@pytest.mark.rollup
+def test_min_max_mean_last_per_interval():
+    aggregator = RollupAggregator([10])
+    for t, pv_output in ((100, 5000), (102, 7000), (105, 3000), (108, 4000)):
+        aggregator.add_solarlog(t, solarlog(pv_output, 500))
+    assert aggregator.collect(109) == []  # interval still open
+
+    aggregator.add_solarlog(111, solarlog(6000, 500))
+    rollups = aggregator.collect(111)
+    assert len(rollups) == 1
+    rollup = rollups[0]
+    assert (rollup.measurement, rollup.sensor, rollup.resolution, rollup.start, rollup.count) == \
+        ('solarlog', 'solarlog1', 10, 100, 4)
+    assert rollup.fields['pv_output'] == (3000, 7000, 4750.0, 4000)
+    assert rollup.fields['consumption'] == (500, 500, 500.0, 500)
+
+
+@pytest.mark.rollup
+def test_several_resolutions():
+    aggregator = RollupAggregator([300, 10])
+    wb = WBSystemState(3)
+    for t in range(0, 300, 5):
+        wb.max_current_active = 6 + t // 100
+        wb.pv_charge_active = t >= 150
+        aggregator.add_wallbox(t, [wb])
+
+    rollups = aggregator.collect(300)
+    assert [r.resolution for r in rollups].count(10) == 30
+    five_minutes = [r for r in rollups if r.resolution == 300]
+    assert len(five_minutes) == 1 and five_minutes[0].sensor == 'wallbox3' and five_minutes[0].count == 60
+    assert five_minutes[0].fields['max_current_active'] == (6, 8, 7.0, 8)
+    assert five_minutes[0].fields['pv_charge_active'] == (0, 1, 0.5, 1)
+    assert aggregator.collect(1000) == []
+
+
+@pytest.mark.rollup
+def test_series_without_new_samples_gets_closed():
+    aggregator = RollupAggregator([10])
+    aggregator.add_solarlog(100, solarlog(5000, 500))
+    assert [r.start for r in aggregator.collect(125)] == [100]
+    assert not aggregator.open
@@ -0,0 +1,52 @@
+from pv_simulator import PVSimulator, PVProfile
+from pv_modbus_solarlog import ModbusTCPSolarLog, ModbusTCPConfig, SolarLogReadInputs
+import pv_modbus_wallbox
+from pv_modbus_wallbox import WBDef
+import pytest
+
+
+@pytest.fixture
+def setup_simulator():
+    simulator = PVSimulator(PVProfile.constant(6000, 500), [1, 2], address=('127.0.0.1', 0))
+    simulator.start()
+    yield simulator
+    simulator.stop()
+
+
+@pytest.mark.simulator
+def test_profile():
+    profile = PVProfile([(0, 0, 400), (100, 1000, 600)])
+    assert profile.at(0) == (0, 400)
+    assert profile.at(50) == (500, 500)
+    assert profile.at(200) == (1000, 600)
+
+
+@pytest.mark.simulator
+def test_solarlog_and_wallboxes_end_to_end(setup_simulator):
+    simulator = setup_simulator
+    host, port = simulator.solarlog.address
+    solarlog = ModbusTCPSolarLog(ModbusTCPConfig(host, port, slave_id=1), SolarLogReadInputs())
+    data = solarlog.get_snapshot()
+    assert data.actual_output == 6000
+    assert data.actual_consumption == 500
+
+    config_wb_heidelberg = pv_modbus_wallbox.ModbusRTUConfig('rtu', simulator.bus.port, timeout=1, baudrate=19200,
+                                                             bytesize=8,
+                                                             parity='E',
+                                                             stopbits=1,
+                                                             strict=False)
+    connection = pv_modbus_wallbox.ModbusRTUHeidelbergWB(wb_config=config_wb_heidelberg
+                                                         , wb_read_input=pv_modbus_wallbox.HeidelbergWBReadInputs()
+                                                         , wb_read_holding=pv_modbus_wallbox.HeidelbergWBReadHolding()
+                                                         , wb_write_holding=pv_modbus_wallbox.HeidelbergWBWriteHolding())
+    assert connection.connect_wb_heidelberg()
+    assert connection.set_max_current(2, 100)
+    simulator.update(1, 1)
+
+    telemetry = connection.get_telemetry(2)
+    assert telemetry.charge_state == WBDef.CHARGE_REQUEST2
+    assert telemetry.current_l1 == 10
+    assert telemetry.actual_charge_power == 6900
+    assert connection.get_telemetry(1).actual_charge_power == 0
+    assert solarlog.get_snapshot().actual_consumption == 500 + 6900
+    connection.close_wb_heidelberg()
@@ -0,0 +1,52 @@
+from pv_spool import PVSpool
+import os
+import pytest
+
+
+@pytest.mark.database
+def test_append_and_replay_oldest_first(tmp_path):
+    spool = PVSpool(str(tmp_path), segment_size=30, max_size=1000)
+    assert spool.is_empty()
+
+    spool.append(['line1 a=1 1', 'line2 a=2 2'])  # 24 bytes, stays in the first segment
+    spool.append(['line3 a=3 3'])  # rotates
+    spool.append(['line4 a=4 4'])
+
+    segment, lines = spool.read_oldest()
+    assert lines == ['line1 a=1 1', 'line2 a=2 2', 'line3 a=3 3']
+    spool.remove(segment)
+
+    segment, lines = spool.read_oldest()
+    assert lines == ['line4 a=4 4']
+    spool.remove(segment)
+    assert spool.is_empty()
+
+
+@pytest.mark.database
+def test_evict_oldest_segment(tmp_path):
+    spool = PVSpool(str(tmp_path), segment_size=10, max_size=30)
+    for i in range(5):
+        spool.append(['line%s a=1 1' % i])  # 12 bytes each, one segment per append
+
+    assert spool.size() <= 30
+    segment, lines = spool.read_oldest()
+    assert lines == ['line3 a=1 1']
+
+
+@pytest.mark.database
+def test_survives_restart_with_partial_record(tmp_path):
+    spool = PVSpool(str(tmp_path), segment_size=1000, max_size=10000)
+    spool.append(['line1 a=1 1'])
+    spool.close()
+    with open(os.path.join(str(tmp_path), '00000001.lp'), 'ab') as f:
+        f.write(b'line2 a=')  # crash in the middle of a write
+
+    spool = PVSpool(str(tmp_path), segment_size=1000, max_size=10000)
+    assert not spool.is_empty()
+    spool.append(['line3 a=3 3'])  # goes into a new segment
+
+    segment, lines = spool.read_oldest()
+    assert lines == ['line1 a=1 1']
+    spool.remove(segment)
+    segment, lines = spool.read_oldest()
+    assert lines == ['line3 a=3 3']
@@ -0,0 +1,102 @@
+from pv_modbus_solarlog import SolarLogData
+from wallbox_system_state import WBSystemState
+from config_file import ConfigFile
+from pv_sqlite_database import PVSQLiteDatabase
+from pv_rollup import RollupAggregator
+import sqlite3
+import time
+import pytest
+
+
+@pytest.fixture
+def setup_config(tmp_path):
+    cfg = ConfigFile()
+    cfg.SQLITE_PATH = str(tmp_path / 'data' / 'pv_modbus.sqlite')
+    cfg.SQLITE_COMMIT_EVERY = 0.05
+    return cfg
+
+
+def read_rows(cfg: ConfigFile, table: str) -> list:
+    connection = sqlite3.connect(cfg.SQLITE_PATH)
+    rows = connection.execute('SELECT * FROM %s ORDER BY sensor, time' % table).fetchall()
+    connection.close()
+    return rows
+
+
+@pytest.mark.database
+def test_rows_of_a_cycle_in_one_commit(setup_config):
+    database = PVSQLiteDatabase(setup_config)
+    solar_log_data = SolarLogData()
+    solar_log_data.actual_output = 6000
+    solar_log_data.actual_consumption = 4500
+    wallbox = [WBSystemState(slave_id) for slave_id in range(1, 41)]
+    wallbox[1].pv_charge_active = True
+    wallbox[1].max_current_active = 8
+
+    database.write_solarlog_data(solar_log_data)
+    database.write_wallbox_data(wallbox)
+    database.close(timeout=1)
+
+    assert [row[:1] + row[2:] for row in read_rows(setup_config, 'solarlog')] == [('solarlog1', 6000, 4500)]
+    rows = read_rows(setup_config, 'wallbox')
+    assert len(rows) == 40
+    assert [row[2:] for row in rows if row[0] == 'wallbox2'] == [(0, 1, 0, 8, 0)]
+
+    connection = sqlite3.connect(setup_config.SQLITE_PATH)
+    assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    connection.close()
+
+
+@pytest.mark.database
+def test_unchanged_wallboxes_not_written_again(setup_config):
+    database = PVSQLiteDatabase(setup_config)
+    wallbox = [WBSystemState(1)]
+    database.write_wallbox_data_only_if_changed(wallbox)
+    time.sleep(1.1)  # next second, so a second write would be a new row
+    database.write_wallbox_data_only_if_changed(wallbox)
+    database.close(timeout=1)
+    assert len(read_rows(setup_config, 'wallbox')) == 1
+
+
+@pytest.mark.database
+def test_retention_drops_old_buckets(setup_config):
+    setup_config.SQLITE_RETENTION_DAYS = 1
+    database = PVSQLiteDatabase(setup_config)
+    now = 1700000000
+    database._commit({'solarlog': [('solarlog1', now - 2 * 86400, 1, 1), ('solarlog1', now - 3600, 2, 2)],
+                      'wallbox': [('wallbox1', now - 2 * 86400, 0, 0, 0, 0, 0), ('wallbox1', now, 0, 0, 0, 0, 0)]})
+    database._prune(now)
+    database.close(timeout=1)
+
+    assert [row[1] for row in read_rows(setup_config, 'solarlog')] == [now - 3600]
+    assert [row[1] for row in read_rows(setup_config, 'wallbox')] == [now]
+
+
+@pytest.mark.database
+def test_rollups_one_row_per_field(setup_config):
+    database = PVSQLiteDatabase(setup_config)
+    aggregator = RollupAggregator([10, 300])
+    start = int(time.time()) // 300 * 300  # within the retention
+    for t, pv_output in ((start + 10, 5000), (start + 15, 7000)):
+        solar_log_data = SolarLogData()
+        solar_log_data.actual_output = pv_output
+        aggregator.add_solarlog(t, solar_log_data)
+    database.write_rollups(aggregator.collect(start + 300))
+    database.close(timeout=1)
+
+    rows = read_rows(setup_config, 'rollup')
+    assert ('solarlog1', start + 10, 10, 'pv_output', 5000, 7000, 6000, 7000, 2) in rows
+    assert ('solarlog1', start, 300, 'pv_output', 5000, 7000, 6000, 7000, 2) in rows
+    assert len(rows) == 4
+
+
+@pytest.mark.database
+def test_close_is_bounded_with_a_full_queue(setup_config):
+    database = PVSQLiteDatabase(setup_config)
+    database.close(timeout=1)  # writer gone, nothing gets drained anymore
+    for _ in range(database.QUEUE_SIZE):
+        database.write_queue.put(('solarlog', []))
+
+    start = time.monotonic()
+    database.close(timeout=0.2)
+    assert time.monotonic() - start < 1
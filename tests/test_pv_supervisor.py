@@ -0,0 +1,306 @@
+from pv_supervisor import Supervisor, SupervisorConfig
+from pv_site import SiteLink, UplinkSink
+from pv_simulator import PVSimulator, PVProfile
+from pv_modbus_solarlog import SolarLogData
+from wallbox_system_state import WBSystemState
+from config_file import ConfigFile
+import pv_site
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import configparser
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SITE_CONFIG = """
+[SOLARLOG]
+SOLARLOG_IP = 127.0.0.1
+SOLARLOG_PORT = %s
+SOLARLOG_SLAVEID = 1
+
+[WALLBOX]
+WB1_SLAVEID = 1
+WB2_SLAVEID = 2
+WB_RTU_DEVICE = %s
+WB_SYSTEM_MAX_CURRENT = 16.0
+WB_MIN_CURRENT = 6.0
+PV_CHARGE_AMP_TOLERANCE = 0.0
+REDUCE_AVAILABLE_CURRENT_BY = 0.0
+KEEP_CHARGE_CURRENT_STABLE_FOR = 20
+
+[TIME]
+MIN_TIME_PV_CHARGE = 60
+
+[LOGGING]
+DATA_SINK = uplink
+SOLARLOG_WRITE_EVERY = 0
+INFLUX_DB_NAME = pv_modbus
+INFLUX_HOST = 127.0.0.1
+INFLUX_PORT = 8086
+INFLUX_USER = pv_modbus
+INFLUX_PWD = #
+
+[SWITCH]
+HAVE_SWITCH = no
+GPIO_SWITCH = 24
+
+[RUNTIME]
+CYCLE_TIME = 0.1
+POLL_FAST = 0.1
+POLL_SLOW = 0.1
+CONFIG_RELOAD = no
+"""
+
+
+class RecordingUplink:
+    def __init__(self):
+        self.lines = []
+
+    def write_lines(self, lines):
+        self.lines.extend(lines)
+        return True
+
+    def close(self, timeout: float = None):
+        pass
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+class FakeProcess:
+    pid = 4711
+
+    def __init__(self):
+        self.alive = True
+        self.exitcode = None
+
+    def is_alive(self):
+        return self.alive
+
+    def join(self, timeout=None):
+        pass
+
+    def kill(self):
+        self.alive = False
+        self.exitcode = -9
+
+
+def fake_start(supervisor: Supervisor):
+    started = []
+
+    def start_site(site, now):
+        site.process = FakeProcess()
+        site.started = now
+        site.last_cycle = None
+        started.append((site.name, now))
+    supervisor.start_site = start_site
+    return started
+
+
+@pytest.mark.supervisor
+def test_config_of_sites_and_uplink():
+    config = configparser.ConfigParser()
+    config.read_string('[SUPERVISOR]\nSITE_HANG_TIMEOUT = 60\n'
+                       '[SITES]\ncarport_north = /etc/pv_modbus/north.ini\ncarport-south = /etc/pv_modbus/south.ini\n')
+    cfg = SupervisorConfig(config)
+    assert cfg.SITES == {'carport_north': '/etc/pv_modbus/north.ini', 'carport-south': '/etc/pv_modbus/south.ini'}
+    assert cfg.SITE_HANG_TIMEOUT == 60
+    assert cfg.uplink.DATA_SINK == 'none'
+
+    # no Influx settings needed without Influx
+    config.read_string('[LOGGING]\nDATA_SINK = none\nINFLUX_BATCH_DELAY = 0.1\n')
+    assert SupervisorConfig(config).uplink.INFLUX_BATCH_DELAY == 0.1
+    config.set('LOGGING', 'DATA_SINK', 'influx')
+    with pytest.raises(KeyError, match='INFLUX_HOST'):
+        SupervisorConfig(config)
+    config.remove_section('LOGGING')
+
+    config.read_string('[SITES]\ncarport north = /etc/pv_modbus/north.ini\n')
+    with pytest.raises(ValueError, match='carport north'):
+        SupervisorConfig(config)
+
+
+@pytest.mark.supervisor
+def test_uplink_sink_tags_the_site(monkeypatch):
+    connection = RecordingConnection()
+    monkeypatch.setattr(pv_site, '_site_link', SiteLink('north', connection))
+    sink = UplinkSink(ConfigFile())
+    solar_log_data = SolarLogData()
+    solar_log_data.actual_output = 6000
+    sink.write_solarlog_data_only_if_changed(solar_log_data)
+    sink.write_solarlog_data_only_if_changed(solar_log_data)
+    sink.write_wallbox_data([WBSystemState(1)])
+
+    assert [kind for kind, _ in connection.sent] == ['lines', 'lines']
+    assert connection.sent[0][1][0].startswith('solarlog,site=north,sensor=solarlog1 pv_output=6000,')
+    assert connection.sent[1][1][0].startswith('wallbox,site=north,sensor=wallbox1 ')
+
+
+@pytest.mark.supervisor
+def test_uplink_sink_only_in_a_site():
+    with pytest.raises(ValueError, match='pv_supervisor'):
+        UplinkSink(ConfigFile())
+
+
+@pytest.mark.supervisor
+def test_crashed_site_restarted_with_backoff():
+    cfg = SupervisorConfig()
+    cfg.SITES = {'north': 'north.ini'}
+    cfg.RESTART_BACKOFF_MIN = 1
+    cfg.RESTART_BACKOFF_MAX = 3
+    cfg.RESTART_RESET_AFTER = 100
+    supervisor = Supervisor(cfg)
+    started = fake_start(supervisor)
+    site = supervisor.sites['north']
+
+    supervisor.check_sites(0)
+    for now, backoff in ((1, 1), (3, 2), (6, 3), (10, 3)):  # crashes right after every start
+        site.process.alive = False
+        supervisor.check_sites(now)
+        assert site.backoff == backoff and site.process is None
+        supervisor.check_sites(now + backoff - 0.5)
+        assert site.process is None  # not yet
+        supervisor.check_sites(now + backoff)
+    assert [t for _, t in started] == [0, 2, 5, 9, 13]
+
+    site.process.alive = False
+    supervisor.check_sites(13 + 100)  # ran long enough
+    assert site.backoff == 1
+    assert supervisor.get_health(113)['north']['restarts'] == 5
+
+
+@pytest.mark.supervisor
+def test_pipe_of_a_dead_site_closed_before_the_restart():
+    cfg = SupervisorConfig()
+    cfg.SITES = {'north': 'north.ini'}
+    supervisor = Supervisor(cfg)
+    supervisor.uplink = RecordingUplink()
+    fake_start(supervisor)
+    site = supervisor.sites['north']
+    supervisor.check_sites(0)
+
+    site.connection, site_end = multiprocessing.Pipe(duplex=False)
+    connection = site.connection
+    site_end.send(('lines', ['solarlog,site=north,sensor=solarlog1 pv_output=6000,consumption=4500 1700000000']))
+    site_end.close()
+    site.process.alive = False  # gone before the supervisor read what it sent
+    supervisor.check_sites(1)
+    assert site.connection is None and connection.closed
+    assert supervisor.uplink.lines == ['solarlog,site=north,sensor=solarlog1 pv_output=6000,consumption=4500 1700000000']
+
+
+@pytest.mark.supervisor
+def test_hung_site_is_killed():
+    cfg = SupervisorConfig()
+    cfg.SITES = {'north': 'north.ini'}
+    cfg.SITE_HANG_TIMEOUT = 30
+    supervisor = Supervisor(cfg)
+    fake_start(supervisor)
+    site = supervisor.sites['north']
+
+    supervisor.check_sites(0)
+    site.last_cycle = 20
+    supervisor.check_sites(45)
+    assert site.process.alive
+    supervisor.check_sites(51)
+    assert not site.process.alive
+    supervisor.check_sites(52)
+    assert site.process is None and site.restarts == 1
+
+
+# real site processes: one on the simulator, one that can not start
+@pytest.mark.supervisor
+def test_sites_report_cycles_and_data(tmp_path):
+    simulator = PVSimulator(PVProfile.constant(6000, 500), [1, 2], address=('127.0.0.1', 0))
+    simulator.start()
+    path = tmp_path / 'north.ini'
+    path.write_text(SITE_CONFIG % (simulator.solarlog.address[1], simulator.bus.port))
+    cfg = SupervisorConfig()
+    cfg.SITES = {'north': str(path), 'south': str(tmp_path / 'missing.ini')}
+    cfg.RESTART_BACKOFF_MIN = 0.1
+    cfg.METRICS_PORT = 0
+    supervisor = Supervisor(cfg)
+    supervisor.uplink = uplink = RecordingUplink()
+    thread = threading.Thread(target=supervisor.run)
+    thread.start()
+
+    deadline = time.monotonic() + 20
+    health = supervisor.get_health()
+    while (health['north'].get('cycles', 0) < 3 or health['south']['restarts'] < 1) and time.monotonic() < deadline:
+        time.sleep(0.1)
+        health = supervisor.get_health()
+    supervisor.stop()
+    thread.join()
+    simulator.stop()
+
+    assert health['north']['up'] and health['north']['restarts'] == 0
+    assert health['north']['cycles'] >= 3 and health['north']['cycle_time'] < 1
+    assert health['south']['restarts'] >= 1 and 'cycles' not in health['south']
+    assert any(line.startswith('solarlog,site=north,sensor=solarlog1 pv_output=6000,') for line in uplink.lines)
+    assert not any(site.process.is_alive() for site in supervisor.sites.values() if site.process is not None)
+    text = supervisor.metrics.render()
+    assert 'pv_site_up{site="north"} 1' in text
+    assert '# TYPE pv_site_restarts_total counter' in text and '# TYPE pv_site_cycles_total counter' in text
+
+
+# stands in for InfluxDB: keeps the bodies of /write
+class FakeInflux(ThreadingHTTPServer):
+    def __init__(self):
+        self.lines = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(handler):
+                body = handler.rfile.read(int(handler.headers['Content-Length'])).decode()
+                self.lines.extend(body.splitlines())
+                handler.send_response(204)
+                handler.end_headers()
+
+            def log_message(handler, format, *args):
+                pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.daemon_threads = True
+
+
+# as in the README: python pv_supervisor.py --config ..., so pv_supervisor is __main__
+@pytest.mark.supervisor
+def test_started_as_script(tmp_path):
+    simulator = PVSimulator(PVProfile.constant(6000, 500), [1, 2], address=('127.0.0.1', 0))
+    simulator.start()
+    influx = FakeInflux()
+    threading.Thread(target=influx.serve_forever, daemon=True).start()
+    (tmp_path / 'north.ini').write_text(SITE_CONFIG % (simulator.solarlog.address[1], simulator.bus.port))
+    (tmp_path / 'supervisor.ini').write_text(
+        '[SITES]\nnorth = %s\n[LOGGING]\nDATA_SINK = influx\nINFLUX_DB_NAME = pv_modbus\nINFLUX_HOST = 127.0.0.1\n'
+        'INFLUX_PORT = %s\nINFLUX_USER = pv_modbus\nINFLUX_PWD = #\nINFLUX_BATCH_DELAY = 0.1\n'
+        % (tmp_path / 'north.ini', influx.server_address[1]))
+    supervisor = subprocess.Popen([sys.executable, os.path.join(REPO, 'pv_supervisor.py')
+                                   , '--config', str(tmp_path / 'supervisor.ini')]
+                                  , cwd=str(tmp_path), stderr=subprocess.PIPE, text=True)
+    try:
+        deadline = time.monotonic() + 20
+        while not any(line.startswith('solarlog,site=north,') for line in influx.lines) \
+                and time.monotonic() < deadline and supervisor.poll() is None:
+            time.sleep(0.1)
+        supervisor.send_signal(signal.SIGTERM)
+        _, stderr = supervisor.communicate(timeout=15)
+    finally:
+        if supervisor.poll() is None:
+            supervisor.kill()
+        influx.shutdown()
+        simulator.stop()
+
+    assert 'exited with code' not in stderr
+    assert any(line.startswith('solarlog,site=north,sensor=solarlog1 pv_output=6000,') for line in influx.lines)
+    assert supervisor.returncode == 0
@@ -0,0 +1,45 @@
+from rolling_window import RollingWindow
+import random
+import pytest
+
+
+@pytest.mark.history
+def test_empty_window():
+    window = RollingWindow(4)
+    assert len(window) == 0
+    assert window.mean() == window.min() == window.max() == window.slope() == window.percentile(50) == 0.0
+
+
+@pytest.mark.history
+def test_statistics_match_brute_force():
+    rng = random.Random(7)
+    window = RollingWindow(10)
+    samples = []
+    for i in range(57):  # wraps around several times
+        sample = (1700000000.0 + i * 5, float(rng.randint(0, 10000)))
+        window.add(*sample)
+        samples.append(sample)
+
+        last = samples[-10:]
+        values = [v for _, v in last]
+        assert len(window) == len(last)
+        assert window.latest() == values[-1]
+        assert window.mean() == pytest.approx(sum(values) / len(values))
+        assert window.min() == min(values)
+        assert window.max() == max(values)
+        assert window.percentile(50) == sorted(values)[len(values) // 2]
+        if len(last) > 1:
+            mean_t = sum(t for t, _ in last) / len(last)
+            mean_v = sum(values) / len(values)
+            slope = sum((t - mean_t) * (v - mean_v) for t, v in last) / sum((t - mean_t) ** 2 for t, _ in last)
+            assert window.slope() == pytest.approx(slope)
+
+
+@pytest.mark.history
+def test_slope_of_a_line():
+    window = RollingWindow(5)
+    for t in range(20):
+        window.add(1000.0 + t, 300.0 - 2.5 * t)
+    assert window.slope() == pytest.approx(-2.5)
+    assert window.min() == 300.0 - 2.5 * 19
+    assert window.max() == 300.0 - 2.5 * 15
@@ -0,0 +1,67 @@
+from rtu_bus_scheduler import RTUBusScheduler, BusPriority, TransactionExpired
+import threading
+import time
+import pytest
+
+
+@pytest.fixture
+def setup_scheduler():
+    scheduler = RTUBusScheduler()
+    yield scheduler
+    scheduler.close()
+
+
+def block_bus(scheduler):
+    release = threading.Event()
+    scheduler.submit(BusPriority.STATE_READ, None, release.wait)
+    time.sleep(0.05)  # worker is busy now
+    return release
+
+
+@pytest.mark.bus
+def test_most_important_transaction_first(setup_scheduler):
+    scheduler = setup_scheduler
+    release = block_bus(scheduler)
+
+    executed = []
+    futures = [scheduler.submit(BusPriority.DIAGNOSTIC, None, executed.append, 'pcb temperature'),
+               scheduler.submit(BusPriority.STATE_READ, None, executed.append, 'charging state 1'),
+               scheduler.submit(BusPriority.STATE_READ, None, executed.append, 'charging state 2'),
+               scheduler.submit(BusPriority.CURRENT_WRITE, None, executed.append, 'max current')]
+    assert scheduler.queue_depth() == 4
+
+    release.set()
+    for future in futures:
+        future.result(timeout=1)
+    assert executed == ['max current', 'charging state 1', 'charging state 2', 'pcb temperature']
+
+
+@pytest.mark.bus
+def test_expired_transaction_is_not_sent(setup_scheduler):
+    scheduler = setup_scheduler
+    release = block_bus(scheduler)
+
+    executed = []
+    future = scheduler.submit(BusPriority.DIAGNOSTIC, 0.01, executed.append, 'pcb temperature')
+    time.sleep(0.05)
+    release.set()
+
+    with pytest.raises(TransactionExpired):
+        future.result(timeout=1)
+    assert executed == []
+    stats = scheduler.get_stats()
+    assert stats['diagnostic']['expired'] == 1
+    assert stats['state_read']['transactions'] == 1
+
+
+@pytest.mark.bus
+def test_call_returns_result_and_raises(setup_scheduler):
+    scheduler = setup_scheduler
+    assert scheduler.call(BusPriority.STATE_READ, lambda a, b=0: a + b, 1, b=2) == 3
+
+    def broken():
+        raise IOError('no response')
+
+    with pytest.raises(IOError):
+        scheduler.call(BusPriority.STATE_READ, broken)
+    assert scheduler.get_stats()['queue_depth'] == 0
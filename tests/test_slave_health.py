@@ -0,0 +1,43 @@
+from slave_health import SlaveHealth, BreakerState
+import pytest
+
+
+@pytest.fixture
+def setup_health():
+    return SlaveHealth(timeout_min=0.2, timeout_max=3.0, max_failures=3, probe_every=60)
+
+
+@pytest.mark.wallbox
+def test_timeout_follows_latency(setup_health):
+    health = setup_health
+    assert health.timeout() == 3.0  # nothing known yet
+    for _ in range(50):
+        health.record_success(0.05)
+    assert health.timeout() == pytest.approx(0.2, abs=0.01)  # never below timeout_min
+    for _ in range(50):
+        health.record_success(0.5)
+    assert 0.5 < health.timeout() < 3.0
+
+
+@pytest.mark.wallbox
+def test_breaker_opens_and_probes(setup_health):
+    health = setup_health
+    for _ in range(2):
+        health.record_failure(100.0)
+    assert health.allow_request(100.0)
+    health.record_failure(100.0)
+    assert health.state == BreakerState.OPEN
+    assert not health.allow_request(159.0)
+    assert health.skipped == 1
+
+    assert health.allow_request(160.0)  # the probe
+    assert health.state == BreakerState.HALF_OPEN
+    assert not health.allow_request(160.0)  # only one
+    health.record_failure(160.0)
+    assert health.state == BreakerState.OPEN
+    assert health.next_probe == 220.0
+
+    assert health.allow_request(220.0)
+    health.record_success(0.05)
+    assert health.state == BreakerState.CLOSED
+    assert health.failures == 0
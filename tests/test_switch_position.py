@@ -0,0 +1,81 @@
+from switch_position import PV_Switch, FileSwitchInput
+from config_file import ConfigFile
+import threading
+import time
+import pytest
+
+
+# edges are triggered by the test
+class FakeSwitchInput:
+    def __init__(self, pv_only: bool):
+        self.pv_only = pv_only
+        self.on_edge = None
+
+    def read(self) -> bool:
+        return self.pv_only
+
+    def start(self, on_edge):
+        self.on_edge = on_edge
+
+    def stop(self):
+        pass
+
+    def flip(self, pv_only: bool):
+        self.pv_only = pv_only
+        self.on_edge()
+
+
+@pytest.mark.switch
+def test_bouncing_contact_changes_the_mode_once():
+    switch_input = FakeSwitchInput(True)
+    changes = []
+    switch = PV_Switch(switch_input, 0.05, on_change=changes.append)
+
+    for pv_only in (False, True, False, True, False):  # bounces within the debounce time
+        switch_input.flip(pv_only)
+        time.sleep(0.005)
+    assert switch.is_switch_set_to_pv_only()  # not settled yet
+    time.sleep(0.1)
+
+    assert changes == [False]
+    assert not switch.is_switch_set_to_pv_only()
+    assert switch.changes == 1
+
+
+@pytest.mark.switch
+def test_bounce_back_is_no_change():
+    switch_input = FakeSwitchInput(True)
+    changes = []
+    switch = PV_Switch(switch_input, 0.02, on_change=changes.append)
+    switch_input.flip(False)
+    switch_input.flip(True)
+    time.sleep(0.05)
+    assert changes == []
+    assert switch.is_switch_set_to_pv_only()
+
+
+@pytest.mark.switch
+def test_lost_edge_gets_picked_up_by_the_cycle():
+    switch_input = FakeSwitchInput(True)
+    switch = PV_Switch(switch_input, 0.01)
+    switch_input.pv_only = False  # no edge
+    assert switch.is_switch_set_to_pv_only()
+    time.sleep(0.05)
+    assert not switch.is_switch_set_to_pv_only()
+
+
+@pytest.mark.switch
+def test_file_input_wakes_on_change(tmp_path):
+    cfg = ConfigFile()
+    cfg.SWITCH_FILE = str(tmp_path / 'switch')
+    (tmp_path / 'switch').write_text('1')
+    changed = threading.Event()
+    switch = PV_Switch(FileSwitchInput(cfg), 0.02, on_change=lambda pv_only: changed.set())
+    assert switch.is_switch_set_to_pv_only()
+
+    start = time.monotonic()
+    (tmp_path / 'switch').write_text('0')
+    assert changed.wait(1)
+    assert time.monotonic() - start < 0.5
+    assert not switch.is_switch_set_to_pv_only()
+    switch.stop()
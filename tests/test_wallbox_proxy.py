@@ -385,3 +385,109 @@ def test_is_charging_active(setup_wallboxes_off_state, setup_config, pv_charge_o
     wallbox[1].grid_charge_active = grid_charge_on
 
     assert wbprox.is_charging_active(wallbox) == result
+
+
+@pytest.mark.activate
+def test_activate_grid_charge_many_wallboxes(setup_config, mocker):
+    connection = mocker.MagicMock()
+    connection.set_max_current.return_value = True
+    wallbox = [WBSystemState(slave_id) for slave_id in range(1, 5)]
+    for wb in wallbox:
+        wb.charge_state = WBDef.CHARGE_REQUEST1
+    wbprox = WallboxProxy(setup_config)
+
+    # 16 A for 4 WBs -> only 2 can get the min current of 6 A
+    wbprox.activate_grid_charge(connection, wallbox)
+    assert [wb.grid_charge_active for wb in wallbox] == [True, True, False, False]
+    assert [wb.max_current_active for wb in wallbox] == [8, 8, 0, 0]
+
+
+@pytest.mark.activate
+def test_activate_pv_charge_site_max_current(setup_wallboxes_off_state, setup_config):
+    connection = create_fake_wallbox_connection()
+    wallbox = setup_wallboxes_off_state
+    setup_config.WB_SITE_MAX_CURRENT = 20.0
+    wbprox = WallboxProxy(setup_config)
+
+    # 4 A left: within the tolerance, but the min current of 6 A would blow the fuse
+    wbprox.activate_pv_charge(connection, wallbox, WB_SYSTEM_MAX_CURRENT * 2)
+    assert wallbox[0].max_current_active == WB_SYSTEM_MAX_CURRENT
+    assert not wallbox[1].pv_charge_active and wallbox[1].max_current_active == 0
+
+    # already charging and the hold time is not over: off anyway
+    wallbox[1].pv_charge_active = True
+    wallbox[1].max_current_active = WB_MIN_CURRENT
+    wallbox[1].last_charge_activation = datetime.datetime.now()
+    wbprox.activate_pv_charge(connection, wallbox, WB_SYSTEM_MAX_CURRENT * 2)
+    assert [wb.max_current_active for wb in wallbox] == [WB_SYSTEM_MAX_CURRENT, 0]
+    assert not wallbox[1].pv_charge_active
+
+    # enough for both
+    setup_config.WB_SITE_MAX_CURRENT = 24.0
+    reset_wallboxes(wallbox)
+    wallbox[1].last_charge_deactivation = datetime.datetime.now() - datetime.timedelta(seconds=MIN_WAIT_BEFORE_PV_ON + 1)
+    wbprox.activate_pv_charge(connection, wallbox, WB_SYSTEM_MAX_CURRENT * 2)
+    assert [wb.max_current_active for wb in wallbox] == [WB_SYSTEM_MAX_CURRENT, 8.0]
+
+
+@pytest.mark.activate
+def test_activate_pv_charge_waterfill(setup_config, mocker):
+    connection = mocker.MagicMock()
+    connection.set_max_current.return_value = True
+    long_ago = datetime.datetime.now() - datetime.timedelta(hours=1)
+    wallbox = [WBSystemState(slave_id) for slave_id in range(1, 5)]
+    for wb in wallbox:
+        wb.charge_state = WBDef.CHARGE_REQUEST1
+        wb.last_charge_activation = long_ago
+        wb.last_charge_deactivation = long_ago
+    wallbox[3].pv_charge_active = True  # already charging, gets in first
+    setup_config.WB_ALLOCATOR = 'waterfill'
+    wbprox = WallboxProxy(setup_config)
+
+    # 21 A -> 3 WBs with 7 A each instead of 16 A + 6 A
+    wbprox.activate_pv_charge(connection, wallbox, 21.0)
+    assert [wb.pv_charge_active for wb in wallbox] == [True, True, False, True]
+    assert [wb.max_current_active for wb in wallbox] == [7.0, 7.0, 0, 7.0]
+
+    # less sun. WB 4 may not stop yet, WB 2 has to
+    for wb in wallbox:
+        wb.last_charge_activation = long_ago
+    wallbox[3].last_charge_activation = datetime.datetime.now()
+    wbprox.activate_pv_charge(connection, wallbox, 13.0)
+    assert [wb.pv_charge_active for wb in wallbox] == [True, False, False, True]
+    assert [wb.max_current_active for wb in wallbox] == [6.5, 0, 0, 6.5]
+
+
+@pytest.mark.activate
+def test_activate_pv_charge_waterfill_site_max_current(setup_config, mocker):
+    connection = mocker.MagicMock()
+    connection.set_max_current.return_value = True
+    long_ago = datetime.datetime.now() - datetime.timedelta(hours=1)
+    wallbox = [WBSystemState(slave_id) for slave_id in range(1, 4)]
+    for wb in wallbox:
+        wb.charge_state = WBDef.CHARGE_REQUEST1
+        wb.last_charge_activation = long_ago
+        wb.last_charge_deactivation = long_ago
+    setup_config.WB_ALLOCATOR = 'waterfill'
+    setup_config.WB_SITE_MAX_CURRENT = 16.0
+    wbprox = WallboxProxy(setup_config)
+
+    # 3 x 6 A would be within the tolerance, but over the 16 A of the site
+    wbprox.activate_pv_charge(connection, wallbox, 32.0)
+    assert [wb.max_current_active for wb in wallbox] == [8.0, 8.0, 0]
+
+    # all three charging and none may stop yet: the last one has to anyway
+    for wb in wallbox:
+        wb.pv_charge_active = True
+        wb.max_current_active = 6.0
+        wb.last_charge_activation = datetime.datetime.now()
+    wbprox.activate_pv_charge(connection, wallbox, 32.0)
+    assert [wb.pv_charge_active for wb in wallbox] == [True, True, False]
+    assert sum(wb.max_current_active for wb in wallbox) <= 16.0
+
+
+@pytest.mark.activate
+def test_water_fill():
+    assert Toolbox.water_fill(30.0, [6.0, 6.0, 6.0], [16.0, 16.0, 16.0]) == [10.0, 10.0, 10.0]
+    assert Toolbox.water_fill(30.0, [6.0, 6.0], [8.0, 32.0]) == [8.0, 22.0]  # what WB 1 can not take goes to WB 2
+    assert Toolbox.water_fill(10.0, [6.0, 6.0], [16.0, 16.0]) == [6.0, 6.0]  # never below the floor
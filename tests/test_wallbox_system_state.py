@@ -29,3 +29,16 @@ def test_wbsystem_state_equality():
 
 
 
+@pytest.mark.activate
+def test_wbsystem_state_snapshot():
+    wb = WBSystemState(2)
+    before = wb.snapshot()
+    wb.standby_active = True  # not saved to the DB
+    assert wb.snapshot() == before
+
+    wb.max_current_active = 8
+    assert wb.snapshot() != before
+    assert before == (0, False, False, 0, 0)
+
+    with pytest.raises(AttributeError):
+        wb.max_curent_active = 8
@@ -1,4 +1,5 @@
 from pv_modbus_solarlog import SolarLogData
+from typing import List
 import datetime
 import logging
 
@@ -45,14 +46,37 @@ class Toolbox:
 
         return available_power
 
+    # split current so that every WB gets at least its floor and the rest is shared evenly, up to each cap.
+    # Whatever a WB can not take because of its cap goes to the others (water-filling). Returns one value per WB
+    @staticmethod
+    def water_fill(available: float, floors: List[float], caps: List[float]) -> List[float]:
+        result = list(floors)
+        remaining = available - sum(floors)
+        if remaining <= 0:
+            return result
+
+        # the smallest headroom fills up first; everything above gets the same share
+        order = sorted(range(len(floors)), key=lambda i: caps[i] - floors[i])
+        left = len(order)
+        for i in order:
+            share = remaining / left
+            headroom = caps[i] - floors[i]
+            if headroom < share:
+                share = headroom
+            result[i] += share
+            remaining -= share
+            left -= 1
+        return result
+
 
 class TimeTools:
-    def __init__(self):
-        self.time_start = datetime.datetime.now()
+    def __init__(self, clock=datetime.datetime.now):  # clock: e.g. a simulated one for replays
+        self.clock = clock
+        self.time_start = self.clock()
 
     def seconds_have_passed_since_trigger(self):
-        time_diff = datetime.datetime.now() - self.time_start
+        time_diff = self.clock() - self.time_start
         return time_diff.total_seconds()
 
     def trigger_time(self):
-        self.time_start = datetime.datetime.now()
\ No newline at end of file
+        self.time_start = self.clock()
\ No newline at end of file
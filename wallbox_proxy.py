@@ -1,7 +1,8 @@
 from wallbox_system_state import WBSystemState
 from pv_modbus_wallbox import WBDef
 from pv_modbus_wallbox import ModbusRTUHeidelbergWB
-from toolbox import Toolbox
+from pv_modbus_solarlog import SolarLogData
+from toolbox import Toolbox, TimeTools
 from config_file import ConfigFile
 import datetime
 from typing import List
@@ -10,8 +11,11 @@ import logging
 
 class WallboxProxy:
 
-    def __init__(self, cfg: ConfigFile):
+    def __init__(self, cfg: ConfigFile, clock=datetime.datetime.now):
         self.cfg = cfg
+        self.clock = clock  # returns the current datetime. Replays pass a simulated one
+        self.available_power = 0  # W. Only calculated again after KEEP_CHARGE_CURRENT_STABLE_FOR
+        self.last_power_calc = TimeTools(clock)
 
     # check if we have to activate standby
     def set_standby_if_required(self, wallbox_connection: ModbusRTUHeidelbergWB, wallbox: WBSystemState):
@@ -30,22 +34,22 @@ class WallboxProxy:
                 logging.fatal('WB %s StandBy _not_ Disabled', wallbox.slave_id)
 
     def is_plug_connected_and_charge_ready(self, wallbox: WBSystemState) -> bool:
-        return wallbox.charge_state == WBDef.CHARGE_PLUG_NO_REQUEST1 \
-                or wallbox.charge_state == WBDef.CHARGE_PLUG_NO_REQUEST2 \
-                or wallbox.charge_state == WBDef.CHARGE_REQUEST1 \
-                or wallbox.charge_state == WBDef.CHARGE_REQUEST2
+        return wallbox.available and (wallbox.charge_state == WBDef.CHARGE_PLUG_NO_REQUEST1
+                                      or wallbox.charge_state == WBDef.CHARGE_PLUG_NO_REQUEST2
+                                      or wallbox.charge_state == WBDef.CHARGE_REQUEST1
+                                      or wallbox.charge_state == WBDef.CHARGE_REQUEST2)
 
     # wrapper so we can filter and work on min time
     def set_current_for_wallbox(self, wallbox_connection: ModbusRTUHeidelbergWB, wallbox: WBSystemState, current: float):
         if wallbox_connection.set_max_current(wallbox.slave_id, Toolbox.amp_rounded_to_wb_format(current)):
             wallbox.max_current_active = current
-            wallbox.last_time_max_current_was_set = datetime.datetime.now()
+            wallbox.last_time_max_current_was_set = self.clock()
 
     def set_current_for_wallbox_relaxed(self, wallbox_connection: ModbusRTUHeidelbergWB, wallbox: WBSystemState, current: float):
         if wallbox.last_time_max_current_was_set is 0:  # first time
             self.set_current_for_wallbox(wallbox_connection, wallbox, current)
         else:
-            time_diff = datetime.datetime.now() - wallbox.last_time_max_current_was_set
+            time_diff = self.clock() - wallbox.last_time_max_current_was_set
             if time_diff.total_seconds() > self.cfg.KEEP_CHARGE_CURRENT_STABLE_FOR:
                 self.set_current_for_wallbox(wallbox_connection, wallbox, current)
 
@@ -57,34 +61,75 @@ class WallboxProxy:
                 connected += 1
         # assign respective power to the wallboxes, evenly
         if connected > 0:
+            # with many WBs the share could drop below the min current. Then only the first ones (by priority) charge
+            charging = min(connected, int(self.cfg.WB_SYSTEM_MAX_CURRENT // self.cfg.WB_MIN_CURRENT))
+            current = self.cfg.WB_SYSTEM_MAX_CURRENT // charging if charging > 0 else 0
             for wb in wallbox:
-                if self.is_plug_connected_and_charge_ready(wb):  # connected
-                    self.set_current_for_wallbox(wallbox_connection, wb, self.cfg.WB_SYSTEM_MAX_CURRENT // connected)
-                    logging.warning('Wallbox ID %s, current set to %s A', wb.slave_id, self.cfg.WB_SYSTEM_MAX_CURRENT // connected)
+                if self.is_plug_connected_and_charge_ready(wb) and charging > 0:  # connected
+                    charging -= 1
+                    self.set_current_for_wallbox(wallbox_connection, wb, current)
+                    logging.warning('Wallbox ID %s, current set to %s A', wb.slave_id, current)
                     if not wb.grid_charge_active:
                         wb.grid_charge_active = True
-                        wb.last_charge_activation = datetime.datetime.now()
-                else:  # disconnected
+                        wb.last_charge_activation = self.clock()
+                else:  # disconnected or no current left
                     self.set_current_for_wallbox(wallbox_connection, wb, 0)
                     if wb.grid_charge_active:
                         wb.grid_charge_active = False
-                        wb.last_charge_deactivation = datetime.datetime.now()
+                        wb.last_charge_deactivation = self.clock()
         else:
             logging.info('No Connector connected')
 
     def deactivate_pv_charge_for_wallbox(self, wallbox: WBSystemState):
         wallbox.pv_charge_active = False
         wallbox.max_current_active = 0
-        wallbox.last_charge_deactivation = datetime.datetime.now()
+        wallbox.last_charge_deactivation = self.clock()
 
     def activate_pv_charge_for_wallbox(self, wallbox: WBSystemState, current):
         wallbox.pv_charge_active = True
         wallbox.max_current_active = current
-        wallbox.last_charge_activation = datetime.datetime.now()
+        wallbox.last_charge_activation = self.clock()
+
+    # PV branch of the control cycle. pv_replay runs the same
+    def allocate_pv(self, wallbox_connection: ModbusRTUHeidelbergWB, wallbox: List[WBSystemState]
+                    , solar_log_data: SolarLogData, already_used_charging_power_for_car, pv_forecast=None):
+        # make sure that all active WBs get deactivated first when switching to PV
+        # this could be more intelligent, just brute force make sure that we have a clean state to start from
+        self.deactivate_grid_charge(wallbox_connection, wallbox)
+
+        # calc the power we could spend for charging
+        # if we change our target power too often/fast, we start to resonate with the measured power consumption
+        if self.last_power_calc.seconds_have_passed_since_trigger() > self.cfg.KEEP_CHARGE_CURRENT_STABLE_FOR:
+            if pv_forecast is not None:
+                solar_log_data = pv_forecast.forecast_data(solar_log_data)
+                logging.warning('Predicted AC Output (PV): %s W', solar_log_data.actual_output)
+            self.available_power = Toolbox.calc_available_power(solar_log_data, already_used_charging_power_for_car)
+            self.last_power_calc.trigger_time()
+
+        # check for enough power to use PV
+        available_current = Toolbox.watt_to_amp_rounded(self.available_power)
+        available_current -= self.cfg.REDUCE_AVAILABLE_CURRENT_BY
+        if available_current >= (self.cfg.WB_MIN_CURRENT - self.cfg.PV_CHARGE_AMP_TOLERANCE):
+            # Charge galore
+            self.activate_pv_charge(wallbox_connection, wallbox, available_current)
 
     def activate_pv_charge(self, wallbox_connection: ModbusRTUHeidelbergWB, wallbox: List[WBSystemState], available_current):
+        # all WBs together must not draw more than the site allows
+        if 0 < self.cfg.WB_SITE_MAX_CURRENT < available_current:
+            available_current = self.cfg.WB_SITE_MAX_CURRENT
+
+        if self.cfg.WB_ALLOCATOR == 'waterfill':
+            self.activate_pv_charge_waterfill(wallbox_connection, wallbox, available_current)
+        else:
+            self.activate_pv_charge_greedy(wallbox_connection, wallbox, available_current)
+
+    # the first WBs (by priority) take as much as they can, the next ones get what is left
+    def activate_pv_charge_greedy(self, wallbox_connection: ModbusRTUHeidelbergWB, wallbox: List[WBSystemState]
+                                  , available_current):
 
         used_current: float = 0.0
+        # what the fuse of the site still allows. Unlike available_current never exceeded, not even for the min current
+        site_left = self.cfg.WB_SITE_MAX_CURRENT if self.cfg.WB_SITE_MAX_CURRENT > 0 else float('inf')
 
         # are any of the Wallboxes already charging with PV? then we update these first
         logging.info('Working on already active WBs first')
@@ -99,7 +144,8 @@ class WallboxProxy:
                         used_current = available_current
 
                     # check if we have enough power for this WB. If not we try to switch it off
-                    if used_current >= (self.cfg.WB_MIN_CURRENT - self.cfg.PV_CHARGE_AMP_TOLERANCE):
+                    if used_current >= (self.cfg.WB_MIN_CURRENT - self.cfg.PV_CHARGE_AMP_TOLERANCE) \
+                            and self.cfg.WB_MIN_CURRENT <= site_left:
                         # enough power. we already charge so no check required
                         if used_current < self.cfg.WB_MIN_CURRENT:  # cant charge less than the min current though
                             used_current = self.cfg.WB_MIN_CURRENT
@@ -107,7 +153,8 @@ class WallboxProxy:
                         self.set_current_for_wallbox(wallbox_connection, wb, used_current)
 
                     else:  # we do not have enough power. Check if we can deactivate this WB
-                        if self.is_pv_charge_deactivation_allowed(wb):
+                        if self.is_pv_charge_deactivation_allowed(wb) or self.cfg.WB_MIN_CURRENT > site_left:
+                            # the site limit is a fuse: off, even if the hold time is not over yet
                             used_current = 0
                             self.set_current_for_wallbox(wallbox_connection, wb, used_current)
                             self.deactivate_pv_charge_for_wallbox(wb)
@@ -128,6 +175,7 @@ class WallboxProxy:
 
                 # keep track of the the current contingent
                 available_current -= used_current
+                site_left -= used_current
                 logging.info('Still Available current: %s A', available_current)
 
         # 2nd step: if we have enough power left, we can check to activate WBs that do not charge yet
@@ -147,12 +195,15 @@ class WallboxProxy:
                                 used_current = available_current
 
                         # check if we can activate this WB. If not we just try the next one
-                        if self.is_pv_charge_activation_allowed(wb):
+                        if used_current > site_left:
+                            logging.info('Site max current reached. Wallbox ID %s not activated', wb.slave_id)
+                        elif self.is_pv_charge_activation_allowed(wb):
                             self.set_current_for_wallbox(wallbox_connection, wb, used_current)
                             logging.info('Setting Wallbox ID %s to %s A', wb.slave_id, used_current)
                             self.activate_pv_charge_for_wallbox(wb, used_current)
                             # keep track of the the current contingent
                             available_current -= used_current
+                            site_left -= used_current
                             logging.debug('Still Available current: %s A', available_current)
                         else:
                             logging.error('Charge activation for Wallbox ID %s not allowed due to time constraints',
@@ -163,14 +214,69 @@ class WallboxProxy:
             else:
                 logging.info('This WB has no charge request')
 
+    # as many WBs as the current allows charge, all of them with the same current (up to their max).
+    # Priority only decides who gets in: charging WBs first, then the waiting ones by Slave ID.
+    # Same hold times as the greedy way: a WB is only switched on/off if MIN_WAIT_BEFORE_PV_ON/MIN_TIME_PV_CHARGE allow it
+    def activate_pv_charge_waterfill(self, wallbox_connection: ModbusRTUHeidelbergWB, wallbox: List[WBSystemState]
+                                     , available_current):
+        min_current = self.cfg.WB_MIN_CURRENT
+        min_needed = min_current - self.cfg.PV_CHARGE_AMP_TOLERANCE
+
+        # charging WBs that have to keep on charging come first, they get the min current in any case
+        selected = []
+        optional = []
+        for wb in wallbox:
+            if not self.is_plug_connected_and_charge_ready(wb):
+                if wb.pv_charge_active:  # no charge request (anymore)
+                    self.set_current_for_wallbox(wallbox_connection, wb, 0)
+                    self.deactivate_pv_charge_for_wallbox(wb)
+                    logging.info('No charge request anymore for Wallbox ID %s. Deactivating', wb.slave_id)
+            elif wb.pv_charge_active:
+                if self.is_pv_charge_deactivation_allowed(wb):
+                    optional.append(wb)
+                else:
+                    selected.append(wb)
+            elif self.is_pv_charge_activation_allowed(wb):
+                optional.append(wb)
+        optional.sort(key=lambda x: not x.pv_charge_active)  # stable, keeps the Slave ID order
+
+        # the site limit is a fuse: never more WBs than it allows with the min current, hold time or not
+        if self.cfg.WB_SITE_MAX_CURRENT > 0:
+            max_selected = int(self.cfg.WB_SITE_MAX_CURRENT // min_current)
+            for wb in selected[max_selected:]:
+                self.set_current_for_wallbox(wallbox_connection, wb, 0)
+                self.deactivate_pv_charge_for_wallbox(wb)
+                logging.warning('Charge deactivation for Wallbox ID %s. Site max current reached', wb.slave_id)
+            selected = selected[:max_selected]
+        else:
+            max_selected = len(wallbox)
+
+        remaining = available_current - len(selected) * min_current
+        for wb in optional:
+            if remaining >= min_needed and len(selected) < max_selected:
+                selected.append(wb)
+                remaining -= min_current
+            elif wb.pv_charge_active:
+                self.set_current_for_wallbox(wallbox_connection, wb, 0)
+                self.deactivate_pv_charge_for_wallbox(wb)
+                logging.warning('Charge deactivation for Wallbox ID %s', wb.slave_id)
+
+        currents = Toolbox.water_fill(available_current, [min_current] * len(selected)
+                                      , [self.cfg.WB_SYSTEM_MAX_CURRENT] * len(selected))
+        for wb, current in zip(selected, currents):
+            self.set_current_for_wallbox(wallbox_connection, wb, current)
+            logging.warning('Setting Wallbox ID %s to %s A', wb.slave_id, current)
+            if not wb.pv_charge_active:
+                self.activate_pv_charge_for_wallbox(wb, current)
+
     # check if WB was inactive for long enough (to avoid fast switch on/off)
     def is_pv_charge_activation_allowed(self, wallbox: WBSystemState) -> bool:
-        time_diff = datetime.datetime.now() - wallbox.last_charge_deactivation
+        time_diff = self.clock() - wallbox.last_charge_deactivation
         return time_diff.total_seconds() > self.cfg.MIN_WAIT_BEFORE_PV_ON
 
     # check if WB was active for long enough (to avoid fast switch on/off)
     def is_pv_charge_deactivation_allowed(self, wallbox: WBSystemState) -> bool:
-        time_diff = datetime.datetime.now() - wallbox.last_charge_activation
+        time_diff = self.clock() - wallbox.last_charge_activation
         return time_diff.total_seconds() > self.cfg.MIN_TIME_PV_CHARGE
 
     def deactivate_grid_charge(self, wallbox_connection: ModbusRTUHeidelbergWB, wallbox: List[WBSystemState]):
@@ -178,14 +284,14 @@ class WallboxProxy:
             if wb.grid_charge_active:
                 wallbox_connection.set_max_current(wb.slave_id, 0)
                 wb.grid_charge_active = False
-                wb.last_charge_deactivation = datetime.datetime.now()
+                wb.last_charge_deactivation = self.clock()
 
     def deactivate_pv_charge(self, wallbox_connection: ModbusRTUHeidelbergWB, wallbox: List[WBSystemState]):
         for wb in wallbox:
             if wb.pv_charge_active:
                 wallbox_connection.set_max_current(wb.slave_id, 0)
                 wb.pv_charge_active = False
-                wb.last_charge_deactivation = datetime.datetime.now()
+                wb.last_charge_deactivation = self.clock()
 
     def is_charging_active(self, wallbox: List[WBSystemState]) -> bool:
         for wb in wallbox:
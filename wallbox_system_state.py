@@ -1,38 +1,88 @@
 import datetime
-from pv_modbus_wallbox import WBDef
+from pv_modbus_wallbox import WBDef, HeidelbergWBTelemetry
 
 
 class WBSystemState:
+    # fixed layout: no __dict__ per WB, and a typo in an attribute name fails instead of adding a new one
+    __slots__ = ('slave_id', 'available', 'charge_state', 'pcb_temperature'
+                 , 'layout_version', 'current_l1', 'current_l2', 'current_l3', 'voltage_l1', 'voltage_l2', 'voltage_l3'
+                 , 'extern_lock_state', 'actual_charge_power', 'energy_since_power_on', 'energy_since_installation'
+                 , 'standby_requested', 'standby_active', 'max_current_active', 'last_time_max_current_was_set'
+                 , 'actual_current_active', 'max_failsafe_current_active', 'pv_charge_active', 'grid_charge_active'
+                 , 'last_charge_activation', 'last_charge_deactivation')
+
     def __init__(self, slave_id):
         self.slave_id = slave_id
+        self.available = True  # False while the WB does not answer
+
+        self.charge_state: WBDef = 0
+
+        self.pcb_temperature = 0
+
+        # telemetry of the last bulk read
+        self.layout_version = 0
+        self.current_l1 = 0
+        self.current_l2 = 0
+        self.current_l3 = 0
+        self.voltage_l1 = 0
+        self.voltage_l2 = 0
+        self.voltage_l3 = 0
+        self.extern_lock_state = 0
+        self.actual_charge_power = 0
+        self.energy_since_power_on = 0
+        self.energy_since_installation = 0
+
+        self.standby_requested: WBDef = WBDef.DISABLE_STANDBY
+        self.standby_active: WBDef = WBDef.DISABLE_STANDBY
 
-    charge_state: WBDef = 0
+        self.max_current_active = 0
+        self.last_time_max_current_was_set: datetime.datetime = 0
+        self.actual_current_active = 0
 
-    pcb_temperature = 0
+        self.max_failsafe_current_active = 0
 
-    standby_requested: WBDef = WBDef.DISABLE_STANDBY
-    standby_active: WBDef = WBDef.DISABLE_STANDBY
+        self.pv_charge_active: bool = False
+        self.grid_charge_active: bool = False
 
-    max_current_active = 0
-    last_time_max_current_was_set: datetime.datetime = 0
-    actual_current_active = 0
+        # datetime when the WB started charging
+        self.last_charge_activation: datetime.datetime = 0
+        # datetime when the WB stopped charging
+        self.last_charge_deactivation: datetime.datetime = 0
 
-    max_failsafe_current_active = 0
+    def update_from_telemetry(self, telemetry: HeidelbergWBTelemetry):
+        self.available = True
+        self.layout_version = telemetry.layout_version
+        self.charge_state = telemetry.charge_state
+        self.current_l1 = telemetry.current_l1
+        self.current_l2 = telemetry.current_l2
+        self.current_l3 = telemetry.current_l3
+        self.pcb_temperature = telemetry.pcb_temperature
+        self.voltage_l1 = telemetry.voltage_l1
+        self.voltage_l2 = telemetry.voltage_l2
+        self.voltage_l3 = telemetry.voltage_l3
+        self.extern_lock_state = telemetry.extern_lock_state
+        self.actual_charge_power = telemetry.actual_charge_power
+        self.energy_since_power_on = telemetry.energy_since_power_on
+        self.energy_since_installation = telemetry.energy_since_installation
 
-    pv_charge_active: bool = False
-    grid_charge_active: bool = False
+    # the WB did not answer or is skipped. What it read last is not true anymore: no charge request and no power,
+    # so it gets no current and its power is not counted as ours. If it still charges, it does with its failsafe current
+    def mark_unavailable(self):
+        self.available = False
+        self.charge_state = 0
+        self.current_l1 = 0
+        self.current_l2 = 0
+        self.current_l3 = 0
+        self.actual_charge_power = 0
+        self.actual_current_active = 0
 
-    # datetime when the WB started charging
-    last_charge_activation: datetime.datetime = 0
-    # datetime when the WB stopped charging
-    last_charge_deactivation: datetime.datetime = 0
+    # immutable copy of what gets saved to the DB. Equal snapshots -> nothing to write
+    def snapshot(self) -> tuple:
+        return (self.charge_state, self.pv_charge_active, self.grid_charge_active, self.max_current_active
+                , self.actual_current_active)
 
-    def __eq__(self, other):  # only comparing what is relevant to be saved. Only a bit ugly :)
+    def __eq__(self, other):  # only comparing what is relevant to be saved
         if not isinstance(other, WBSystemState):
             return NotImplemented
 
-        return self.charge_state == other.charge_state \
-            and self.pv_charge_active == other.pv_charge_active \
-            and self.grid_charge_active == other.grid_charge_active \
-            and self.max_current_active == other.max_current_active \
-            and self.actual_current_active == other.actual_current_active
+        return self.snapshot() == other.snapshot()